@@ -0,0 +1,754 @@
+"""Parallel batch processing of gas exchange imaging subjects.
+
+Every subject runs in its own worker process, so that an exception, a crash or a
+timeout in one subject does not affect the others. Worker processes are started
+with the thread pools of the numerical libraries capped, so that N workers with
+T threads each do not oversubscribe the node.
+
+Subjects are admitted only while the sum of their estimated peak memory fits the
+memory budget of the node. The estimates come from utils/memory_utils.py and are
+calibrated from the peak memory recorded for past runs, unless the config of the
+subject sets its own memory budget.
+
+The result of every subject is recorded in the manifest of the cohort (see
+utils/manifest.py), so that rerunning a cohort skips the subjects that are up to
+date and retries the ones that failed.
+"""
+
+import collections
+import glob
+import importlib.util
+import logging
+import multiprocessing as mp
+import os
+import queue
+import shutil
+import signal
+import tempfile
+import threading
+import time
+import traceback
+from typing import Any, Dict, List, Optional, Sequence
+
+import segmentation_service
+from config import base_config
+from utils import compute_utils, constants, manifest, memory_utils
+
+MODE_AUTO = "auto"
+MODE_RECON = "recon"
+MODE_READIN = "readin"
+POLL_INTERVAL = 0.5
+TERMINATE_GRACE = 10.0
+MEMORY_BUDGET_FRACTION = 0.9
+CONFIG_DIR = "config/"
+# config modules imported by load_config, by absolute path
+_CONFIG_MODULES: Dict[str, Any] = {}
+
+
+class BatchJob(object):
+    """Subject config processed in a batch.
+
+    Attributes:
+        config_path (str): path of the subject config file
+        subject_id (str): subject id, set once the config is loaded by the worker
+        status (constants.BatchStatus): status of the job
+        runtime (float): wall time of the job in seconds
+        error (str): error message if the job failed
+        features (dict): features of the peak memory model, or None if the config
+            cannot be loaded
+        memory (float): estimated peak memory in bytes
+        peak_rss (int): measured peak memory in bytes
+        key (str): key of the inputs of the job, see manifest.get_key, or None if
+            the config cannot be loaded
+    """
+
+    def __init__(self, config_path: str):
+        """Init object."""
+        self.config_path = config_path
+        self.subject_id = os.path.splitext(os.path.basename(config_path))[0]
+        self.status = constants.BatchStatus.PENDING
+        self.runtime = 0.0
+        self.error = ""
+        self.features: Optional[Dict[str, float]] = None
+        self.memory = 0.0
+        self.peak_rss = 0
+        self.key: Optional[str] = None
+
+    def estimate_memory(
+        self, model: memory_utils.MemoryModel, config: Optional[base_config.Config]
+    ):
+        """Estimate the peak memory of the job from its config.
+
+        The memory budget of the config, if set, is used instead of the estimate.
+
+        Args:
+            model: peak memory model
+            config: config of the subject, or None if it cannot be loaded
+        """
+        try:
+            self.features = memory_utils.get_features(config)
+            self.memory = model.predict(self.features)
+        except Exception as e:
+            logging.warning(
+                "Cannot estimate memory of {}: {}".format(self.config_path, e)
+            )
+            self.memory = model.predict(
+                {name: float(name == "intercept") for name in memory_utils.FEATURES}
+            )
+        if config is not None and config.compute.memory_budget_gb:
+            self.memory = config.compute.memory_budget_gb * 1e9
+
+
+def get_config_paths(cohort: str, config_glob: Optional[str] = None) -> List[str]:
+    """Get the config files of the subjects of a cohort.
+
+    Args:
+        cohort: cohort folder name in the config folder, "all", or cohort names
+            joined by "-", e.g. "healthy-cteph"
+        config_glob: glob of config files to use instead of the cohort
+    Returns:
+        list of config file paths
+    """
+    if config_glob:
+        return sorted(glob.glob(config_glob))
+    if cohort == "healthy":
+        subjects = glob.glob(os.path.join(CONFIG_DIR, "healthy", "*py"))
+    elif cohort == "cteph":
+        subjects = glob.glob(os.path.join(CONFIG_DIR, "cteph", "*py"))
+    elif cohort == "ild":
+        subjects = glob.glob(os.path.join(CONFIG_DIR, "ild", "*py"))
+    elif cohort == "tyvaso":
+        subjects = glob.glob(os.path.join(CONFIG_DIR, "tyvaso", "*py"))
+    elif cohort == "jupiter":
+        subjects = glob.glob(os.path.join(CONFIG_DIR, "jupiter", "*py"))
+    elif cohort == "all":
+        subjects = glob.glob(os.path.join(CONFIG_DIR, "healthy", "*py"))
+        subjects += glob.glob(os.path.join(CONFIG_DIR, "cteph", "*py"))
+        subjects += glob.glob(os.path.join(CONFIG_DIR, "ild", "*py"))
+        subjects += glob.glob(os.path.join(CONFIG_DIR, "tyvaso", "*py"))
+    elif "-" in cohort:
+        cohorts = cohort.split("-")
+        subjects = []
+        for name in cohorts:
+            if name == "healthy":
+                subjects += glob.glob(os.path.join(CONFIG_DIR, "healthy", "*py"))
+            elif name == "cteph":
+                subjects += glob.glob(os.path.join(CONFIG_DIR, "cteph", "*py"))
+            elif name == "ild":
+                subjects += glob.glob(os.path.join(CONFIG_DIR, "ild", "*py"))
+            elif name == "tyvaso":
+                subjects += glob.glob(os.path.join(CONFIG_DIR, "tyvaso", "*py"))
+            else:
+                raise ValueError("Invalid cohort name")
+    else:
+        raise ValueError("Invalid cohort name")
+
+    return subjects
+
+
+def get_mode(force_recon: bool, force_readin: bool) -> str:
+    """Get the pipeline mode from the pipeline flags.
+
+    Args:
+        force_recon: whether to force the reconstruction
+        force_readin: whether to force reading in the .mat file
+    Returns:
+        pipeline mode, see run_subject
+    """
+    if force_recon:
+        return MODE_RECON
+    elif force_readin:
+        return MODE_READIN
+    return MODE_AUTO
+
+
+def load_config(config_path: str, reload: bool = False) -> base_config.Config:
+    """Import a subject config file.
+
+    The file is imported from its absolute path, like the --config flag of
+    main.py, so that config files outside the repository can be used.
+
+    Args:
+        config_path: path of the config file, absolute or relative to the working
+            directory, e.g. config/healthy/subject.py
+        reload: whether to import the file again if it was already imported, so
+            that long-lived processes see edits of the config
+    Returns:
+        config of the subject
+    """
+    path = os.path.abspath(config_path)
+    module = _CONFIG_MODULES.get(path)
+    if module is None or reload:
+        name = os.path.splitext(os.path.basename(path))[0]
+        spec = importlib.util.spec_from_file_location(name, path)
+        if spec is None or spec.loader is None:
+            raise ValueError("Invalid config file {}".format(config_path))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        _CONFIG_MODULES[path] = module
+    return module.get_config()
+
+
+def run_subject(
+    config: base_config.Config,
+    mode: str = MODE_AUTO,
+    resume: bool = True,
+    force_segmentation: bool = False,
+):
+    """Run the gas exchange imaging pipeline on a subject.
+
+    Args:
+        config: config of the subject
+        mode: MODE_RECON to reconstruct, MODE_READIN to read in the .mat file or
+            MODE_AUTO to follow config.processes
+        resume: whether to restore unchanged stages from checkpoints, ignored with
+            MODE_RECON, which forces all stages to run again
+        force_segmentation: whether to run segmentation again when reading in
+    """
+    from main import gx_mapping_readin, gx_mapping_reconstruction
+
+    if mode == MODE_RECON or (mode == MODE_AUTO and config.processes.gx_mapping_recon):
+        gx_mapping_reconstruction(config, resume=resume and mode != MODE_RECON)
+    elif mode == MODE_READIN or (
+        mode == MODE_AUTO and config.processes.gx_mapping_readin
+    ):
+        gx_mapping_readin(config, force_segmentation, resume=resume)
+    else:
+        logging.info("No process specified for subject {}".format(config.subject_id))
+
+
+def _run_job(
+    config_path: str,
+    mode: str,
+    resume: bool,
+    force_segmentation: bool,
+    threads: int,
+    results: Any,
+    segmentation_client: Optional[Any] = None,
+    scratch_dir: Optional[str] = None,
+):
+    """Run a batch job in a worker process and report its result.
+
+    Args:
+        config_path: path of the subject config file
+        mode: pipeline mode, see run_subject
+        resume: whether to restore unchanged stages from checkpoints
+        force_segmentation: whether to run segmentation again when reading in
+        threads: number of threads of the worker
+        results: queue to put the result of the job in
+        segmentation_client: client of the segmentation service of the batch, or
+            None to load the segmentation model in the worker
+        scratch_dir: directory of the workspace of the job, which replaces the
+            scratch directory of the config, or None to keep it
+    """
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s %(processName)s %(message)s"
+    )
+    signal.signal(signal.SIGTERM, _exit_on_sigterm)
+    result = {"config_path": config_path, "status": constants.BatchStatus.SUCCESS}
+    try:
+        config = load_config(config_path)
+        compute_utils.cap_threads(config.compute, threads)
+        if scratch_dir:
+            config.compute.scratch_dir = scratch_dir
+        if segmentation_client is not None:
+            import segmentation
+
+            segmentation.set_remote_model(segmentation_client)
+        result["subject_id"] = config.subject_id
+        results.put(dict(result, status=constants.BatchStatus.RUNNING))
+        run_subject(config, mode, resume, force_segmentation)
+    except Exception:
+        logging.error(traceback.format_exc())
+        result["status"] = constants.BatchStatus.FAILED
+        result["error"] = traceback.format_exc(limit=-1).strip()
+    result["peak_rss"] = memory_utils.get_peak_rss()
+    results.put(result)
+
+
+def _collect_results(results: Any, jobs: Dict[str, BatchJob], timeout: float):
+    """Update the jobs with the results reported by the workers.
+
+    Args:
+        results: queue of results
+        jobs: jobs by config path
+        timeout: seconds to wait for the first result
+    """
+    while True:
+        try:
+            result = results.get(timeout=timeout)
+        except queue.Empty:
+            return
+        timeout = 0
+        job = jobs[result["config_path"]]
+        job.subject_id = result.get("subject_id", job.subject_id)
+        job.status = result["status"]
+        job.error = result.get("error", "")
+        job.peak_rss = result.get("peak_rss", 0)
+
+
+def _make_scratch_dir(
+    config: Optional[base_config.Config], subject_id: str
+) -> Optional[str]:
+    """Make the scratch directory of a job in the scratch directory of its config.
+
+    The workspace of the subject is created in it, so that the batch runner can
+    remove the workspace of a worker it stopped, whose finalizers may not run.
+
+    Args:
+        config: config of the subject, or None if it cannot be loaded
+        subject_id: subject id
+    Returns:
+        str absolute path of the directory, or None if the config cannot be loaded
+    """
+    if config is None:
+        return None
+    os.makedirs(str(config.compute.scratch_dir), exist_ok=True)
+    return os.path.abspath(
+        tempfile.mkdtemp(
+            prefix="{}_job_".format(subject_id), dir=str(config.compute.scratch_dir)
+        )
+    )
+
+
+def _remove_scratch_dir(path: Optional[str]):
+    """Remove the scratch directory of a job and the workspace left in it.
+
+    Args:
+        path: path of the directory, see _make_scratch_dir
+    """
+    if path:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def _exit_on_sigterm(signum: int, frame: Any):
+    """Exit a worker process cleanly when it is terminated.
+
+    The worker then unwinds like on any exit: its queues finish writing what
+    they are sending and the finalizers, such as those of the workspaces, run.
+
+    Args:
+        signum: signal number
+        frame: current stack frame
+    """
+    raise SystemExit("terminated by signal {}".format(signum))
+
+
+def _stop_process(process: Any) -> bool:
+    """Terminate a worker process, killing it if it does not exit.
+
+    Args:
+        process: worker process
+    Returns:
+        True if the process had to be killed, which can leave the queues it was
+        writing to corrupted
+    """
+    process.terminate()
+    process.join(TERMINATE_GRACE)
+    if not process.is_alive():
+        return False
+    process.kill()
+    process.join()
+    return True
+
+
+class MemoryAdmission(object):
+    """Memory budget of a node, shared by the batches running on it.
+
+    Attributes:
+        budget (float): memory available to the workers in bytes
+        used (float): estimated peak memory of the admitted jobs in bytes
+        n_admitted (int): number of admitted jobs
+    """
+
+    def __init__(self, budget: Optional[float] = None):
+        """Initialize the budget.
+
+        Args:
+            budget: memory available to the workers in bytes, or None for a
+                fraction of the physical memory of the node
+        """
+        if budget is None:
+            budget = MEMORY_BUDGET_FRACTION * memory_utils.get_total_memory()
+        self.budget = budget
+        self.used = 0.0
+        self.n_admitted = 0
+        self._lock = threading.Lock()
+
+    def admit(self, memory: float) -> bool:
+        """Admit a job if its memory fits the memory left in the budget.
+
+        A job larger than the whole budget is admitted when no other job is.
+
+        Args:
+            memory: estimated peak memory of the job in bytes
+        Returns:
+            True if the job is admitted
+        """
+        with self._lock:
+            if self.n_admitted and self.used + memory > self.budget:
+                return False
+            self.used += memory
+            self.n_admitted += 1
+            return True
+
+    def release(self, memory: float):
+        """Release the memory of a finished job.
+
+        Args:
+            memory: estimated peak memory of the job in bytes
+        """
+        with self._lock:
+            self.used -= memory
+            self.n_admitted -= 1
+
+
+def _next_job(
+    pending: List[BatchJob], admission: MemoryAdmission
+) -> Optional[BatchJob]:
+    """Admit the first pending job that fits the memory left.
+
+    Args:
+        pending: pending jobs in order
+        admission: memory budget of the node
+    Returns:
+        job to start, or None if no job fits
+    """
+    for job in pending:
+        if admission.admit(job.memory):
+            return job
+    return None
+
+
+def _is_selected(
+    job: BatchJob,
+    entry: Optional[Dict[str, Any]],
+    resume: bool,
+    only_failed: bool,
+    since: Optional[str],
+) -> bool:
+    """Check whether a job runs given its manifest entry.
+
+    Args:
+        job: batch job
+        entry: manifest entry of the job, or None if it never ran
+        resume: whether subjects that are up to date are skipped
+        only_failed: only select jobs whose last run failed or timed out
+        since: only select jobs not run successfully with their current inputs
+            since this date (YYYY-MM-DD): jobs never run, last run before the
+            date, or whose inputs changed since their last successful run
+    Returns:
+        True if the job runs
+    """
+    if only_failed:
+        return entry is not None and entry.get("status") in (
+            constants.BatchStatus.FAILED.value,
+            constants.BatchStatus.TIMEOUT.value,
+        )
+    if since:
+        return (
+            entry is None
+            or entry.get("finished", "")[:10] < since
+            or not manifest.is_up_to_date(entry, job.key)
+        )
+    return not (resume and entry and manifest.is_up_to_date(entry, job.key))
+
+
+def _record_job(
+    manifest_path: str,
+    job: BatchJob,
+    config: Optional[base_config.Config],
+    start: float,
+    mode: str,
+    force_segmentation: bool,
+):
+    """Record the result of a finished job in the manifest.
+
+    The key is computed again after a successful run because the pipeline may
+    rewrite its own inputs, e.g. the .mat file when reading in.
+
+    Args:
+        manifest_path: path of the manifest of the cohort
+        job: finished job
+        config: config of the subject, or None if it cannot be loaded
+        start: start time of the job in seconds since the epoch
+        mode: pipeline mode, see run_subject
+        force_segmentation: whether segmentation was run again when reading in
+    """
+    key, outputs = job.key, []
+    if config is not None:
+        outputs = manifest.get_output_files(config, start)
+        if job.status == constants.BatchStatus.SUCCESS:
+            key = manifest.get_key(config, mode, force_segmentation)
+    manifest.update_manifest(
+        manifest_path,
+        job.config_path,
+        {
+            "subject_id": job.subject_id,
+            "key": key,
+            "status": job.status.value,
+            "runtime": round(job.runtime, 1),
+            "outputs": outputs,
+            "error": job.error,
+        },
+    )
+
+
+def run_batch(
+    config_paths: Sequence[str],
+    n_workers: int = 1,
+    threads_per_worker: int = 1,
+    timeout: Optional[float] = None,
+    mode: str = MODE_AUTO,
+    resume: bool = True,
+    force_segmentation: bool = False,
+    memory_budget: Optional[float] = None,
+    history_path: str = memory_utils.HISTORY_PATH,
+    manifest_path: Optional[str] = None,
+    only_failed: bool = False,
+    since: Optional[str] = None,
+    segmentation_batch_size: int = 1,
+    segmentation_max_wait: float = 5.0,
+    admission: Optional[MemoryAdmission] = None,
+) -> List[BatchJob]:
+    """Run the gas exchange imaging pipeline on subjects in parallel.
+
+    Pending subjects are started in order, skipping those whose estimated peak
+    memory does not fit the memory left in the budget, so that smaller subjects
+    can run next to a large one. A subject larger than the whole budget runs on
+    its own.
+
+    If a manifest is given, subjects whose last run succeeded with the same
+    inputs are skipped when resuming, and the result of every subject that runs
+    is recorded in the manifest.
+
+    Args:
+        config_paths: paths of the subject config files
+        n_workers: number of subjects processed concurrently
+        threads_per_worker: number of threads of the numerical libraries in each
+            worker
+        timeout: maximum wall time per subject in seconds, or None for no limit
+        mode: pipeline mode, see run_subject
+        resume: whether to restore unchanged stages from checkpoints
+        force_segmentation: whether to run segmentation again when reading in
+        memory_budget: memory available to the workers in bytes, or None for a
+            fraction of the physical memory of the node
+        history_path: path of the peak memory history used to calibrate the
+            estimates
+        manifest_path: path of the manifest of the cohort, or None to run all
+            subjects without recording them
+        only_failed: only run the subjects whose last run failed or timed out
+        since: only run the subjects not run successfully with their current
+            inputs since this date (YYYY-MM-DD), i.e. never run, last run before
+            the date, or whose inputs changed. Subjects last run before the date
+            run again even if they are up to date.
+        segmentation_batch_size: maximum number of subjects segmented in one
+            batch by the segmentation service, see segmentation_service.py. With
+            1, each worker loads the model and segments its subject.
+        segmentation_max_wait: maximum time in seconds a subject waits for others
+            to fill a segmentation batch
+        admission: memory budget shared with other batches running on the node,
+            e.g. by the workers of work_queue.py, in which case memory_budget is
+            ignored. Defaults to a budget of memory_budget for this batch only.
+    Returns:
+        list of jobs with their status and runtime
+    """
+    jobs = collections.OrderedDict(
+        (config_path, BatchJob(config_path)) for config_path in config_paths
+    )
+    if admission is None:
+        admission = MemoryAdmission(memory_budget)
+    memory_budget = admission.budget
+    model = memory_utils.get_calibrated_model(history_path)
+    entries = manifest.load_manifest(manifest_path) if manifest_path else {}
+    configs: Dict[str, Optional[base_config.Config]] = {}
+    pending = []
+    for job in jobs.values():
+        try:
+            configs[job.config_path] = load_config(job.config_path)
+            job.subject_id = configs[job.config_path].subject_id
+            job.key = manifest.get_key(
+                configs[job.config_path], mode, force_segmentation
+            )
+        except Exception as e:
+            logging.warning("Cannot load {}: {}".format(job.config_path, e))
+            configs[job.config_path] = None
+        entry = entries.get(job.config_path)
+        if manifest_path and not _is_selected(
+            job, entry, resume, only_failed, since
+        ):
+            job.status = constants.BatchStatus.SKIPPED
+            continue
+        job.estimate_memory(model, configs[job.config_path])
+        if job.memory > memory_budget:
+            logging.warning(
+                "{} needs {:.1f} GB, more than the {:.1f} GB budget.".format(
+                    job.config_path, job.memory / 1e9, memory_budget / 1e9
+                )
+            )
+        pending.append(job)
+    logging.info(
+        "Running {} subjects, skipping {}.".format(
+            len(pending), len(jobs) - len(pending)
+        )
+    )
+    running: Dict[str, Any] = {}
+    ctx = mp.get_context("spawn")
+    results = ctx.Queue()
+    service = None
+    free_slots = list(range(n_workers))
+    slots: Dict[str, int] = {}
+    scratch_dirs: Dict[str, Optional[str]] = {}
+    if segmentation_batch_size > 1 and n_workers > 1 and pending:
+        with compute_utils.thread_env(threads_per_worker):
+            service = segmentation_service.SegmentationService(
+                ctx,
+                n_workers,
+                min(segmentation_batch_size, n_workers),
+                segmentation_max_wait,
+                threads_per_worker,
+            )
+    start_batch = time.time()
+    try:
+        while pending or running:
+            while pending and len(running) < n_workers:
+                job = _next_job(pending, admission)
+                if job is None:
+                    # wait for a job of this or another batch to finish
+                    break
+                pending.remove(job)
+                slots[job.config_path] = free_slots.pop(0)
+                scratch_dirs[job.config_path] = _make_scratch_dir(
+                    configs[job.config_path], job.subject_id
+                )
+                process = ctx.Process(
+                    target=_run_job,
+                    args=(
+                        job.config_path,
+                        mode,
+                        resume,
+                        force_segmentation,
+                        threads_per_worker,
+                        results,
+                        (
+                            service.get_client(slots[job.config_path])
+                            if service is not None
+                            else None
+                        ),
+                        scratch_dirs[job.config_path],
+                    ),
+                    name=job.subject_id,
+                )
+                # spawned workers inherit the environment of this process
+                with compute_utils.thread_env(threads_per_worker):
+                    process.start()
+                job.status = constants.BatchStatus.RUNNING
+                running[job.config_path] = (process, time.time())
+                logging.info(
+                    "Started {} (estimated {:.1f} GB)".format(
+                        job.config_path, job.memory / 1e9
+                    )
+                )
+            _collect_results(results, jobs, POLL_INTERVAL)
+            for config_path, (process, start) in list(running.items()):
+                job = jobs[config_path]
+                if not process.is_alive():
+                    process.join()
+                    _collect_results(results, jobs, 0)
+                    if job.status == constants.BatchStatus.RUNNING:
+                        job.status = constants.BatchStatus.FAILED
+                        job.error = "worker exited with code {}".format(
+                            process.exitcode
+                        )
+                elif timeout and time.time() - start > timeout:
+                    if _stop_process(process) and service is not None:
+                        logging.warning(
+                            "Killed {}, restarting the segmentation service.".format(
+                                job.subject_id
+                            )
+                        )
+                        with compute_utils.thread_env(threads_per_worker):
+                            service.restart()
+                    job.status = constants.BatchStatus.TIMEOUT
+                    job.error = "timed out after {:.0f} s".format(timeout)
+                else:
+                    continue
+                job.runtime = time.time() - start
+                del running[config_path]
+                admission.release(job.memory)
+                free_slots.append(slots.pop(config_path))
+                _remove_scratch_dir(scratch_dirs.pop(config_path))
+                if job.features is not None and job.peak_rss:
+                    memory_utils.append_history(
+                        {
+                            "config_path": job.config_path,
+                            "subject_id": job.subject_id,
+                            "status": job.status.value,
+                            "features": job.features,
+                            "peak_rss": job.peak_rss,
+                        },
+                        history_path,
+                    )
+                if manifest_path:
+                    _record_job(
+                        manifest_path,
+                        job,
+                        configs[config_path],
+                        start,
+                        mode,
+                        force_segmentation,
+                    )
+                logging.info(
+                    "Finished {} ({}, {:.0f} s)".format(
+                        job.subject_id, job.status.value, job.runtime
+                    )
+                )
+    finally:
+        for config_path, (process, _) in running.items():
+            _stop_process(process)
+            admission.release(jobs[config_path].memory)
+            _remove_scratch_dir(scratch_dirs.pop(config_path))
+        if service is not None:
+            service.stop()
+    logging.info(summarize(list(jobs.values()), time.time() - start_batch))
+    return list(jobs.values())
+
+
+def summarize(jobs: Sequence[BatchJob], wall_time: float) -> str:
+    """Summarize a batch run.
+
+    Args:
+        jobs: jobs of the batch
+        wall_time: wall time of the batch in seconds
+    Returns:
+        str summary with one line per job and the failures
+    """
+    lines = [
+        "{:<30} {:<8} {:>10} {:>10} {:>10}".format(
+            "subject", "status", "runtime (s)", "est. (GB)", "peak (GB)"
+        )
+    ]
+    for job in jobs:
+        lines.append(
+            "{:<30} {:<8} {:>10.0f} {:>10.1f} {:>10.1f}".format(
+                job.subject_id,
+                job.status.value,
+                job.runtime,
+                job.memory / 1e9,
+                job.peak_rss / 1e9,
+            )
+        )
+    failed = [
+        job
+        for job in jobs
+        if job.status
+        not in (constants.BatchStatus.SUCCESS, constants.BatchStatus.SKIPPED)
+    ]
+    lines.append(
+        "{} subjects, {} failed, wall time {:.0f} s, total runtime {:.0f} s".format(
+            len(jobs), len(failed), wall_time, sum(job.runtime for job in jobs)
+        )
+    )
+    for job in failed:
+        lines.append("{}: {}".format(job.subject_id, job.error))
+    return "\n".join(lines)
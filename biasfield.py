@@ -1,22 +1,95 @@
 """Bias field correction.
 
-Currently supports N4ITK bias field correction.
+Currently supports N4ITK bias field correction, with the N4BiasFieldCorrection
+executable or with its native implementation, and RF-depolarization correction,
+whose bias field is smoothed in memory by a multilevel B-spline approximation.
 """
+import logging
 import os
-from typing import Tuple
+from typing import Any, List, Optional, Sequence, Tuple
 
 import nibabel as nib
 import numpy as np
 from absl import app, flags
-from scipy import signal
 
-from utils import constants, img_utils
+from utils import (
+    bspline_utils,
+    cache_utils,
+    constants,
+    filter_utils,
+    img_utils,
+    workspace,
+)
 
 FLAGS = flags.FLAGS
 flags.DEFINE_string("image_file", "", "nifti image file path.")
 flags.DEFINE_string("mask_file", "", "nifti mask file path.")
 flags.DEFINE_string("output_path", "", "output folder location")
 
+# stages of correct_biasfield_n4itk: shrink factor, iterations of each level,
+# B-spline mesh as a spacing in voxels or as a number of spans along each axis,
+# B-spline order, histogram sharpening FWHM, and whether the product of the bias
+# fields is normalized to its mean after the stage
+N4_STAGES = (
+    {"shrink": 1, "iterations": (25,), "mesh": 112, "order": 1, "fwhm": 0.75},
+    {"shrink": 1, "iterations": (25,), "mesh": 112, "order": 2, "fwhm": 0.75},
+    {
+        "shrink": 1,
+        "iterations": (25,),
+        "mesh": 112,
+        "order": 3,
+        "fwhm": 0.75,
+        "normalize": True,
+    },
+    {
+        "shrink": 1,
+        "iterations": (25,),
+        "mesh": (1, 1, 14),
+        "order": 3,
+        "fwhm": 0.5,
+        "normalize": True,
+    },
+    {
+        "shrink": 1,
+        "iterations": (25,),
+        "mesh": (1, 14, 1),
+        "order": 3,
+        "fwhm": 0.5,
+        "normalize": True,
+    },
+    {
+        "shrink": 1,
+        "iterations": (25,),
+        "mesh": (14, 1, 1),
+        "order": 3,
+        "fwhm": 0.5,
+        "normalize": True,
+    },
+    {
+        "shrink": 2,
+        "iterations": (50,),
+        "mesh": (4, 4, 4),
+        "order": 3,
+        "fwhm": 0.25,
+        "normalize": True,
+    },
+)
+N4_WIENER_NOISE = 0.01
+N4_BINS = 100
+
+N4ITK_PATH = os.path.join(os.path.dirname(__file__), "bin", "N4BiasFieldCorrection")
+# options of the N4BiasFieldCorrection calls of correct_biasfield_n4itk, and
+# whether the product of the bias fields is normalized to its mean after the call
+N4ITK_CALLS = (
+    ("-s 1 -c [25,0] -b [112,1] -t [0.75,0.01,100]", False),
+    ("-s 1 -c [25,0] -b [112,2] -t [0.75,0.01,100]", False),
+    ("-s 1 -c [25,0] -b [112,3] -t [0.75,0.01,100]", True),
+    ("-s 1 -c [25,0] -b [1x1x14,3] -t [0.5,0.01,100]", True),
+    ("-s 1 -c [25,0] -b [1x14x1,3] -t [0.5,0.01,100]", True),
+    ("-s 1 -c [25,0] -b [14x1x1,3] -t [0.5,0.01,100]", True),
+    ("-s 2 -c [50,0] -b [4x4x4,3] -t [0.25,0.01,100]", True),
+)
+
 
 def calculate_flip_angle(
     image1: np.ndarray,
@@ -40,11 +113,11 @@ def calculate_flip_angle(
     """
     ratio = np.float_power(np.abs(image2 / image1), 2 / n_proj)
     # apply median filter
-    ratio = signal.medfilt(ratio, kernel_size=3)
+    ratio = filter_utils.median_filter(ratio, size=3)
     # set values above 1 to 1
     ratio[ratio > 1] = 1
     flip_angle_map = (180 / np.pi) * np.arccos(ratio) * np.exp(TR / T1)
-    return signal.medfilt(flip_angle_map, kernel_size=3)
+    return filter_utils.median_filter(flip_angle_map, size=3)
 
 
 def calculate_biasfield_rf(
@@ -86,131 +159,309 @@ def calculate_biasfield_rf(
     return image_biasfield, image_biasfield_smoothed
 
 
-def correct_biasfield_n4itk(image: np.ndarray, mask: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+def correct_biasfield_n4itk(
+    image: np.ndarray, mask: np.ndarray, tmp_dir: Optional[str] = None
+) -> Tuple[np.ndarray, np.ndarray]:
     """Apply N4ITK bias field correction with multiple iterations as in Matlab script.
 
     Args:
         image: np.ndarray 3D image to apply n4itk bias field correction.
         mask: np.ndarray 3D mask for n4itk bias field correction.
+        tmp_dir: directory for intermediate files. Defaults to a temporary
+            directory.
     """
-    current_path = os.path.dirname(__file__)
-    tmp_path = os.path.join(current_path, "tmp")
-    bin_path = os.path.join(current_path, "bin")
-
-    pathInput = os.path.join(tmp_path, "image.nii")
-    pathMask = os.path.join(tmp_path, "mask.nii")
-    pathOutput = os.path.join(tmp_path, "image_cor.nii")
-    pathBiasField = os.path.join(tmp_path, "biasfield.nii")
-
-    pathN4 = os.path.join(bin_path, "N4BiasFieldCorrection")
-    
-    # Save the input image and mask as NIfTI files
-    nii_image = nib.Nifti1Image(np.abs(image), np.eye(4))
-    nii_mask = nib.Nifti1Image(mask.astype(float), np.eye(4))
-    nib.save(nii_image, pathInput)
-    nib.save(nii_mask, pathMask)
-
-    # Initialize bias field stack and parameters
-    stack_bias_field = []
-    all_bias_field = np.ones(image.shape)
+    with workspace.scratch_dir(tmp_dir) as tmp_path:
+        pathInput = os.path.join(tmp_path, "image.nii")
+        pathMask = os.path.join(tmp_path, "mask.nii")
+        pathOutput = os.path.join(tmp_path, "image_cor.nii")
+        pathBiasField = os.path.join(tmp_path, "biasfield.nii")
+
+        pathN4 = N4ITK_PATH
+
+        # Save the input image and mask as NIfTI files
+        nii_image = nib.Nifti1Image(np.abs(image), np.eye(4))
+        nii_mask = nib.Nifti1Image(mask.astype(float), np.eye(4))
+        nib.save(nii_image, pathInput)
+        nib.save(nii_mask, pathMask)
+
+        # Initialize bias field stack and parameters
+        stack_bias_field = []
+        all_bias_field = np.ones(image.shape)
+
+        # Linear, binomial, trinomial, AP, RL, HF and complete corrections, each
+        # correcting the output of the previous one
+        pathCurrent = pathInput
+        for options, normalize in N4ITK_CALLS:
+            cmd = (
+                f'"{pathN4}" -d 3 -i "{pathCurrent}" -w "{pathMask}" {options} '
+                f'-o ["{pathOutput}","{pathBiasField}"]'
+            )
+            os.system(cmd)
+            bias_field = nib.load(pathBiasField).get_fdata()
+            stack_bias_field.append(bias_field)
+            all_bias_field *= bias_field
+            if normalize:
+                all_bias_field /= np.mean(all_bias_field)
+            pathCurrent = pathOutput
+
+        # Import Results
+        bias_corrected_image = nib.load(pathOutput).get_fdata()
+        stack_bias_field = np.stack(stack_bias_field, axis=-1)
+
+        # Optionally save the final corrected image and bias field
+        nib.save(nib.Nifti1Image(bias_corrected_image, np.eye(4)), os.path.join(tmp_path, "FinalCorrectedImage.nii"))
+        np.save(os.path.join(tmp_path, "FinalBiasField.npy"), all_bias_field)
+
+        # Clean up temporary files
+        os.remove(pathInput)
+        os.remove(pathMask)
+        os.remove(pathOutput)
+        os.remove(pathBiasField)
+
+        return bias_corrected_image.astype("float64"), all_bias_field.astype("float64")
+
+
+def sharpen_histogram(
+    values: np.ndarray,
+    fwhm: float = 0.15,
+    noise: float = 0.01,
+    n_bins: int = 200,
+) -> np.ndarray:
+    """Sharpen the histogram of log intensities as N4 does.
 
-    # Linear Correction
-    cmd = (
-        f'"{pathN4}" -d 3 -i "{pathInput}" -s 1 -w "{pathMask}" '
-        f'-c [25,0] -b [112,1] -t [0.75,0.01,100] '
-        f'-o ["{pathOutput}","{pathBiasField}"]'
-    )
-    os.system(cmd)
-    bias_field = nib.load(pathBiasField).get_fdata()
-    stack_bias_field.append(bias_field)
-    all_bias_field *= bias_field
-
-    # Binomial Correction
-    cmd = (
-        f'"{pathN4}" -d 3 -i "{pathOutput}" -s 1 -w "{pathMask}" '
-        f'-c [25,0] -b [112,2] -t [0.75,0.01,100] '
-        f'-o ["{pathOutput}","{pathBiasField}"]'
-    )
-    os.system(cmd)
-    bias_field = nib.load(pathBiasField).get_fdata()
-    stack_bias_field.append(bias_field)
-    all_bias_field *= bias_field
-
-    # Trinomial Correction
-    cmd = (
-        f'"{pathN4}" -d 3 -i "{pathOutput}" -s 1 -w "{pathMask}" '
-        f'-c [25,0] -b [112,3] -t [0.75,0.01,100] '
-        f'-o ["{pathOutput}","{pathBiasField}"]'
-    )
-    os.system(cmd)
-    bias_field = nib.load(pathBiasField).get_fdata()
-    stack_bias_field.append(bias_field)
-    all_bias_field *= bias_field
-    all_bias_field /= np.mean(all_bias_field)
-
-    # AP Correction
-    cmd = (
-        f'"{pathN4}" -d 3 -i "{pathOutput}" -s 1 -w "{pathMask}" '
-        f'-c [25,0] -b [1x1x14,3] -t [0.5,0.01,100] '
-        f'-o ["{pathOutput}","{pathBiasField}"]'
-    )
-    os.system(cmd)
-    bias_field = nib.load(pathBiasField).get_fdata()
-    stack_bias_field.append(bias_field)
-    all_bias_field *= bias_field
-    all_bias_field /= np.mean(all_bias_field)
-
-    # RL Correction
-    cmd = (
-        f'"{pathN4}" -d 3 -i "{pathOutput}" -s 1 -w "{pathMask}" '
-        f'-c [25,0] -b [1x14x1,3] -t [0.5,0.01,100] '
-        f'-o ["{pathOutput}","{pathBiasField}"]'
+    The histogram is deconvolved by a gaussian bias field with a Wiener filter, and
+    each value is mapped to its expected value given the sharpened histogram.
+
+    Args:
+        values: log intensities of the voxels in the mask
+        fwhm: full width at half maximum of the gaussian in log intensity
+        noise: noise of the Wiener filter
+        n_bins: number of bins of the histogram
+    Returns:
+        np.ndarray sharpened log intensities
+    """
+    low, high = np.min(values), np.max(values)
+    if high <= low:
+        return values
+    slope = (high - low) / (n_bins - 1)
+    # histogram with each value split linearly between its two nearest bins
+    position = (values - low) / slope
+    lower = np.minimum(position.astype(int), n_bins - 2)
+    weight = position - lower
+    histogram = np.bincount(lower, 1 - weight, n_bins) + np.bincount(
+        lower + 1, weight, n_bins
     )
-    os.system(cmd)
-    bias_field = nib.load(pathBiasField).get_fdata()
-    stack_bias_field.append(bias_field)
-    all_bias_field *= bias_field
-    all_bias_field /= np.mean(all_bias_field)
-
-    # HF Correction
-    cmd = (
-        f'"{pathN4}" -d 3 -i "{pathOutput}" -s 1 -w "{pathMask}" '
-        f'-c [25,0] -b [14x1x1,3] -t [0.5,0.01,100] '
-        f'-o ["{pathOutput}","{pathBiasField}"]'
+    # zero padded to a power of 2, the histogram being centered
+    size = 2 ** (int(np.ceil(np.log2(n_bins))) + 1)
+    offset = (size - n_bins) // 2
+    padded = np.zeros(size)
+    padded[offset : offset + n_bins] = histogram
+    # gaussian of the bias field, centered on the first bin with wrap around
+    scaled_fwhm = fwhm / slope
+    distance = np.minimum(np.arange(size), size - np.arange(size))
+    gaussian = (
+        2
+        * np.sqrt(np.log(2) / np.pi)
+        / scaled_fwhm
+        * np.exp(-4 * np.log(2) * distance**2 / scaled_fwhm**2)
     )
-    os.system(cmd)
-    bias_field = nib.load(pathBiasField).get_fdata()
-    stack_bias_field.append(bias_field)
-    all_bias_field *= bias_field
-    all_bias_field /= np.mean(all_bias_field)
-
-    # Complete Correction
-    cmd = (
-        f'"{pathN4}" -d 3 -i "{pathOutput}" -s 2 -w "{pathMask}" '
-        f'-c [50,0] -b [4x4x4,3] -t [0.25,0.01,100] '
-        f'-o ["{pathOutput}","{pathBiasField}"]'
+    gaussian_f = np.fft.fft(gaussian)
+    wiener_f = np.conj(gaussian_f) / (np.abs(gaussian_f) ** 2 + noise)
+    sharpened = np.maximum(np.real(np.fft.ifft(np.fft.fft(padded) * wiener_f)), 0)
+    # expected intensity of each bin given the sharpened histogram
+    centers = low + (np.arange(size) - offset) * slope
+    numerator = np.real(np.fft.ifft(np.fft.fft(centers * sharpened) * gaussian_f))
+    denominator = np.real(np.fft.ifft(np.fft.fft(sharpened) * gaussian_f))
+    expected = np.zeros(size)
+    nonzero = denominator != 0
+    expected[nonzero] = numerator[nonzero] / denominator[nonzero]
+    expected = expected[offset : offset + n_bins]
+    return expected[lower] * (1 - weight) + expected[lower + 1] * weight
+
+
+def _get_n4_mesh(
+    shape: Sequence[int], mesh: Any
+) -> Tuple[List[int], List[Tuple[float, float]]]:
+    """Get the B-spline mesh of N4 over an image.
+
+    As N4BiasFieldCorrection does, a mesh spacing is rounded up to a whole number
+    of spans, the domain being padded equally on both sides.
+
+    Args:
+        shape: shape of the image
+        mesh: spacing of the mesh in voxels, or number of spans along each axis
+    Returns:
+        Tuple of the number of spans and of the parametric domain along each axis
+    """
+    if np.isscalar(mesh):
+        n_spans = [max(int(np.ceil((size - 1) / mesh)), 1) for size in shape]
+        padding = [n * mesh - (size - 1) for n, size in zip(n_spans, shape)]
+        domains = [
+            (-pad / 2, size - 1 + pad / 2) for pad, size in zip(padding, shape)
+        ]
+        return n_spans, domains
+    return [int(n) for n in mesh], [(0.0, size - 1.0) for size in shape]
+
+
+def correct_n4(
+    image: np.ndarray,
+    mask: np.ndarray,
+    shrink: int = 1,
+    iterations: Sequence[int] = (50,),
+    mesh: Any = (1, 1, 1),
+    order: int = 3,
+    fwhm: float = 0.15,
+    noise: float = N4_WIENER_NOISE,
+    n_bins: int = N4_BINS,
+    convergence: float = 0.0,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Apply N4 bias field correction in memory.
+
+    Same algorithm as a N4BiasFieldCorrection call with the mask as weight image.
+    The log bias field is a B-spline fitted on the shrunk image. At each
+    iteration, the histogram of the log corrected image is sharpened, and the
+    B-spline fit of the difference is added to the log bias field. Each level
+    after the first doubles the number of spans of the mesh.
+
+    Args:
+        image: np.ndarray 3D image.
+        mask: np.ndarray 3D mask of the voxels used to estimate the bias field.
+        shrink: shrink factor of the image.
+        iterations: number of iterations of each level.
+        mesh: spacing of the B-spline mesh in voxels, or number of spans along
+            each axis at the first level.
+        order: order of the B-spline.
+        fwhm: full width at half maximum of the gaussian of the sharpening.
+        noise: noise of the Wiener filter of the sharpening.
+        n_bins: number of bins of the histogram of the sharpening.
+        convergence: the iterations of a level stop once the coefficient of
+            variation of the ratio of successive bias fields is below it.
+    Returns:
+        Tuple of the corrected image and the bias field.
+    """
+    image = np.abs(image)
+    n_spans, domains = _get_n4_mesh(image.shape, mesh)
+    sampling = tuple(slice((shrink - 1) // 2, None, shrink) for _ in image.shape)
+    coords = [np.arange(size)[sampling[0]] for size in image.shape]
+    image_shrunk = image[sampling]
+    weights = np.logical_and(mask[sampling] > 0, image_shrunk > 0).astype(float)
+    inside = weights > 0
+    log_image = np.zeros(image_shrunk.shape)
+    log_image[inside] = np.log(image_shrunk[inside])
+    log_biasfield = np.zeros(image_shrunk.shape)
+    lattice = np.zeros([n + order for n in n_spans])
+    for level, n_iterations in enumerate(iterations):
+        if level > 0:
+            lattice = bspline_utils.refine(lattice, n_spans, order)
+            n_spans = [2 * n for n in n_spans]
+        bases = bspline_utils.get_bases(coords, n_spans, order, domains)
+        for _ in range(n_iterations):
+            residual = log_image[inside] - log_biasfield[inside]
+            update = np.zeros(image_shrunk.shape)
+            update[inside] = residual - sharpen_histogram(
+                residual, fwhm, noise, n_bins
+            )
+            lattice += bspline_utils.fit(update, weights, bases)
+            previous = log_biasfield
+            log_biasfield = bspline_utils.evaluate(lattice, bases)
+            ratio = np.exp(log_biasfield[inside] - previous[inside])
+            if np.std(ratio) / np.mean(ratio) < convergence:
+                break
+    bases = bspline_utils.get_bases(
+        [np.arange(size) for size in image.shape], n_spans, order, domains
     )
-    os.system(cmd)
-    bias_field = nib.load(pathBiasField).get_fdata()
-    stack_bias_field.append(bias_field)
-    all_bias_field *= bias_field
-    all_bias_field /= np.mean(all_bias_field)
+    biasfield = np.exp(bspline_utils.evaluate(lattice, bases))
+    return image / biasfield, biasfield
 
-    # Import Results
-    bias_corrected_image = nib.load(pathOutput).get_fdata()
-    stack_bias_field = np.stack(stack_bias_field, axis=-1)
 
-    # Optionally save the final corrected image and bias field
-    nib.save(nib.Nifti1Image(bias_corrected_image, np.eye(4)), os.path.join(tmp_path, "FinalCorrectedImage.nii"))
-    np.save(os.path.join(tmp_path, "FinalBiasField.npy"), all_bias_field)
+def correct_biasfield_n4_native(
+    image: np.ndarray, mask: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Apply the N4 bias field correction of correct_biasfield_n4itk in memory.
 
-    # Clean up temporary files
-    os.remove(pathInput)
-    os.remove(pathMask)
-    os.remove(pathOutput)
-    os.remove(pathBiasField)
+    Runs the same stages as correct_biasfield_n4itk with correct_n4, without
+    executables or intermediate files.
 
-    return bias_corrected_image.astype("float64"), all_bias_field.astype("float64")
+    Args:
+        image: np.ndarray 3D image to apply n4itk bias field correction.
+        mask: np.ndarray 3D mask for n4itk bias field correction.
+    Returns:
+        Tuple of the corrected image and the bias field.
+    """
+    image_cor = np.abs(image).astype(float)
+    all_bias_field = np.ones(image.shape)
+    for stage in N4_STAGES:
+        image_cor, bias_field = correct_n4(
+            image_cor,
+            mask,
+            shrink=stage["shrink"],
+            iterations=stage["iterations"],
+            mesh=stage["mesh"],
+            order=stage["order"],
+            fwhm=stage["fwhm"],
+        )
+        all_bias_field *= bias_field
+        if stage.get("normalize"):
+            all_bias_field /= np.mean(all_bias_field)
+    logging.info("Native N4 bias field correction done.")
+    return image_cor.astype("float64"), all_bias_field.astype("float64")
+
+
+def correct_biasfield_n4(
+    image: np.ndarray,
+    mask: np.ndarray,
+    bias_key: str = constants.BiasfieldKey.N4ITK.value,
+    tmp_dir: Optional[str] = None,
+    cache_dir: Optional[str] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Apply N4 bias field correction, reusing a cached bias field if any.
+
+    The bias field is cached under a hash of the image, the mask and the exact
+    parameters of the correction, including the size and modification time of
+    the N4BiasFieldCorrection executable. The corrected image of a cached bias
+    field is the image divided by the bias field, up to the scale of the
+    correction, which is cached with it.
+
+    Args:
+        image: np.ndarray 3D image to apply n4itk bias field correction.
+        mask: np.ndarray 3D mask for n4itk bias field correction.
+        bias_key: str bias field key, n4itk or n4_native, see
+            constants.BiasfieldKey.
+        tmp_dir: directory for the intermediate files of N4ITK. Defaults to a
+            temporary directory.
+        cache_dir: cache directory, see cache_utils.get_cache_dir. Defaults to no
+            caching.
+    Returns:
+        Tuple of the corrected image and the bias field.
+    """
+    if bias_key == constants.BiasfieldKey.N4ITK.value:
+        parameters: Any = (N4ITK_CALLS, cache_utils.get_file_stats([N4ITK_PATH]))
+    elif bias_key == constants.BiasfieldKey.N4_NATIVE.value:
+        parameters = (N4_STAGES, N4_WIENER_NOISE, N4_BINS)
+    else:
+        raise ValueError("Invalid bias field key {}".format(bias_key))
+    image = np.abs(image).astype(float)
+    mask = mask.astype(bool)
+    key = cache_utils.get_hash("biasfield", bias_key, parameters, image, mask)
+    cached = cache_utils.load_arrays(cache_dir, key) if cache_dir else None
+    if cached is not None:
+        logging.info("Using the cached bias field {}.".format(key))
+        biasfield = cached["biasfield"]
+        return image / (biasfield * cached["scale"]), biasfield
+    if bias_key == constants.BiasfieldKey.N4ITK.value:
+        image_cor, biasfield = correct_biasfield_n4itk(image, mask, tmp_dir=tmp_dir)
+    else:
+        image_cor, biasfield = correct_biasfield_n4_native(image, mask)
+    if cache_dir:
+        cache_utils.save_arrays(
+            cache_dir,
+            key,
+            {
+                "biasfield": biasfield,
+                "scale": np.sum(image) / np.sum(image_cor * biasfield),
+            },
+        )
+    return image_cor, biasfield
 
 
 def correct_biasfield_rf(
@@ -232,6 +483,8 @@ def correct_biasfield_rf(
         n_proj (int): number of radial projections
         T1 (float): T1 value milli-seconds. Defaults to np.inf.
         TR (float): TR value in milli-seconds. Defaults to 4.5ms.
+    Returns:
+        Tuple of the corrected image and the smoothed bias field.
     """
     _, image_biasfield_smoothed = calculate_biasfield_rf(
         image1, image2, mask, n_proj, T1, TR
@@ -17,6 +17,8 @@ class Config(config_dict.ConfigDict):
     """Base config file.
 
     Attributes:
+        compress_nifti: bool, whether to gzip the exported nifti files
+        compute: Compute, the compute resources of the pipeline
         data_dir: str, path to the data directory
         hb_correction_key: str, hemoglobin correction key
         hb: float, subject hb value in g/dL
@@ -26,6 +28,7 @@ class Config(config_dict.ConfigDict):
         processes: Process, the evaluation processes
         rbc_m_ratio: float, the RBC to M ratio
         reference_data_key: str, reference data key
+        registration_engine: str, the registration engine of the registration key
         remove_contamination: bool, whether to remove gas contamination
         remove_noisy_projections: bool, whether to remove noisy projections
         segmentation_key: str, the segmentation key
@@ -35,6 +38,8 @@ class Config(config_dict.ConfigDict):
     def __init__(self):
         """Initialize config parameters."""
         super().__init__()
+        self.compress_nifti = False
+        self.compute = Compute()
         self.data_dir = ""
         self.manual_seg_filepath = ""
         self.manual_reg_filepath = ""
@@ -44,6 +49,7 @@ class Config(config_dict.ConfigDict):
         self.reference_data_key = constants.ReferenceDataKey.DUKE_REFERENCE.value
         self.segmentation_key = constants.SegmentationKey.CNN_VENT.value
         self.registration_key = constants.RegistrationKey.SKIP.value
+        self.registration_engine = constants.RegistrationEngine.ANTS.value
         self.bias_key = constants.BiasfieldKey.N4ITK.value
         self.hb_correction_key = constants.HbCorrectionKey.NONE.value
         self.hb = 0.0
@@ -52,6 +58,30 @@ class Config(config_dict.ConfigDict):
         self.multi_echo = False;
 
 
+class Compute(object):
+    """Define the compute resources of the pipeline.
+
+    Attributes:
+        threads: int, threads of the numerical libraries, the CNN and the ANTs
+            executables, 0 to keep their defaults. The batch runner caps it to the
+            threads of each worker.
+        memory_budget_gb: float, memory reserved for the subject in GB when
+            processed in a batch, 0 to use the peak memory estimate
+        precision: str, floating point precision of the CNN inference
+        cache_dir: str, directory of the stage checkpoints, empty for a stages
+            folder in the data directory
+        scratch_dir: str, directory of the per-subject workspaces, e.g. on tmpfs
+    """
+
+    def __init__(self):
+        """Initialize the compute parameters."""
+        self.threads = 0
+        self.memory_budget_gb = 0.0
+        self.precision = constants.Precision.FLOAT32.value
+        self.cache_dir = ""
+        self.scratch_dir = "tmp"
+
+
 class Process(object):
     """Define the evaluation processes.
 
@@ -1,13 +1,16 @@
 """Scripts to run gas exchange mapping pipeline."""
 
 import logging
+from concurrent.futures import Future
+from typing import List
 
-import numpy as np
 from absl import app, flags
 from ml_collections import config_flags
 
+import pipeline
 from config import base_config
 from subject_classmap import Subject
+from utils import compute_utils, io_utils
 
 FLAGS = flags.FLAGS # using absl
 
@@ -24,6 +27,12 @@ Presumably these flags are specified with their values in the command line
 flags.DEFINE_boolean("force_recon", False, "force reconstruction for the subject")
 flags.DEFINE_boolean("force_readin", False, "force read in .mat for the subject")
 flags.DEFINE_boolean("force_segmentation", False, "run segmentation again.")
+flags.DEFINE_boolean(
+    "resume",
+    True,
+    "restore stages whose inputs are unchanged from checkpoints. Ignored with "
+    "--force_recon, which runs all stages again.",
+)
 
 """
 Haad: 
@@ -31,78 +40,65 @@ Haad:
 - It specifies which attributes should be set (e.g. subject_id, rbc_m_ratio, etc...)
 
 """
-def gx_mapping_reconstruction(config: base_config.Config):
+def _save_outputs(subject: Subject, resume: bool):
+    """Run the report stages and save the output files of a subject.
+
+    The files are written in the background during the report stages. All the
+    writers finish before returning, even on errors, since the workspace they
+    write to is removed afterwards.
+
+    Args:
+        subject: subject instance
+        resume: whether to restore unchanged stages from checkpoints
+    """
+    exports: List[Future] = []
+    try:
+        exports += subject.save_files()
+        exports += subject.save_subject_to_mat()
+        pipeline.run_stages(subject, pipeline.REPORT_STAGES, resume=resume)
+        subject.write_stats_to_csv()
+        subject.save_config_as_json()
+    finally:
+        io_utils.wait_for_exports(exports)
+    subject.move_output_files()
+
+
+def gx_mapping_reconstruction(config: base_config.Config, resume: bool = True):
     """Run the gas exchange mapping pipeline with reconstruction.
 
     Args:
         config (config_dict.ConfigDict): config dict
+        resume (bool): whether to restore unchanged stages from checkpoints
     """
+    compute_utils.apply_compute(config.compute)
     subject = Subject(config=config) # Haad: Make a subject out of the configuration file
-    try:
-        subject.read_twix_files()
-    except:
-        logging.warning("Cannot read in twix files.")
-        try:
-            subject.read_mrd_files()
-        except:
-            raise ValueError("Cannot read in raw data files.")
-    subject.calculate_rbc_m_ratio() # Haad: This will only do a calculation if RBC:M ratio is not already set
-    logging.info("Reconstructing images")
-    subject.preprocess()
-    subject.reconstruction_gas()
-    subject.reconstruction_dissolved()
-    if config.recon.recon_proton:
-        subject.reconstruction_ute()
-    elif config.dicom_proton_dir:
-        subject.read_dicom_files()
-    else:
-        subject.image_proton = np.zeros_like(subject.image_gas_highreso)
-        
-    # Haad: The order of function execution below should be fixed
-    subject.segmentation()
-    subject.registration()
-    subject.biasfield_correction()
-    subject.gas_binning()
-    subject.dixon_decomposition()
-    subject.hb_correction()
-    subject.dissolved_analysis()
-    subject.dissolved_binning()
-    subject.get_statistics()
-    subject.get_info()
-    subject.save_subject_to_mat()
-    subject.write_stats_to_csv()
-    subject.generate_figures()
-    subject.generate_pdf()
-    subject.save_files()
-    subject.save_config_as_json()
-    subject.move_output_files()
+    with subject.workspace:
+        logging.info("Reconstructing images")
+        # Haad: The order of the stages should be fixed
+        pipeline.run_stages(subject, pipeline.RECON_STAGES, resume=resume)
+        _save_outputs(subject, resume)
     logging.info("Complete")
 
 
-def gx_mapping_readin(config: base_config.Config):
+def gx_mapping_readin(
+    config: base_config.Config, force_segmentation: bool = False, resume: bool = True
+):
     """Run the gas exchange imaging pipeline by reading in .mat file.
 
     Args:
         config (config_dict.ConfigDict): config dict
+        force_segmentation (bool): whether to run segmentation again
+        resume (bool): whether to restore unchanged stages from checkpoints
     """
+    compute_utils.apply_compute(config.compute)
     subject = Subject(config=config)
-    subject.read_mat_file()
-    if FLAGS.force_segmentation:
-        subject.segmentation()
-    subject.gas_binning()
-    subject.dixon_decomposition()
-    subject.hb_correction()
-    subject.dissolved_analysis()
-    subject.dissolved_binning()
-    subject.get_statistics()
-    subject.get_info()
-    subject.save_subject_to_mat()
-    subject.write_stats_to_csv()
-    subject.generate_figures()
-    subject.generate_pdf()
-    subject.save_files()
-    subject.save_config_as_json()
-    subject.move_output_files()
+    with subject.workspace:
+        pipeline.run_stages(
+            subject,
+            pipeline.get_readin_stages(force_segmentation),
+            resume=resume,
+        )
+        _save_outputs(subject, resume)
     logging.info("Complete")
 
 
@@ -114,16 +110,17 @@ def main(argv):
     config = _CONFIG.value
     if FLAGS.force_recon:
         logging.info("Gas exchange imaging mapping with reconstruction.")
-        gx_mapping_reconstruction(config)
+        gx_mapping_reconstruction(config, resume=False)
     elif FLAGS.force_readin:
         logging.info("Gas exchange imaging mapping with reconstruction.")
-        gx_mapping_readin(config)
+        gx_mapping_readin(config, FLAGS.force_segmentation, resume=FLAGS.resume)
     elif config.processes.gx_mapping_recon:
         logging.info("Gas exchange imaging mapping with reconstruction.")
-        gx_mapping_reconstruction(config)
+        gx_mapping_reconstruction(config, resume=FLAGS.resume)
     elif config.processes.gx_mapping_readin:
         logging.info("Gas exchange imaging mapping with reconstruction.")
-        gx_mapping_readin(config) # Haad: Only do this if using a .mat file
+        # Haad: Only do this if using a .mat file
+        gx_mapping_readin(config, FLAGS.force_segmentation, resume=FLAGS.resume)
     else:
         pass
 
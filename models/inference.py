@@ -0,0 +1,225 @@
+"""Inference engine of the segmentation model.
+
+The Keras model runs its batch normalization layers as separate operations on
+the full resolution feature maps. At inference these are affine maps with fixed
+statistics, which are folded into the weights of the preceding convolutions.
+The folded model is then traced once into a graph compiled with XLA, so that
+every prediction runs the fused graph.
+
+The model can also be converted to TensorFlow Lite with post-training float16
+or int8 quantization, and run by the TensorFlow Lite interpreter, whose CPU
+kernels are delegated to XNNPACK.
+"""
+import logging
+import sys
+import threading
+from typing import Iterable, Optional, Tuple
+
+import numpy as np
+import tensorflow as tf
+
+sys.path.append("..")
+from models import model_vnet
+from utils import constants
+
+
+def fold_batch_norm(model: tf.keras.Model, folded_model: tf.keras.Model):
+    """Fold the batch normalization layers of a model into its convolutions.
+
+    Every batch normalization layer of the VNet directly follows a convolution
+    and is replaced by an identity layer of the same name in the folded model.
+    The convolution weights become:
+
+        kernel' = kernel * gamma / sqrt(variance + epsilon)
+        bias' = (bias - mean) * gamma / sqrt(variance + epsilon) + beta
+
+    Args:
+        model: model with its weights loaded
+        folded_model: same model built with fold_batch_norm=True, whose weights
+            are set
+    """
+    for layer in model.layers:
+        if layer.weights and not isinstance(
+            layer, tf.keras.layers.BatchNormalization
+        ):
+            folded_model.get_layer(layer.name).set_weights(layer.get_weights())
+    for entry in model.get_config()["layers"]:
+        if entry["class_name"] != "BatchNormalization":
+            continue
+        batch_norm = model.get_layer(entry["name"])
+        conv = model.get_layer(entry["inbound_nodes"][0][0][0])
+        gamma, beta, mean, variance = batch_norm.get_weights()
+        scale = gamma / np.sqrt(variance + batch_norm.epsilon)
+        kernel, bias = conv.get_weights()
+        # the output channels are the last kernel axis of a convolution and the
+        # second to last of a transposed convolution
+        shape = [1] * kernel.ndim
+        if isinstance(conv, tf.keras.layers.Conv3DTranspose):
+            shape[-2] = -1
+        else:
+            shape[-1] = -1
+        folded_model.get_layer(conv.name).set_weights(
+            [kernel * np.reshape(scale, shape), (bias - mean) * scale + beta]
+        )
+
+
+class InferenceEngine(object):
+    """Compiled inference of a Keras model.
+
+    Attributes:
+        model (tf.keras.Model): model
+        input_shape (tuple): shape of an input batch of a single image
+        jit_compile (bool): whether the graph is compiled with XLA
+    """
+
+    def __init__(self, model: tf.keras.Model, jit_compile: bool = True):
+        """Init object.
+
+        The graph is traced and compiled by a first prediction on zeros. If XLA
+        cannot compile it, the graph runs without XLA. The batch axis of the graph
+        is not fixed, XLA compiles it again for each new batch size.
+
+        Args:
+            model: model
+            jit_compile: whether to compile the graph with XLA
+        """
+        self.model = model
+        self.input_shape = (1,) + tuple(model.input_shape[1:])
+        self.jit_compile = jit_compile
+        self._function = self._trace(jit_compile)
+        try:
+            self._function(tf.zeros(self.input_shape))
+        except (tf.errors.OpError, ValueError) as e:
+            if not jit_compile:
+                raise
+            logging.warning("Cannot compile with XLA, running without: {}".format(e))
+            self.jit_compile = False
+            self._function = self._trace(False)
+
+    def _trace(self, jit_compile: bool):
+        """Get the graph function of the model.
+
+        Args:
+            jit_compile: whether to compile the graph with XLA
+        Returns:
+            tf.function of the model in inference mode
+        """
+        return tf.function(
+            lambda image: self.model(image, training=False),
+            input_signature=[
+                tf.TensorSpec((None,) + self.input_shape[1:], tf.float32)
+            ],
+            jit_compile=jit_compile,
+        )
+
+    def predict(self, image: np.ndarray) -> np.ndarray:
+        """Run the model on a batch of images.
+
+        Args:
+            image: np.ndarray batch of images of shape input_shape[1:]
+        Returns:
+            np.ndarray float32 output of the model
+        """
+        output = self._function(tf.convert_to_tensor(image, dtype=tf.float32))
+        return output.numpy().astype(np.float32)
+
+
+def load_engine(
+    weights_path: str,
+    input_size: Tuple[int, ...] = (128, 128, 128, 1),
+    precision: str = "float32",
+    jit_compile: bool = True,
+) -> InferenceEngine:
+    """Build the VNet with its batch normalization folded and compile it.
+
+    Args:
+        weights_path: path of the weights of the model
+        input_size: shape of an input image with its channel axis
+        precision: str of the Keras dtype policy, float32 or mixed_float16
+        jit_compile: whether to compile the graph with XLA
+    Returns:
+        inference engine of the model
+    """
+    tf.keras.mixed_precision.set_global_policy(precision)
+    model = model_vnet.vnet(input_size=input_size)
+    model.load_weights(weights_path)
+    folded_model = model_vnet.vnet(input_size=input_size, fold_batch_norm=True)
+    fold_batch_norm(model, folded_model)
+    return InferenceEngine(folded_model, jit_compile)
+
+
+def convert_to_tflite(
+    model: tf.keras.Model,
+    quantization: str,
+    calibration_images: Iterable[np.ndarray] = (),
+) -> bytes:
+    """Convert a model to TensorFlow Lite with post-training quantization.
+
+    With int8 quantization, the activation ranges are calibrated on the
+    calibration images, and operations without an int8 kernel are kept in float.
+
+    Args:
+        model: model with its weights loaded
+        quantization: str quantization, see constants.Quantization
+        calibration_images: input batches of the model, required for int8
+    Returns:
+        bytes of the TensorFlow Lite model
+    """
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if quantization == constants.Quantization.FLOAT16.value:
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantization == constants.Quantization.INT8.value:
+        calibration_images = list(calibration_images)
+        if not calibration_images:
+            raise ValueError("int8 quantization requires calibration images")
+        converter.representative_dataset = lambda: (
+            [image.astype(np.float32)] for image in calibration_images
+        )
+    else:
+        raise ValueError("Invalid quantization {}".format(quantization))
+    return converter.convert()
+
+
+class TFLiteEngine(object):
+    """Inference of a TensorFlow Lite model.
+
+    The interpreter is not thread safe, predictions are serialized.
+
+    Attributes:
+        model_path (str): path of the TensorFlow Lite model
+        input_shape (tuple): shape of the input batch
+    """
+
+    def __init__(self, model_path: str, num_threads: Optional[int] = None):
+        """Init object.
+
+        Args:
+            model_path: path of the TensorFlow Lite model
+            num_threads: threads of the interpreter, None for its default
+        """
+        self.model_path = model_path
+        self._interpreter = tf.lite.Interpreter(
+            model_path=model_path, num_threads=num_threads
+        )
+        self._interpreter.allocate_tensors()
+        self._input = self._interpreter.get_input_details()[0]
+        self._output = self._interpreter.get_output_details()[0]
+        self.input_shape = tuple(self._input["shape"])
+        self._lock = threading.Lock()
+
+    def predict(self, image: np.ndarray) -> np.ndarray:
+        """Run the model on an image.
+
+        Args:
+            image: np.ndarray batch of a single image of shape input_shape
+        Returns:
+            np.ndarray float32 output of the model
+        """
+        with self._lock:
+            self._interpreter.set_tensor(
+                self._input["index"], np.asarray(image, dtype=np.float32)
+            )
+            self._interpreter.invoke()
+            output = self._interpreter.get_tensor(self._output["index"])
+        return output.astype(np.float32)
@@ -5,19 +5,20 @@ V-Net implementation in Keras 2
 https://arxiv.org/pdf/1606.04797.pdf
 """
 import tensorflow as tf
-
-tf.compat.v1.disable_v2_behavior()
-
 from tensorflow.keras.models import Model
 from tensorflow.keras.optimizers import Adam
 
 
-def BatchNormalization(name: str) -> tf.keras.layers.Layer:
+def BatchNormalization(name: str, folded: bool = False) -> tf.keras.layers.Layer:
     """Batch normalization with fused parameter false.
 
     Args:
         name: str name of the layer.
+        folded: bool whether the batch normalization is folded into the preceding
+            convolution, in which case an identity layer of the same name is used.
     """
+    if folded:
+        return tf.keras.layers.Activation("linear", name=name)
     return tf.keras.layers.BatchNormalization(name=name, fused=False)
 
 
@@ -43,7 +44,9 @@ def Deconvolution3D(inputs, filters, kernel_size, subsample, name):
     return x
 
 
-def downward_layer(input_layer, n_convolutions, n_output_channels, number):
+def downward_layer(
+    input_layer, n_convolutions, n_output_channels, number, folded=False
+):
     inl = input_layer
 
     for nnn in range(n_convolutions):
@@ -54,7 +57,9 @@ def downward_layer(input_layer, n_convolutions, n_output_channels, number):
             kernel_initializer="he_normal",
             name="conv_" + str(number) + "_" + str(nnn),
         )(inl)
-        inl = BatchNormalization(name="batch_" + str(number) + "_" + str(nnn))(inl)
+        inl = BatchNormalization(
+            name="batch_" + str(number) + "_" + str(nnn), folded=folded
+        )(inl)
         inl = tf.keras.layers.ReLU(name="relu_" + str(number) + "_" + str(nnn))(inl)
 
     add_l = tf.math.add(inl, input_layer)
@@ -66,16 +71,18 @@ def downward_layer(input_layer, n_convolutions, n_output_channels, number):
         kernel_initializer="he_normal",
         name="conv_" + str(number) + "_" + str(nnn + 1),
     )(add_l)
-    downsample = BatchNormalization(name="batch_" + str(number) + "_" + str(nnn + 1))(
-        downsample
-    )
+    downsample = BatchNormalization(
+        name="batch_" + str(number) + "_" + str(nnn + 1), folded=folded
+    )(downsample)
     downsample = tf.keras.layers.ReLU(name="relu_" + str(number) + "_" + str(nnn + 1))(
         downsample
     )
     return downsample, add_l
 
 
-def upward_layer(input0, input1, n_convolutions, n_output_channels, number):
+def upward_layer(
+    input0, input1, n_convolutions, n_output_channels, number, folded=False
+):
     merged = tf.concat([input0, input1], axis=4)
     inl = merged
     for nnn in range(n_convolutions):
@@ -87,7 +94,9 @@ def upward_layer(input0, input1, n_convolutions, n_output_channels, number):
             kernel_initializer="he_normal",
             name="conv_" + str(number) + "_" + str(nnn),
         )(inl)
-        inl = BatchNormalization(name="batch_" + str(number) + "_" + str(nnn))(inl)
+        inl = BatchNormalization(
+            name="batch_" + str(number) + "_" + str(nnn), folded=folded
+        )(inl)
         inl = tf.keras.layers.ReLU(name="relu_" + str(number) + "_" + str(nnn))(inl)
 
     add_l = tf.math.add(inl, merged)
@@ -100,9 +109,9 @@ def upward_layer(input0, input1, n_convolutions, n_output_channels, number):
         subsample=(2, 2, 2),
         name="dconv_" + str(number) + "_" + str(nnn + 1),
     )
-    upsample = BatchNormalization(name="batch_" + str(number) + "_" + str(nnn + 1))(
-        upsample
-    )
+    upsample = BatchNormalization(
+        name="batch_" + str(number) + "_" + str(nnn + 1), folded=folded
+    )(upsample)
     return tf.keras.layers.ReLU(name="relu_" + str(number) + "_" + str(nnn + 1))(
         upsample
     )
@@ -233,6 +242,7 @@ def vnet(
     optimizer=Adam(lr=1e-4),
     loss="binary_crossentropy",
     metrics=["accuracy"],
+    fold_batch_norm=False,
 ):
     # loss='categorical_crossentropy', metrics=['categorical_accuracy']):
     # Layer 1
@@ -246,7 +256,7 @@ def vnet(
         kernel_initializer="he_normal",
         name="conv_1",
     )(input_gas)
-    conv1 = BatchNormalization(name="batch_1")(conv1)
+    conv1 = BatchNormalization(name="batch_1", folded=fold_batch_norm)(conv1)
     conv1 = tf.keras.layers.ReLU(name="relu_1")(conv1)
     repeat1 = tf.concat(16 * [input_gas], axis=-1)
     add1 = tf.math.add(conv1, repeat1)
@@ -258,13 +268,13 @@ def vnet(
         kernel_initializer="he_normal",
         name="down_1",
     )(add1)
-    down1 = BatchNormalization(name="batch_1_2")(down1)
+    down1 = BatchNormalization(name="batch_1_2", folded=fold_batch_norm)(down1)
     down1 = tf.keras.layers.ReLU(name="relu_1_2")(down1)
 
     # Layer 2,3,4
-    down2, add2 = downward_layer(down1, 2, 64, 2)
-    down3, add3 = downward_layer(down2, 3, 128, 3)
-    down4, add4 = downward_layer(down3, 3, 256, 4)
+    down2, add2 = downward_layer(down1, 2, 64, 2, folded=fold_batch_norm)
+    down3, add3 = downward_layer(down2, 3, 128, 3, folded=fold_batch_norm)
+    down4, add4 = downward_layer(down3, 3, 256, 4, folded=fold_batch_norm)
 
     # Layer 5
     conv_5_1 = tf.keras.layers.Conv3D(
@@ -274,7 +284,7 @@ def vnet(
         kernel_initializer="he_normal",
         name="conv_5_1",
     )(down4)
-    conv_5_1 = BatchNormalization(name="batch_5_1")(conv_5_1)
+    conv_5_1 = BatchNormalization(name="batch_5_1", folded=fold_batch_norm)(conv_5_1)
     conv_5_1 = tf.keras.layers.ReLU(name="relu_5_1")(conv_5_1)
     conv_5_2 = tf.keras.layers.Conv3D(
         256,
@@ -283,7 +293,7 @@ def vnet(
         kernel_initializer="he_normal",
         name="conv_5_2",
     )(conv_5_1)
-    conv_5_2 = BatchNormalization(name="batch_5_2")(conv_5_2)
+    conv_5_2 = BatchNormalization(name="batch_5_2", folded=fold_batch_norm)(conv_5_2)
     conv_5_2 = tf.keras.layers.ReLU(name="relu_5_2")(conv_5_2)
     conv_5_3 = tf.keras.layers.Conv3D(
         256,
@@ -292,7 +302,7 @@ def vnet(
         kernel_initializer="he_normal",
         name="conv_5_3",
     )(conv_5_2)
-    conv_5_3 = BatchNormalization(name="batch_5_3")(conv_5_3)
+    conv_5_3 = BatchNormalization(name="batch_5_3", folded=fold_batch_norm)(conv_5_3)
     conv_5_3 = tf.keras.layers.ReLU(name="relu_5_3")(conv_5_3)
     add5 = tf.math.add(conv_5_3, down4)
 
@@ -301,13 +311,15 @@ def vnet(
         add5, 128, (2, 2, 2), subsample=(2, 2, 2), name="dconv_5"
     )
 
-    upsample_5 = BatchNormalization(name="batch_5_4")(upsample_5)
+    upsample_5 = BatchNormalization(name="batch_5_4", folded=fold_batch_norm)(
+        upsample_5
+    )
     upsample_5 = tf.keras.layers.ReLU(name="relu_5_4")(upsample_5)
 
     # Layer 6,7,8
-    upsample_6 = upward_layer(upsample_5, add4, 3, 64, 6)
-    upsample_7 = upward_layer(upsample_6, add3, 3, 32, 7)
-    upsample_8 = upward_layer(upsample_7, add2, 2, 16, 8)
+    upsample_6 = upward_layer(upsample_5, add4, 3, 64, 6, folded=fold_batch_norm)
+    upsample_7 = upward_layer(upsample_6, add3, 3, 32, 7, folded=fold_batch_norm)
+    upsample_8 = upward_layer(upsample_7, add2, 2, 16, 8, folded=fold_batch_norm)
 
     # Layer 9
     merged_9 = tf.concat([upsample_8, add1], axis=4)
@@ -318,7 +330,7 @@ def vnet(
         kernel_initializer="he_normal",
         name="conv_9_1",
     )(merged_9)
-    conv_9_1 = BatchNormalization(name="batch_9_1")(conv_9_1)
+    conv_9_1 = BatchNormalization(name="batch_9_1", folded=fold_batch_norm)(conv_9_1)
     conv_9_1 = tf.keras.layers.ReLU(name="relu_9_1")(conv_9_1)
     add_9 = tf.math.add(conv_9_1, merged_9)
     # conv_9_2 = tf.keras.layers.Conv3D(1, kernel_size=(1, 1, 1), padding='same', kernel_initializer='he_normal')(add_9)
@@ -329,7 +341,7 @@ def vnet(
         kernel_initializer="he_normal",
         name="conv_9_2",
     )(add_9)
-    conv_9_2 = BatchNormalization(name="batch_9_2")(conv_9_2)
+    conv_9_2 = BatchNormalization(name="batch_9_2", folded=fold_batch_norm)(conv_9_2)
     conv_9_2 = tf.keras.layers.ReLU(name="relu_9_2")(conv_9_2)
 
     # softmax = Softmax()(conv_9_2)
@@ -340,7 +352,9 @@ def vnet(
         kernel_initializer="he_normal",
         name="conv_sigm_1",
     )(conv_9_2)
-    sigmoid_v = BatchNormalization(name="batch_sigm_1")(sigmoid_v)
+    sigmoid_v = BatchNormalization(name="batch_sigm_1", folded=fold_batch_norm)(
+        sigmoid_v
+    )
     sigmoid_v = tf.keras.layers.Activation(activation="sigmoid")(sigmoid_v)
 
     model = Model(inputs=input_gas, outputs=sigmoid_v)
@@ -0,0 +1,648 @@
+"""Resumable stages of the gas exchange imaging pipeline.
+
+Each stage declares the subject instance variables it reads and writes, the
+config fields that affect it and the files it reads and writes. The outputs of
+every stage are checkpointed under a key computed from the content of its
+inputs and the source code of the pipeline, so that rerunning the pipeline only
+recomputes the stages downstream of what changed.
+
+The declared inputs and outputs also define the dependency graph of the stages:
+a stage waits for the earlier stages that write what it reads or writes, and
+for those that read what it writes. Independent stages, such as the gas and
+dissolved-phase reconstructions or the spectroscopy fit, run concurrently in a
+thread pool. The numerical kernels release the GIL (numpy, numba nogil
+functions, TensorFlow and ANTs), so the stages overlap.
+"""
+
+import glob
+import logging
+import os
+import shutil
+import tempfile
+from concurrent import futures
+from typing import Any, Callable, Dict, List, Optional, Sequence, Set
+
+import segmentation
+from subject_classmap import Subject
+from utils import cache_utils, compute_utils, constants, io_utils
+
+CHECKPOINT_FILE = "checkpoint.mat"
+STAGE_WORKERS = 4
+# folders of the project modules hashed in the stage keys, see get_source_hash
+SOURCE_DIRS = (".", "recon", "spect", "utils", "models")
+
+
+class Stage(object):
+    """Step of the pipeline whose results can be checkpointed.
+
+    Attributes:
+        name (str): name of the stage
+        methods (tuple): names of the subject methods run by the stage, in order
+        inputs (tuple): names of the subject instance variables read by the stage
+        outputs (tuple): names of the subject instance variables written by the stage
+        config_fields (tuple): dotted names of the config fields read by the stage
+        input_files (callable): function of the subject returning the paths of the
+            files read by the stage
+        output_files (callable): function of the subject returning the paths of the
+            files written by the stage
+    """
+
+    def __init__(
+        self,
+        name: str,
+        methods: Sequence[str],
+        inputs: Sequence[str] = (),
+        outputs: Sequence[str] = (),
+        config_fields: Sequence[str] = (),
+        input_files: Optional[Callable[[Subject], List[str]]] = None,
+        output_files: Optional[Callable[[Subject], List[str]]] = None,
+    ):
+        """Init object."""
+        self.name = name
+        self.methods = tuple(methods)
+        self.inputs = tuple(inputs)
+        self.outputs = tuple(outputs)
+        self.config_fields = tuple(config_fields)
+        self.input_files = input_files
+        self.output_files = output_files
+
+    def run(self, subject: Subject):
+        """Run the stage on the subject.
+
+        Args:
+            subject: subject instance
+        """
+        for method in self.methods:
+            getattr(subject, method)()
+
+    def get_key(self, subject: Subject) -> str:
+        """Get the checkpoint key of the stage.
+
+        The key changes whenever the inputs, the config fields, the input files,
+        the source code of the project modules, see get_source_hash, or the
+        pipeline version change.
+
+        Args:
+            subject: subject instance
+        Returns:
+            str hex digest
+        """
+        return cache_utils.get_hash(
+            self.name,
+            constants.PipelineVersion.VERSION_NUMBER,
+            get_source_hash(),
+            {name: getattr(subject, name, None) for name in self.inputs},
+            {
+                field: _get_config_field(subject.config, field)
+                for field in self.config_fields
+            },
+            cache_utils.get_file_stats(
+                self.input_files(subject) if self.input_files else []
+            ),
+        )
+
+    def get_output_files(self, subject: Subject) -> List[str]:
+        """Get the paths of the files written by the stage.
+
+        Args:
+            subject: subject instance
+        Returns:
+            list of file paths
+        """
+        return self.output_files(subject) if self.output_files else []
+
+    def get_reads(self, subject: Subject) -> Set[str]:
+        """Get the instance variables and files read by the stage.
+
+        Args:
+            subject: subject instance
+        Returns:
+            set of instance variable names and file paths
+        """
+        files = self.input_files(subject) if self.input_files else []
+        return set(self.inputs) | set(os.path.abspath(file) for file in files)
+
+    def get_writes(self, subject: Subject) -> Set[str]:
+        """Get the instance variables and files written by the stage.
+
+        Args:
+            subject: subject instance
+        Returns:
+            set of instance variable names and file paths
+        """
+        files = self.get_output_files(subject)
+        return set(self.outputs) | set(os.path.abspath(file) for file in files)
+
+
+def get_source_hash() -> str:
+    """Get a hash of the source code of the project modules.
+
+    Covers the modules run by the stages: the top-level modules except the
+    scripts, and the recon, spect, utils and models packages. The config files
+    are not included, the stages hash the config fields they read instead.
+
+    Returns:
+        str hex digest
+    """
+    root = os.path.dirname(os.path.abspath(__file__))
+    paths = [
+        path
+        for folder in SOURCE_DIRS
+        for path in sorted(glob.glob(os.path.join(root, folder, "*.py")))
+        if not os.path.basename(path).startswith("script_")
+    ]
+    return cache_utils.get_hash(
+        [
+            (os.path.relpath(path, root), cache_utils.get_file_hash(path))
+            for path in paths
+        ]
+    )
+
+
+def _get_config_field(config: Any, field: str) -> Any:
+    """Get a config field by its dotted name.
+
+    Args:
+        config: config dict
+        field: dotted name of the field, e.g. "recon.recon_size"
+    Returns:
+        value of the field
+    """
+    value = config
+    for name in field.split("."):
+        value = getattr(value, name)
+    return value
+
+
+def _get_raw_files(subject: Subject) -> List[str]:
+    """Get the paths of the raw data files."""
+    data_dir = str(subject.config.data_dir)
+    return glob.glob(os.path.join(data_dir, "*.dat")) + glob.glob(
+        os.path.join(data_dir, "*.h5")
+    )
+
+
+def _get_mat_files(subject: Subject) -> List[str]:
+    """Get the path of the mat file."""
+    return glob.glob(os.path.join(str(subject.config.data_dir), "*.mat"))
+
+
+def _get_proton_files(subject: Subject) -> List[str]:
+    """Get the paths of the proton DICOM files."""
+    if subject.config.recon.recon_proton or not subject.config.dicom_proton_dir:
+        return []
+    return glob.glob(os.path.join(str(subject.config.dicom_proton_dir), "*"))
+
+
+def _get_segmentation_files(subject: Subject) -> List[str]:
+    """Get the paths of the manual segmentation file and the quantized model."""
+    files = glob.glob(str(subject.config.manual_seg_filepath))
+    if (
+        subject.config.segmentation_key
+        == constants.SegmentationKey.CNN_VENT_QUANTIZED.value
+    ):
+        files += glob.glob(segmentation.VENT_QUANTIZED_PATH)
+    return files
+
+
+def _get_manual_reg_files(subject: Subject) -> List[str]:
+    """Get the path of the manual registration file."""
+    return glob.glob(str(subject.config.manual_reg_filepath))
+
+
+def _get_figure_files(subject: Subject) -> List[str]:
+    """Get the paths of the figures."""
+    return [subject.workspace.path(figure) for figure in FIGURE_FILES]
+
+
+def _get_report_files(subject: Subject) -> List[str]:
+    """Get the path of the report."""
+    return [
+        subject.workspace.path("{}_report.pdf".format(subject.config.subject_id))
+    ]
+
+
+FIGURE_FILES = (
+    "montage_vent.png",
+    "montage_membrane.png",
+    "montage_rbc.png",
+    "montage_gas_binned.png",
+    "montage_rbc_binned.png",
+    "montage_membrane_binned.png",
+    "montage_proton_qa.png",
+    "montage_vent_qa.png",
+    "montage_dissolved_qa.png",
+    "hist_vent.png",
+    "hist_rbc.png",
+    "hist_membrane.png",
+)
+
+READ = Stage(
+    name="read",
+    methods=("read_raw_files",),
+    outputs=("dict_dis", "dict_dyn", "dict_ute"),
+    config_fields=("data_dir", "multi_echo", "recon.recon_proton"),
+    input_files=_get_raw_files,
+)
+READ_MAT = Stage(
+    name="read_mat",
+    methods=("read_mat_file",),
+    outputs=(
+        "dict_dis",
+        "dict_dyn",
+        "dict_ute",
+        "data_dissolved",
+        "data_gas",
+        "image_dissolved",
+        "image_gas_highreso",
+        "image_gas_highsnr",
+        "image_gas_cor",
+        "image_proton",
+        "image_proton_reg",
+        "image_biasfield",
+        "mask",
+        "mask_vent",
+        "traj_dissolved",
+        "traj_gas",
+        "rbc_m_ratio",
+    ),
+    config_fields=("data_dir", "rbc_m_ratio"),
+    input_files=_get_mat_files,
+)
+RBC_M_RATIO = Stage(
+    name="rbc_m_ratio",
+    methods=("calculate_rbc_m_ratio",),
+    inputs=("dict_dyn",),
+    outputs=("rbc_m_ratio",),
+    config_fields=("rbc_m_ratio",),
+)
+PREPROCESS = Stage(
+    name="preprocess",
+    methods=("preprocess",),
+    inputs=("dict_dis", "dict_dyn", "dict_ute"),
+    outputs=(
+        "dict_dis",
+        "data_dissolved",
+        "data_gas",
+        "data_ute",
+        "traj_dissolved",
+        "traj_gas",
+        "traj_ute",
+        "traj_scaling_factor",
+    ),
+    config_fields=("recon",),
+)
+REFERENCE = Stage(
+    name="reference",
+    methods=("get_reference_data",),
+    inputs=("dict_dis",),
+    outputs=("reference_data", "reference_data_key"),
+    config_fields=("reference_data_key",),
+)
+RECONSTRUCTION_GAS = Stage(
+    name="reconstruction_gas",
+    methods=("reconstruction_gas",),
+    inputs=("data_gas", "traj_gas", "dict_dis"),
+    outputs=("image_gas_highreso", "image_gas_highsnr"),
+    config_fields=("recon",),
+)
+RECONSTRUCTION_DISSOLVED = Stage(
+    name="reconstruction_dissolved",
+    methods=("reconstruction_dissolved",),
+    inputs=("data_dissolved", "traj_dissolved", "dict_dis"),
+    outputs=("image_dissolved",),
+    config_fields=("recon",),
+)
+RECONSTRUCTION_PROTON = Stage(
+    name="reconstruction_proton",
+    methods=("get_proton_image",),
+    inputs=("data_ute", "traj_ute", "dict_ute", "image_gas_highreso"),
+    outputs=("image_proton",),
+    config_fields=("recon", "dicom_proton_dir"),
+    input_files=_get_proton_files,
+)
+SEGMENTATION = Stage(
+    name="segmentation",
+    methods=("segmentation",),
+    inputs=("image_gas_highreso",),
+    outputs=("mask",),
+    config_fields=("segmentation_key", "manual_seg_filepath", "compute.precision"),
+    input_files=_get_segmentation_files,
+)
+REGISTRATION = Stage(
+    name="registration",
+    methods=("registration",),
+    inputs=("image_gas_highreso", "image_proton", "mask"),
+    outputs=("mask", "image_proton_reg"),
+    config_fields=(
+        "registration_key",
+        "registration_engine",
+        "segmentation_key",
+        "manual_reg_filepath",
+    ),
+    input_files=_get_manual_reg_files,
+)
+BIASFIELD = Stage(
+    name="biasfield",
+    methods=("biasfield_correction",),
+    inputs=("image_gas_highreso", "mask", "data_gas", "traj_gas", "dict_dis"),
+    outputs=("image_gas_cor", "image_biasfield"),
+    config_fields=("bias_key", "recon"),
+)
+BINNING = Stage(
+    name="binning",
+    methods=(
+        "gas_binning",
+        "dixon_decomposition",
+        "hb_correction",
+        "dissolved_analysis",
+        "dissolved_binning",
+    ),
+    inputs=(
+        "image_gas_cor",
+        "image_gas_highsnr",
+        "image_dissolved",
+        "mask",
+        "rbc_m_ratio",
+        "reference_data",
+        "dict_dis",
+    ),
+    outputs=(
+        "image_gas_binned",
+        "mask_vent",
+        "image_rbc",
+        "image_membrane",
+        "rbc_m_ratio",
+        "rbc_hb_correction_factor",
+        "membrane_hb_correction_factor",
+        "image_rbc2gas",
+        "image_membrane2gas",
+        "image_rbc2gas_binned",
+        "image_membrane2gas_binned",
+    ),
+    config_fields=("hb_correction_key", "hb"),
+)
+STATS = Stage(
+    name="stats",
+    methods=("get_statistics", "get_info"),
+    inputs=(
+        "dict_dis",
+        "image_gas_highreso",
+        "image_gas_cor",
+        "image_rbc",
+        "image_membrane",
+        "image_rbc2gas",
+        "image_membrane2gas",
+        "image_rbc2gas_binned",
+        "image_membrane2gas_binned",
+        "image_gas_binned",
+        "mask",
+        "mask_vent",
+        "rbc_m_ratio",
+        "rbc_hb_correction_factor",
+        "membrane_hb_correction_factor",
+        "reference_data",
+    ),
+    outputs=("dict_stats", "dict_info"),
+    config_fields=("subject_id", "recon", "hb_correction_key", "hb"),
+)
+FIGURES = Stage(
+    name="figures",
+    methods=("generate_figures",),
+    inputs=(
+        "image_gas_highreso",
+        "image_gas_cor",
+        "image_proton",
+        "image_dissolved",
+        "image_rbc",
+        "image_membrane",
+        "image_gas_binned",
+        "image_rbc2gas",
+        "image_membrane2gas",
+        "image_rbc2gas_binned",
+        "image_membrane2gas_binned",
+        "mask",
+        "mask_vent",
+        "reference_data",
+    ),
+    output_files=_get_figure_files,
+)
+REPORT = Stage(
+    name="report",
+    methods=("generate_pdf",),
+    inputs=("dict_stats", "dict_info", "reference_data"),
+    config_fields=("subject_id",),
+    input_files=_get_figure_files,
+    output_files=_get_report_files,
+)
+
+RECON_STAGES = (
+    READ,
+    RBC_M_RATIO,
+    PREPROCESS,
+    REFERENCE,
+    RECONSTRUCTION_GAS,
+    RECONSTRUCTION_DISSOLVED,
+    RECONSTRUCTION_PROTON,
+    SEGMENTATION,
+    REGISTRATION,
+    BIASFIELD,
+    BINNING,
+    STATS,
+)
+READIN_STAGES = (
+    READ_MAT,
+    REFERENCE,
+    BINNING,
+    STATS,
+)
+REPORT_STAGES = (
+    FIGURES,
+    REPORT,
+)
+
+
+def get_readin_stages(force_segmentation: bool) -> List[Stage]:
+    """Get the stages of the pipeline reading in the .mat file.
+
+    Args:
+        force_segmentation: whether to run segmentation again.
+    Returns:
+        list of stages
+    """
+    stages = list(READIN_STAGES)
+    if force_segmentation:
+        stages.insert(1, SEGMENTATION)
+    return stages
+
+
+def get_cache_dir(subject: Subject) -> str:
+    """Get the directory of the stage checkpoints of the subject.
+
+    Args:
+        subject: subject instance
+    Returns:
+        str path of the directory, see cache_utils.get_cache_dir
+    """
+    return cache_utils.get_cache_dir(subject.config)
+
+
+def _load_checkpoint(stage: Stage, subject: Subject, path: str):
+    """Restore the outputs of a stage from its checkpoint.
+
+    Args:
+        stage: stage
+        subject: subject instance
+        path: path of the checkpoint directory
+    """
+    with io_utils.import_subject_h5(os.path.join(path, CHECKPOINT_FILE)) as mdict:
+        for name in stage.outputs:
+            if name in mdict:
+                setattr(subject, name, mdict[name])
+    for file in stage.get_output_files(subject):
+        shutil.copy2(os.path.join(path, os.path.basename(file)), file)
+
+
+def _save_checkpoint(stage: Stage, subject: Subject, path: str):
+    """Save the outputs of a stage to its checkpoint.
+
+    The checkpoint is written to a temporary directory which is then renamed, so
+    that an interrupted run never leaves a partial checkpoint behind. Older
+    checkpoints of the stage are removed.
+
+    Args:
+        stage: stage
+        subject: subject instance
+        path: path of the checkpoint directory
+    """
+    stage_dir = os.path.dirname(path)
+    os.makedirs(stage_dir, exist_ok=True)
+    tmp_path = tempfile.mkdtemp(dir=stage_dir, prefix=".")
+    io_utils.export_h5(
+        {
+            name: getattr(subject, name)
+            for name in stage.outputs
+            if hasattr(subject, name)
+        },
+        os.path.join(tmp_path, CHECKPOINT_FILE),
+        compression=None,
+    )
+    for file in stage.get_output_files(subject):
+        shutil.copy2(file, os.path.join(tmp_path, os.path.basename(file)))
+    for old_path in glob.glob(os.path.join(stage_dir, "*")):
+        shutil.rmtree(old_path, ignore_errors=True)
+    os.replace(tmp_path, path)
+
+
+def get_dependencies(stages: Sequence[Stage], subject: Subject) -> List[Set[int]]:
+    """Get the dependency graph of stages listed in order.
+
+    A stage depends on an earlier stage if the earlier stage writes an instance
+    variable or file that the stage reads or writes, or reads one that the stage
+    writes. Running the stages in any order compatible with the graph gives the
+    same result as running them in list order.
+
+    Args:
+        stages: stages, in order
+        subject: subject instance
+    Returns:
+        list with the indices of the stages each stage depends on
+    """
+    reads = [stage.get_reads(subject) for stage in stages]
+    writes = [stage.get_writes(subject) for stage in stages]
+    return [
+        {
+            i
+            for i in range(j)
+            if writes[i] & (reads[j] | writes[j]) or reads[i] & writes[j]
+        }
+        for j in range(len(stages))
+    ]
+
+
+def _run_stage(
+    stage: Stage, subject: Subject, cache_dir: str, resume: bool, threads: int
+):
+    """Run a stage, or restore it from its checkpoint if its key is unchanged.
+
+    Args:
+        stage: stage
+        subject: subject instance
+        cache_dir: directory of the stage checkpoints
+        resume: whether to restore the stage from its checkpoint
+        threads: number of threads of the stage
+    """
+    with compute_utils.stage_threads(threads):
+        key = stage.get_key(subject)
+        path = os.path.join(cache_dir, stage.name, key)
+        if resume and os.path.exists(os.path.join(path, CHECKPOINT_FILE)):
+            logging.info("Restoring stage %s from checkpoint.", stage.name)
+            _load_checkpoint(stage, subject, path)
+            return
+        logging.info("Running stage %s.", stage.name)
+        stage.run(subject)
+        try:
+            _save_checkpoint(stage, subject, path)
+        except OSError as e:
+            logging.warning("Cannot checkpoint stage %s: %s", stage.name, e)
+
+
+def run_stages(
+    subject: Subject,
+    stages: Sequence[Stage],
+    cache_dir: Optional[str] = None,
+    resume: bool = True,
+    n_workers: int = STAGE_WORKERS,
+):
+    """Run the stages of the pipeline on the subject.
+
+    Stages whose checkpoint key is unchanged since the last run are restored from
+    their checkpoint instead of being run. Every stage that is run is
+    checkpointed, so that an interrupted run resumes from the last completed
+    stage. Stages run as soon as the stages they depend on are complete, see
+    get_dependencies, up to n_workers at a time. The stages running side by side
+    share the threads of the config, or the cores if it does not cap them, so
+    that they never use more threads than a single stage would.
+
+    Args:
+        subject: subject instance
+        stages: stages to run, in order
+        cache_dir: directory of the stage checkpoints. Defaults to a directory in
+            the subject data directory.
+        resume: whether to restore unchanged stages from their checkpoints. If
+            False, all stages are run.
+        n_workers: maximum number of stages run concurrently. With 1, the stages
+            run in list order.
+    """
+    cache_dir = cache_dir or get_cache_dir(subject)
+    dependencies = get_dependencies(stages, subject)
+    threads = compute_utils.get_threads() or os.cpu_count() or 1
+    n_workers = max(1, min(n_workers, len(stages), threads))
+    stage_threads = threads // n_workers
+    done: Set[int] = set()
+    running: Dict[futures.Future, int] = {}
+    with compute_utils.blas_threads(stage_threads), futures.ThreadPoolExecutor(
+        max_workers=n_workers
+    ) as executor:
+        while len(done) < len(stages):
+            for j, stage in enumerate(stages):
+                if (
+                    len(running) < n_workers
+                    and j not in done
+                    and j not in running.values()
+                    and dependencies[j] <= done
+                ):
+                    future = executor.submit(
+                        _run_stage, stage, subject, cache_dir, resume, stage_threads
+                    )
+                    running[future] = j
+            finished, _ = futures.wait(running, return_when=futures.FIRST_COMPLETED)
+            for future in finished:
+                j = running.pop(future)
+                try:
+                    future.result()
+                except BaseException:
+                    # let the running stages finish, but do not start new ones
+                    futures.wait(running)
+                    raise
+                done.add(j)
@@ -5,11 +5,12 @@ import time
 from abc import ABC, abstractmethod
 
 import numpy as np
+import scipy.fft
 
 sys.path.append("..")
 
 from recon import dcf, system_model
-from utils import constants
+from utils import compute_utils, constants
 
 
 class GriddedReconModel(ABC):
@@ -106,7 +107,11 @@ class LSQgridded(GriddedReconModel):
             logging.info("-- Calculating IFFT ...")
         time_start = time.time()
         # reconVol = np.fft.fftshift(np.fft.ifftn(reconVol))
-        reconVol = np.fft.ifftshift(np.fft.ifftn(np.fft.ifftshift(reconVol)))
+        reconVol = np.fft.ifftshift(
+            scipy.fft.ifftn(
+                np.fft.ifftshift(reconVol), workers=compute_utils.get_threads() or None
+            )
+        )
         time_end = time.time()
         logging.info("The runtime for iFFT: " + str(time_end - time_start))
         if self.verbosity:
@@ -124,7 +129,9 @@ class LSQgridded(GriddedReconModel):
             )
             if self.verbosity:
                 logging.info("-- Calculating image-space deapodization function")
-            deapVol = np.fft.ifftn(deapVol)
+            deapVol = scipy.fft.ifftn(
+                deapVol, workers=compute_utils.get_threads() or None
+            )
             deapVol = np.fft.ifftshift(deapVol)
             if self.crop:
                 deapVol = self.system_obj.crop(deapVol)
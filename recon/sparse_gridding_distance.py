@@ -26,7 +26,7 @@ DEBUG = False
 DEBUG_GRID = False
 
 
-@njit
+@njit(nogil=True)
 def grid_point(
     sample_loc: np.ndarray,
     idx_convert: np.ndarray,
@@ -161,7 +161,7 @@ def grid_point(
         seed_pt[cur_dim] = lower
 
 
-@njit
+@njit(cache=True, nogil=True)
 def sparse_gridding_distance(
     coords: np.ndarray,
     kernel_width: float,
@@ -1,21 +1,70 @@
 """Registration module."""
 import logging
 import os
-from typing import Tuple
+from typing import Optional, Tuple
 
 import nibabel as nib
 import numpy as np
 from absl import app, flags
 
+from utils import cache_utils, constants, registration_utils, workspace
+
 FLAGS = flags.FLAGS
 
 flags.DEFINE_string("image_static", "", "nii image file path of static image.")
 flags.DEFINE_string("image_moving1", "", "nii image file path")
 flags.DEFINE_string("image_moving2", "", "nii image file path")
+flags.DEFINE_enum(
+    "registration_engine",
+    constants.RegistrationEngine.ANTS.value,
+    [engine.value for engine in constants.RegistrationEngine],
+    "registration engine.",
+)
+
+ANTS_REGISTRATION_PATH = os.path.join(
+    os.path.dirname(__file__), "bin", "antsRegistration"
+)
+ANTS_APPLY_TRANSFORMS_PATH = os.path.join(
+    os.path.dirname(__file__), "bin", "antsApplyTransforms"
+)
+# options of the rigid antsRegistration call
+ANTS_REGISTRATION_OPTIONS = (
+    " --dimensionality 3"
+    " --float 0"
+    " --interpolation BSpline"
+    " --metric MI[{static},{moving},1,32,Regular, 1]"
+    " --transform Rigid[0.1]"
+    " --convergence [20x20x20, 1e-6, 20]"
+    " --shrink-factors 4x2x1"
+    " --smoothing-sigmas 0x0x0"
+    " --output {output}"
+    " --verbose 1"
+)
+
+
+def _get_register_command(
+    path_reg: str, path_static: str, path_moving: str, output: str
+) -> str:
+    """Get the command of the rigid antsRegistration call.
+
+    Args:
+        path_reg: path of the antsRegistration executable
+        path_static: nii file path of the static image
+        path_moving: nii file path of the moving image
+        output: output option of the call
+    Returns:
+        str command
+    """
+    return path_reg + ANTS_REGISTRATION_OPTIONS.format(
+        static=path_static, moving=path_moving, output=output
+    )
 
 
 def register_ants(
-    image_static: np.ndarray, image_moving1: np.ndarray, image_moving2: np.ndarray
+    image_static: np.ndarray,
+    image_moving1: np.ndarray,
+    image_moving2: np.ndarray,
+    tmp_dir: Optional[str] = None,
 ) -> Tuple[np.ndarray, np.ndarray]:
     """Register images using Ants executables.
 
@@ -24,99 +73,235 @@ def register_ants(
         image_moving1: np.ndarray moving image 1.
         image_moving2: np.ndarray moving image 2 using the calculated
             transform between image_static and image_moving1.
+        tmp_dir: directory for intermediate files. Defaults to a temporary
+            directory.
 
     Returns:
         Tuple of registered images
     """
-    current_path = os.path.dirname(__file__)
-    tmp_path = os.path.join(current_path, "tmp")
-    bin_path = os.path.join(current_path, "bin")
-    pathInputstatic = os.path.join(tmp_path, "image_static.nii")
-    pathInputmoving2 = os.path.join(tmp_path, "image_moving2.nii")
-    pathInputmoving1 = os.path.join(tmp_path, "image_moving1.nii")
-    pathOutputprefix = os.path.join(tmp_path, "thisTransform_")
-    pathOutputmoving2 = os.path.join(tmp_path, "transform_reg.nii.gz")
-    pathOutputmoving1 = os.path.join(tmp_path, "moving_reg.nii.gz")
-
-    pathReg = bin_path + "/antsRegistration"
-    pathApply = bin_path + "/antsApplyTransforms"
-
-    # save the inputs into nii files so the execute N4 can read in
-    nii_static = nib.Nifti1Image(abs(image_static), np.eye(4))
-    nii_moving2 = nib.Nifti1Image(abs(image_moving2), np.eye(4))
-    nii_moving1 = nib.Nifti1Image(abs(image_moving1), np.eye(4))
-    nib.save(nii_static, pathInputstatic)
-    nib.save(nii_moving2, pathInputmoving2)
-    nib.save(nii_moving1, pathInputmoving1)
-
-    # Rigid transformation
-    logging.info("*** Using Ants Executable files to register images ...")
-    output_prefix = "[" + pathOutputprefix + ", " + pathOutputmoving1 + "]"
-    # command string
-    cmd_register = (
-        pathReg
-        + " --dimensionality 3 \
-        --float 0 \
-        --interpolation BSpline \
-        --metric MI["
-        + pathInputstatic
-        + ","
-        + pathInputmoving1
-        + ",1,32,Regular, 1] \
-        --transform Rigid[0.1] \
-        --convergence [20x20x20, 1e-6, 20] \
-        --shrink-factors 4x2x1 \
-        --smoothing-sigmas 0x0x0 \
-        --output "
-        + output_prefix
-        + " \
-        --verbose 1"
-    )
-    # registration command
-    os.system(cmd_register)
-    tdata = os.path.join(tmp_path, "thisTransform_0GenericAffine.mat")
-    # command string
-    cmd_applyTransform = (
-        pathApply
-        + " -d 3 -e 0 -i "
-        + pathInputmoving2
-        + " -r "
-        + pathOutputmoving1
-        + " -o "
-        + pathOutputmoving2
-        + " -t "
-        + tdata
-    )
-    # call the command to apply transformation to image_transform
-    os.system(cmd_applyTransform)
-    try:
-        moving2_reg = np.around(np.array(nib.load(pathOutputmoving2).get_fdata()))
-    except FileNotFoundError:
-        raise Exception(
-            "registration failed, could not find antsRegistration executable"
+    with workspace.scratch_dir(tmp_dir) as tmp_path:
+        pathInputstatic = os.path.join(tmp_path, "image_static.nii")
+        pathInputmoving2 = os.path.join(tmp_path, "image_moving2.nii")
+        pathInputmoving1 = os.path.join(tmp_path, "image_moving1.nii")
+        pathOutputprefix = os.path.join(tmp_path, "thisTransform_")
+        pathOutputmoving2 = os.path.join(tmp_path, "transform_reg.nii.gz")
+        pathOutputmoving1 = os.path.join(tmp_path, "moving_reg.nii.gz")
+
+        pathReg = ANTS_REGISTRATION_PATH
+        pathApply = ANTS_APPLY_TRANSFORMS_PATH
+
+        # save the inputs into nii files so the execute N4 can read in
+        nii_static = nib.Nifti1Image(abs(image_static), np.eye(4))
+        nii_moving2 = nib.Nifti1Image(abs(image_moving2), np.eye(4))
+        nii_moving1 = nib.Nifti1Image(abs(image_moving1), np.eye(4))
+        nib.save(nii_static, pathInputstatic)
+        nib.save(nii_moving2, pathInputmoving2)
+        nib.save(nii_moving1, pathInputmoving1)
+
+        # Rigid transformation
+        logging.info("*** Using Ants Executable files to register images ...")
+        output_prefix = "[" + pathOutputprefix + ", " + pathOutputmoving1 + "]"
+        cmd_register = _get_register_command(
+            pathReg, pathInputstatic, pathInputmoving1, output_prefix
+        )
+        # registration command
+        os.system(cmd_register)
+        tdata = os.path.join(tmp_path, "thisTransform_0GenericAffine.mat")
+        # command string
+        cmd_applyTransform = (
+            pathApply
+            + " -d 3 -e 0 -i "
+            + pathInputmoving2
+            + " -r "
+            + pathOutputmoving1
+            + " -o "
+            + pathOutputmoving2
+            + " -t "
+            + tdata
         )
-    moving1_reg = np.array(nib.load(pathOutputmoving1).get_fdata())
-    # remove the generated nii files
-    os.remove(pathInputstatic)
-    os.remove(pathInputmoving1)
-    os.remove(pathInputmoving2)
-    os.remove(pathOutputprefix + "0GenericAffine.mat")
-    os.remove(pathOutputmoving2)
-    os.remove(pathOutputmoving1)
+        # call the command to apply transformation to image_transform
+        os.system(cmd_applyTransform)
+        try:
+            moving2_reg = np.around(np.array(nib.load(pathOutputmoving2).get_fdata()))
+        except FileNotFoundError:
+            raise Exception(
+                "registration failed, could not find antsRegistration executable"
+            )
+        moving1_reg = np.array(nib.load(pathOutputmoving1).get_fdata())
+        # remove the generated nii files
+        os.remove(pathInputstatic)
+        os.remove(pathInputmoving1)
+        os.remove(pathInputmoving2)
+        os.remove(pathOutputprefix + "0GenericAffine.mat")
+        os.remove(pathOutputmoving2)
+        os.remove(pathOutputmoving1)
+
+        return moving1_reg.astype("float64"), moving2_reg.astype("float64")
+
 
+def apply_transform(
+    shape: Tuple[int, ...],
+    image_moving1: np.ndarray,
+    image_moving2: np.ndarray,
+    rotation: np.ndarray,
+    offset: np.ndarray,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Resample the moving images in memory with a rigid transform.
+
+    As in register_ants, image_moving1 is resampled with B-splines and
+    image_moving2 with linear interpolation, rounded.
+
+    Args:
+        shape: shape of the static image.
+        image_moving1: np.ndarray moving image 1.
+        image_moving2: np.ndarray moving image 2.
+        rotation: rotation matrix of the transform, see registration_utils.
+        offset: offset of the transform.
+
+    Returns:
+        Tuple of registered images
+    """
+    moving1_reg = registration_utils.apply_rigid(
+        abs(image_moving1), rotation, offset, shape, order=3
+    )
+    moving2_reg = np.around(
+        registration_utils.apply_rigid(
+            abs(image_moving2), rotation, offset, shape, order=1
+        )
+    )
     return moving1_reg.astype("float64"), moving2_reg.astype("float64")
 
 
+def register_native(
+    image_static: np.ndarray,
+    image_moving1: np.ndarray,
+    image_moving2: np.ndarray,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Register images in memory with the native rigid registration.
+
+    Same registration as register_ants: image_moving1 is registered to
+    image_static with the mutual information and resampled with B-splines, and
+    the transform is applied to image_moving2 with linear interpolation.
+
+    Args:
+        image_static: np.ndarray static image.
+        image_moving1: np.ndarray moving image 1.
+        image_moving2: np.ndarray moving image 2 using the calculated
+            transform between image_static and image_moving1.
+
+    Returns:
+        Tuple of registered images
+    """
+    logging.info("*** Using the native rigid registration ...")
+    rotation, offset = registration_utils.register_rigid(
+        abs(image_static), abs(image_moving1)
+    )
+    return apply_transform(
+        image_static.shape, image_moving1, image_moving2, rotation, offset
+    )
+
+
+def register(
+    image_static: np.ndarray,
+    image_moving1: np.ndarray,
+    image_moving2: np.ndarray,
+    engine: str = constants.RegistrationEngine.ANTS.value,
+    tmp_dir: Optional[str] = None,
+    cache_dir: Optional[str] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Register images with a registration engine.
+
+    With a cache directory, the results are cached under a hash of the input
+    images and the exact parameters of the engine. The images registered by
+    ANTs are cached as ANTs wrote them, under a key that includes the size and
+    modification time of its executables. The native engine caches the rigid
+    transform, with which both moving images are resampled in memory.
+
+    Args:
+        image_static: np.ndarray static image.
+        image_moving1: np.ndarray moving image 1.
+        image_moving2: np.ndarray moving image 2 using the calculated
+            transform between image_static and image_moving1.
+        engine: str registration engine, see constants.RegistrationEngine.
+        tmp_dir: directory for the intermediate files of ANTs. Defaults to a
+            temporary directory.
+        cache_dir: cache directory, see cache_utils.get_cache_dir. Defaults to no
+            caching.
+
+    Returns:
+        Tuple of registered images
+    """
+    if engine == constants.RegistrationEngine.ANTS.value:
+        if not cache_dir:
+            return register_ants(image_static, image_moving1, image_moving2, tmp_dir)
+        key = cache_utils.get_hash(
+            "registration",
+            engine,
+            ANTS_REGISTRATION_OPTIONS,
+            cache_utils.get_file_stats(
+                [ANTS_REGISTRATION_PATH, ANTS_APPLY_TRANSFORMS_PATH]
+            ),
+            np.abs(image_static).astype(float),
+            np.abs(image_moving1).astype(float),
+            np.abs(image_moving2).astype(float),
+        )
+        cached = cache_utils.load_arrays(cache_dir, key)
+        if cached is not None:
+            logging.info("Using the cached registered images {}.".format(key))
+            return cached["moving1_reg"], cached["moving2_reg"]
+        moving1_reg, moving2_reg = register_ants(
+            image_static, image_moving1, image_moving2, tmp_dir
+        )
+        cache_utils.save_arrays(
+            cache_dir, key, {"moving1_reg": moving1_reg, "moving2_reg": moving2_reg}
+        )
+        return moving1_reg, moving2_reg
+    elif engine != constants.RegistrationEngine.NATIVE.value:
+        raise ValueError("Invalid registration engine {}".format(engine))
+    if not cache_dir:
+        return register_native(image_static, image_moving1, image_moving2)
+    key = cache_utils.get_hash(
+        "registration",
+        engine,
+        (
+            registration_utils.SHRINK_FACTORS,
+            registration_utils.ITERATIONS,
+            registration_utils.N_BINS,
+            registration_utils.LEARNING_RATE,
+            registration_utils.MAX_SAMPLES,
+            registration_utils.MIN_STEP,
+        ),
+        np.abs(image_static).astype(float),
+        np.abs(image_moving1).astype(float),
+    )
+    cached = cache_utils.load_arrays(cache_dir, key)
+    if cached is not None:
+        logging.info("Using the cached rigid transform {}.".format(key))
+        rotation, offset = cached["rotation"], cached["offset"]
+    else:
+        logging.info("*** Using the native rigid registration ...")
+        rotation, offset = registration_utils.register_rigid(
+            abs(image_static), abs(image_moving1)
+        )
+        cache_utils.save_arrays(
+            cache_dir, key, {"rotation": rotation, "offset": offset}
+        )
+    return apply_transform(
+        image_static.shape, image_moving1, image_moving2, rotation, offset
+    )
+
+
 def main(argv):
-    """Ants registration command line."""
+    """Registration command line."""
     image_static_filepath = FLAGS.image_static
     image_moving1_filepath = FLAGS.image_moving1
     image_moving2_filepath = FLAGS.image_moving2
 
-    register_ants(
+    register(
         image_static=nib.load(image_static_filepath).get_fdata(),
         image_moving1=nib.load(image_moving1_filepath).get_fdata(),
         image_moving2=nib.load(image_moving2_filepath).get_fdata(),
+        engine=FLAGS.registration_engine,
     )
 
 
@@ -1,8 +1,7 @@
 #!/bin/bash
 
-# Find all .py files in the config/tests directory
-for file in config/tests/*.py
-do
-  # Call the python command with the file name as an argument
-  python main.py --config "$file"
-done
\ No newline at end of file
+# Process all .py files in the config/tests directory in parallel worker processes,
+# without the batch manifest so that every test subject runs
+# Usage: ./run_tests.sh [number of workers]
+python script_process_batch.py --config_glob "config/tests/*.py" --workers "${1:-4}" \
+    --manifest ""
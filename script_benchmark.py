@@ -0,0 +1,548 @@
+"""Scripts to benchmark the pipeline.
+
+Each benchmark runs in a fresh interpreter and its results are appended to a
+json lines history with the git commit, so that regressions can be tracked
+across commits:
+
+    python script_benchmark.py --benchmarks import_time
+    python script_benchmark.py --benchmarks import_time --modules main,batch
+    python script_benchmark.py --benchmarks segmentation --nii_filepath gas.nii
+    python script_benchmark.py --benchmarks threshold_segmentation
+    python script_benchmark.py --benchmarks n4_parity
+    python script_benchmark.py --benchmarks filters
+
+The import_time benchmark measures the start-up cost of the entry modules with
+`python -X importtime`, and lists the heavy dependencies each of them imports.
+These are imported lazily by the stages that use them, so none are expected.
+
+The segmentation benchmark measures the build time, the CPU latency of a 128^3
+prediction and the peak memory of the Keras model and of the inference engine
+of segmentation.get_model, each in its own worker process. It fails if the Dice
+coefficient between their masks is below the tolerance. Without an image, a
+phantom of two ellipsoids is segmented.
+
+The threshold_segmentation benchmark compares the masks of the threshold_vent
+segmentation to the CNN masks on the high resolution gas images of processed
+test subjects, with the latency of both.
+
+The n4_parity benchmark runs the N4BiasFieldCorrection executables and the
+native N4 on the high resolution gas images and masks of processed test
+subjects. It fails if their bias fields differ by more than the tolerance in
+the mask.
+
+The filters benchmark runs the filters of filter_utils and the generic scipy
+filters they replace on a 128^3 volume. It fails if their outputs differ.
+"""
+import datetime
+import glob
+import json
+import logging
+import multiprocessing as mp
+import os
+import queue as queue_module
+import re
+import subprocess
+import sys
+import time
+from typing import Any, Callable, Dict, List
+
+import numpy as np
+from absl import app, flags
+from scipy import ndimage, signal
+
+import batch
+import biasfield
+import segmentation  # also defines the nii_filepath flag
+from utils import (
+    constants,
+    filter_utils,
+    img_utils,
+    io_utils,
+    memory_utils,
+    metrics,
+    report,
+)
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_list("benchmarks", ["import_time"], "benchmarks to run.")
+flags.DEFINE_list(
+    "modules",
+    ["subject_classmap", "main", "batch", "script_submit"],
+    "entry modules of the import_time benchmark.",
+)
+flags.DEFINE_integer("repeats", 3, "runs of each benchmark, the best one is kept.")
+flags.DEFINE_integer("top", 10, "number of slowest imports to log.")
+flags.DEFINE_string("history", "data/benchmarks.jsonl", "json lines history.")
+flags.DEFINE_float(
+    "dice_tolerance", 0.99, "minimum Dice coefficient between the segmentations."
+)
+flags.DEFINE_string(
+    "config_glob",
+    "config/tests/*.py",
+    "config files of the processed subjects of the threshold_segmentation benchmark.",
+)
+flags.DEFINE_float(
+    "n4_tolerance",
+    0.05,
+    "maximum mean relative difference between the N4 bias fields in the mask.",
+)
+
+# dependencies that should only be imported by the stages that use them
+HEAVY_MODULES = (
+    "tensorflow",
+    "matplotlib",
+    "skimage",
+    "pdfkit",
+    "PyPDF2",
+    "git",
+)
+IMPORT_TIME_PATTERN = re.compile(r"import time:\s*(\d+)\s*\|\s*(\d+)\s*\|( *)(\S+)")
+
+
+def parse_import_time(stderr: str) -> List[Dict[str, Any]]:
+    """Parse the output of `python -X importtime`.
+
+    Args:
+        stderr: standard error of the interpreter
+    Returns:
+        list of imported modules with their name, nesting level, and self and
+        cumulative import time in seconds
+    """
+    imports = []
+    for line in stderr.splitlines():
+        match = IMPORT_TIME_PATTERN.match(line)
+        if match:
+            imports.append(
+                {
+                    "name": match.group(4),
+                    "level": (len(match.group(3)) - 1) // 2,
+                    "self": int(match.group(1)) * 1e-6,
+                    "cumulative": int(match.group(2)) * 1e-6,
+                }
+            )
+    return imports
+
+
+def benchmark_import_time(module: str) -> Dict[str, Any]:
+    """Measure the import time of a module in a fresh interpreter.
+
+    Args:
+        module: module name
+    Returns:
+        dictionary of the total import time in seconds, the slowest top level
+        imports and the heavy dependencies imported
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import {}".format(module)],
+        capture_output=True,
+        text=True,
+        env=dict(os.environ, PYTHONDONTWRITEBYTECODE="1"),
+    )
+    if result.returncode != 0:
+        raise RuntimeError(
+            "Cannot import {}:\n{}".format(module, result.stderr.strip()[-2000:])
+        )
+    imports = parse_import_time(result.stderr)
+    top_level = [entry for entry in imports if entry["level"] == 0]
+    slowest = sorted(top_level, key=lambda entry: -entry["cumulative"])
+    return {
+        "total": sum(entry["cumulative"] for entry in top_level),
+        "slowest": {entry["name"]: entry["cumulative"] for entry in slowest[: FLAGS.top]},
+        "heavy": sorted(
+            {
+                entry["name"].split(".")[0]
+                for entry in imports
+                if entry["name"].split(".")[0] in HEAVY_MODULES
+            }
+        ),
+    }
+
+
+def run_import_time() -> Dict[str, Any]:
+    """Run the import_time benchmark on the entry modules.
+
+    Returns:
+        results of each module, keeping the fastest of the repeated runs
+    """
+    results = {}
+    for module in FLAGS.modules:
+        runs = [benchmark_import_time(module) for _ in range(FLAGS.repeats)]
+        results[module] = min(runs, key=lambda run: run["total"])
+        logging.info(
+            "import {}: {:.2f} s, heavy dependencies: {}".format(
+                module, results[module]["total"], results[module]["heavy"] or "none"
+            )
+        )
+        for name, seconds in results[module]["slowest"].items():
+            logging.info("    {:<40} {:.3f} s".format(name, seconds))
+    return results
+
+
+def get_phantom(size: int = 128) -> np.ndarray:
+    """Get a noisy phantom of two lungs.
+
+    Args:
+        size: number of voxels along each axis
+    Returns:
+        np.ndarray image of shape (size, size, size)
+    """
+    x, y, z = np.meshgrid(*(np.linspace(-1, 1, size),) * 3, indexing="ij")
+    image = np.zeros((size, size, size))
+    for center in (-0.35, 0.35):
+        lung = ((x - center) / 0.3) ** 2 + (y / 0.45) ** 2 + (z / 0.6) ** 2 <= 1
+        image[lung] = 1.0
+    return image + 0.1 * np.random.default_rng(0).standard_normal(image.shape)
+
+
+def _run_in_process(target: Callable, args: tuple, name: str) -> Any:
+    """Run a benchmark in a fresh worker process.
+
+    Args:
+        target: function of the benchmark, called with args and a results queue
+        args: arguments of the function before the results queue
+        name: name of the benchmark used in errors
+    Returns:
+        result put in the queue by the function
+    """
+    ctx = mp.get_context("spawn")
+    queue = ctx.Queue()
+    process = ctx.Process(target=target, args=args + (queue,))
+    process.start()
+    while True:
+        try:
+            result = queue.get(timeout=1.0)
+            break
+        except queue_module.Empty:
+            if not process.is_alive():
+                raise RuntimeError(
+                    "The {} benchmark exited with code {}".format(
+                        name, process.exitcode
+                    )
+                )
+    process.join()
+    return result
+
+
+def _run_segmentation(variant: str, image: np.ndarray, repeats: int, results: Any):
+    """Benchmark a segmentation variant in a worker process.
+
+    Args:
+        variant: "keras" for the Keras model or "engine" for the inference engine
+        image: np.ndarray image of shape (128, 128, 128)
+        repeats: number of predictions
+        results: queue to put the results in
+    """
+    start = time.time()
+    if variant == "keras":
+        from models import model_vnet
+
+        model = model_vnet.vnet(input_size=(128, 128, 128, 1))
+        model.load_weights(segmentation.VENT_WEIGHTS_PATH)
+    else:
+        model = segmentation.get_model(constants.ImageType.VENT.value)
+    build = time.time() - start
+    batch = img_utils.standardize_image(image)[None, ..., None]
+    latencies = []
+    for _ in range(repeats):
+        start = time.time()
+        output = model.predict(batch)
+        latencies.append(time.time() - start)
+    results.put(
+        {
+            "build": build,
+            "latency": min(latencies),
+            "peak_rss": memory_utils.get_peak_rss(),
+            "mask": output[0, ..., 0] > 0.5,
+        }
+    )
+
+
+def run_segmentation() -> Dict[str, Any]:
+    """Run the segmentation benchmark.
+
+    Returns:
+        build time and latency in seconds and peak memory in bytes of each
+        variant, and the Dice coefficient between their masks
+    """
+    if FLAGS.nii_filepath:
+        image = np.abs(io_utils.import_nii(FLAGS.nii_filepath))
+    else:
+        image = get_phantom()
+    results: Dict[str, Any] = {}
+    masks = {}
+    for variant in ("keras", "engine"):
+        result = _run_in_process(
+            _run_segmentation, (variant, image, FLAGS.repeats), variant
+        )
+        masks[variant] = result.pop("mask")
+        results[variant] = result
+        logging.info(
+            "{}: build {:.1f} s, latency {:.2f} s, peak memory {:.2f} GB".format(
+                variant, result["build"], result["latency"], result["peak_rss"] / 1e9
+            )
+        )
+    results["dice"] = metrics.dice(masks["keras"], masks["engine"])
+    logging.info("Dice between the masks: {:.4f}".format(results["dice"]))
+    if results["dice"] < FLAGS.dice_tolerance:
+        raise ValueError(
+            "The inference engine segmentation differs from the Keras model: "
+            "Dice {:.4f} < {}".format(results["dice"], FLAGS.dice_tolerance)
+        )
+    return results
+
+
+def get_processed_images(name: str) -> Dict[str, str]:
+    """Get a nifti file of each processed subject of the config glob.
+
+    Args:
+        name: name of the nifti file in the data directory, without extension
+    Returns:
+        paths of the files by subject id
+    """
+    images = {}
+    for config_path in sorted(glob.glob(FLAGS.config_glob)):
+        config = batch.load_config(config_path)
+        paths = sorted(glob.glob(os.path.join(str(config.data_dir), name + ".nii*")))
+        if paths:
+            images[os.path.splitext(os.path.basename(config_path))[0]] = paths[0]
+        else:
+            logging.warning("No {} in {}, skipping.".format(name, config.data_dir))
+    if not images:
+        raise ValueError("No processed subject matches {}".format(FLAGS.config_glob))
+    return images
+
+
+def _run_threshold_segmentation(images: Dict[str, str], repeats: int, results: Any):
+    """Compare the threshold and CNN segmentations in a worker process.
+
+    Args:
+        images: paths of the high resolution gas images by subject id
+        repeats: number of segmentations of each image
+        results: queue to put the results in
+    """
+    model = segmentation.get_model(constants.ImageType.VENT.value)
+    subjects = {}
+    for subject_id, path in images.items():
+        image = np.abs(io_utils.import_nii(path))
+        latencies = []
+        for _ in range(repeats):
+            start = time.time()
+            mask_threshold = segmentation.predict_threshold(image)
+            latencies.append(time.time() - start)
+        start = time.time()
+        output = segmentation.predict_tiled(model, segmentation.standardize(image))
+        latency_cnn = time.time() - start
+        subjects[subject_id] = {
+            "dice": metrics.dice(output > 0.5, mask_threshold),
+            "latency_threshold": min(latencies),
+            "latency_cnn": latency_cnn,
+        }
+    results.put(subjects)
+
+
+def run_threshold_segmentation() -> Dict[str, Any]:
+    """Run the threshold_segmentation benchmark on the processed test subjects.
+
+    Returns:
+        Dice coefficient and latencies in seconds of each subject, and the mean
+        Dice coefficient
+    """
+    images = get_processed_images("gas_highreso")
+    subjects = _run_in_process(
+        _run_threshold_segmentation,
+        (images, FLAGS.repeats),
+        "threshold_segmentation",
+    )
+    for subject_id, result in subjects.items():
+        logging.info(
+            "{}: Dice {:.4f}, latency {:.2f} s threshold, {:.2f} s CNN".format(
+                subject_id,
+                result["dice"],
+                result["latency_threshold"],
+                result["latency_cnn"],
+            )
+        )
+    mean_dice = float(np.mean([result["dice"] for result in subjects.values()]))
+    logging.info("Mean Dice: {:.4f}".format(mean_dice))
+    return {"subjects": subjects, "mean_dice": mean_dice}
+
+
+def run_n4_parity() -> Dict[str, Any]:
+    """Run the n4_parity benchmark on the processed test subjects.
+
+    Returns:
+        runtime in seconds of both implementations and mean relative difference
+        of their bias fields in the mask, for each subject
+    """
+    images = get_processed_images("gas_highreso")
+    masks = get_processed_images("mask_reg")
+    subjects = {}
+    for subject_id in sorted(set(images) & set(masks)):
+        image = np.abs(io_utils.import_nii(images[subject_id]))
+        mask = io_utils.import_nii(masks[subject_id]) > 0
+        start = time.time()
+        _, biasfield_ants = biasfield.correct_biasfield_n4itk(image, mask)
+        runtime_ants = time.time() - start
+        start = time.time()
+        _, biasfield_native = biasfield.correct_biasfield_n4_native(image, mask)
+        runtime_native = time.time() - start
+        subjects[subject_id] = {
+            "difference": float(
+                np.mean(
+                    np.abs(biasfield_native[mask] - biasfield_ants[mask])
+                    / biasfield_ants[mask]
+                )
+            ),
+            "runtime_ants": runtime_ants,
+            "runtime_native": runtime_native,
+        }
+        logging.info(
+            "{}: difference {:.2%}, runtime {:.1f} s ANTs, {:.1f} s native".format(
+                subject_id,
+                subjects[subject_id]["difference"],
+                runtime_ants,
+                runtime_native,
+            )
+        )
+    failed = [
+        subject_id
+        for subject_id, result in subjects.items()
+        if result["difference"] > FLAGS.n4_tolerance
+    ]
+    if failed:
+        raise ValueError(
+            "The native N4 bias field differs from the executable on {}".format(
+                failed
+            )
+        )
+    return subjects
+
+
+def _time_best(function: Callable, *args: Any) -> Any:
+    """Time the best of the repeated runs of a function.
+
+    Args:
+        function: function to time
+        args: arguments of the function
+    Returns:
+        Tuple of the output of the function and its best runtime in seconds
+    """
+    runtimes = []
+    for _ in range(FLAGS.repeats):
+        start = time.time()
+        output = function(*args)
+        runtimes.append(time.time() - start)
+    return output, min(runtimes)
+
+
+def run_filters() -> Dict[str, Any]:
+    """Run the filters benchmark on a 128^3 volume.
+
+    The first run of the median filter compiles it, only the best run is kept.
+
+    Returns:
+        runtime in seconds of both implementations and maximum absolute
+        difference of their outputs, for each filter
+    """
+    image = get_phantom()
+    mask = image > 0.5
+    size = metrics._get_dilation_kernel(128)
+    filters = {
+        "box": (
+            lambda: ndimage.convolve(
+                image, np.ones((11, 11, 11)) / 11**3, mode="constant"
+            ),
+            lambda: filter_utils.box_filter(image, 11),
+        ),
+        "median": (
+            lambda: signal.medfilt(image, kernel_size=3),
+            lambda: filter_utils.median_filter(image, size=3),
+        ),
+        "dilation": (
+            lambda: ndimage.binary_dilation(mask, np.ones((size, size, size))),
+            lambda: filter_utils.dilate(mask, size),
+        ),
+        "slice_erosion": (
+            lambda: ndimage.grey_erosion(image, size=(3, 3, 1), mode="nearest"),
+            lambda: filter_utils.erode(image, 3, axes=(0, 1), mode="nearest"),
+        ),
+    }
+    results = {}
+    for name, (reference, fast) in filters.items():
+        output_reference, runtime_reference = _time_best(reference)
+        output_fast, runtime_fast = _time_best(fast)
+        results[name] = {
+            "difference": float(
+                np.max(
+                    np.abs(
+                        output_fast.astype(float) - output_reference.astype(float)
+                    )
+                )
+            ),
+            "runtime_reference": runtime_reference,
+            "runtime_fast": runtime_fast,
+        }
+        logging.info(
+            "{}: difference {:.2e}, runtime {:.3f} s scipy, {:.3f} s fast".format(
+                name, results[name]["difference"], runtime_reference, runtime_fast
+            )
+        )
+    failed = [
+        name for name, result in results.items() if result["difference"] > 1e-9
+    ]
+    if failed:
+        raise ValueError("The fast filters differ from scipy on {}".format(failed))
+    return results
+
+
+BENCHMARKS: Dict[str, Callable[[], Dict[str, Any]]] = {
+    "import_time": run_import_time,
+    "segmentation": run_segmentation,
+    "threshold_segmentation": run_threshold_segmentation,
+    "n4_parity": run_n4_parity,
+    "filters": run_filters,
+}
+
+
+def record(name: str, results: Dict[str, Any], path: str):
+    """Append the results of a benchmark to the history.
+
+    Args:
+        name: benchmark name
+        results: benchmark results
+        path: path of the json lines history
+    """
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    entry = {
+        "benchmark": name,
+        "time": datetime.datetime.now().isoformat(timespec="seconds"),
+        "branch": report.get_git_branch(),
+        "commit": subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True
+        ).stdout.strip(),
+        "python": sys.version.split()[0],
+        "results": results,
+    }
+    with open(path, "a") as f:
+        f.write(json.dumps(entry) + "\n")
+
+
+def main(argv):
+    """Run the benchmarks and record their results."""
+    for name in FLAGS.benchmarks:
+        if name not in BENCHMARKS:
+            raise ValueError(
+                "Invalid benchmark {}, expected one of {}".format(
+                    name, sorted(BENCHMARKS)
+                )
+            )
+    for name in FLAGS.benchmarks:
+        results = BENCHMARKS[name]()
+        if FLAGS.history:
+            record(name, results, FLAGS.history)
+
+
+if __name__ == "__main__":
+    app.run(main)
@@ -0,0 +1,34 @@
+"""Scripts to export the cohort statistics databases to csv."""
+import logging
+
+from absl import app, flags
+
+from utils import stats_db
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string("db_dir", stats_db.STATS_DB_DIR, "statistics databases directory.")
+flags.DEFINE_string("csv_path", stats_db.STATS_CSV_PATH, "exported csv file path.")
+flags.DEFINE_list("subject_ids", None, "only export these subjects.")
+flags.DEFINE_integer("pipeline_version", None, "only export this pipeline version.")
+
+
+def main(argv):
+    """Export the merged cohort statistics databases of all nodes to csv.
+
+    Without filters, regenerates the legacy data/stats_all.csv file.
+    """
+    if FLAGS.subject_ids or FLAGS.pipeline_version is not None:
+        df = stats_db.query_stats(
+            FLAGS.db_dir,
+            subject_ids=FLAGS.subject_ids,
+            pipeline_version=FLAGS.pipeline_version,
+        )
+        df.to_csv(FLAGS.csv_path, index=False)
+    else:
+        stats_db.export_csv(FLAGS.db_dir, FLAGS.csv_path)
+    logging.info("Exported statistics to {}".format(FLAGS.csv_path))
+
+
+if __name__ == "__main__":
+    app.run(main)
@@ -1,75 +1,104 @@
 """Scripts to run gas exchange mapping pipeline in batches."""
-import glob
-import importlib
+import datetime
 import logging
 import os
-import pdb
+import sys
 
 from absl import app, flags
 
-from main import gx_mapping_readin, gx_mapping_reconstruction
-
-FLAGS = flags.FLAGS
+import batch
+from main import FLAGS  # also defines the pipeline flags
+from utils import constants, manifest
 
 flags.DEFINE_string("cohort", "healthy", "cohort folder name in config folder")
-
-CONFIG_PATH = "config/"
+flags.DEFINE_string(
+    "config_glob", None, "glob of config files to process instead of a cohort."
+)
+flags.DEFINE_integer("workers", 1, "number of subjects processed concurrently.")
+flags.DEFINE_integer(
+    "threads_per_worker", None, "threads per worker, defaults to cores / workers."
+)
+flags.DEFINE_float("timeout", None, "maximum wall time per subject in seconds.")
+flags.DEFINE_float(
+    "memory_budget_gb",
+    None,
+    "memory available to the workers in GB, defaults to 90% of the node memory.",
+)
+flags.DEFINE_string(
+    "manifest",
+    None,
+    "path of the batch manifest, defaults to data/manifests/<cohort>.json. Set to "
+    "an empty string to run all subjects without a manifest.",
+)
+flags.DEFINE_bool(
+    "only_failed", False, "only run the subjects that failed in the last run."
+)
+flags.DEFINE_integer(
+    "segmentation_batch_size",
+    1,
+    "maximum number of subjects segmented in one batch by a shared segmentation "
+    "service, 1 to segment each subject in its worker.",
+)
+flags.DEFINE_float(
+    "segmentation_max_wait",
+    5.0,
+    "maximum time in seconds a subject waits for others to fill a segmentation "
+    "batch.",
+)
+flags.DEFINE_string(
+    "since",
+    None,
+    "only run the subjects not run successfully since this date (YYYY-MM-DD): "
+    "subjects never run, last run before the date, or whose inputs changed since "
+    "their last successful run.",
+)
 
 
 def main(argv):
     """Run the gas exchange imaging pipeline in multiple subjects.
 
     Import the config file and run the gas exchange imaging pipeline on all
-    subjects specified in by the cohort flag.
+    subjects specified in by the cohort flag. Subjects are processed in parallel
+    worker processes.
     """
-    if FLAGS.cohort == "healthy":
-        subjects = glob.glob(os.path.join(CONFIG_PATH, "healthy", "*py"))
-    elif FLAGS.cohort == "cteph":
-        subjects = glob.glob(os.path.join(CONFIG_PATH, "cteph", "*py"))
-    elif FLAGS.cohort == "ild":
-        subjects = glob.glob(os.path.join(CONFIG_PATH, "ild", "*py"))
-    elif FLAGS.cohort == "tyvaso":
-        subjects = glob.glob(os.path.join(CONFIG_PATH, "tyvaso", "*py"))
-    elif FLAGS.cohort == "jupiter":
-        subjects = glob.glob(os.path.join(CONFIG_PATH, "jupiter", "*py"))
-    elif FLAGS.cohort == "all":
-        subjects = glob.glob(os.path.join(CONFIG_PATH, "healthy", "*py"))
-        subjects += glob.glob(os.path.join(CONFIG_PATH, "cteph", "*py"))
-        subjects += glob.glob(os.path.join(CONFIG_PATH, "ild", "*py"))
-        subjects += glob.glob(os.path.join(CONFIG_PATH, "tyvaso", "*py"))
-    elif "-" in FLAGS.cohort:
-        cohorts = FLAGS.cohort.split("-")
-        subjects = []
-        for cohort in cohorts:
-            if cohort == "healthy":
-                subjects += glob.glob(os.path.join(CONFIG_PATH, "healthy", "*py"))
-            elif cohort == "cteph":
-                subjects += glob.glob(os.path.join(CONFIG_PATH, "cteph", "*py"))
-            elif cohort == "ild":
-                subjects += glob.glob(os.path.join(CONFIG_PATH, "ild", "*py"))
-            elif cohort == "tyvaso":
-                subjects += glob.glob(os.path.join(CONFIG_PATH, "tyvaso", "*py"))
-            else:
-                raise ValueError("Invalid cohort name")
+    subjects = batch.get_config_paths(FLAGS.cohort, FLAGS.config_glob)
+    mode = batch.get_mode(FLAGS.force_recon, FLAGS.force_readin)
+    if FLAGS.manifest is not None:
+        manifest_path = FLAGS.manifest
+    elif FLAGS.config_glob:
+        cohort = os.path.basename(os.path.dirname(FLAGS.config_glob))
+        manifest_path = manifest.get_manifest_path(cohort)
     else:
-        raise ValueError("Invalid cohort name")
-
-    for subject in subjects:
-        config_obj = importlib.import_module(
-            name=subject[:-3].replace("/", "."), package=None
-        )
-        config = config_obj.get_config()
-        logging.info("Processing subject: %s", config.subject_id)
-        if FLAGS.force_recon:
-            gx_mapping_reconstruction(config)
-        elif FLAGS.force_readin:
-            gx_mapping_readin(config)
-        elif config.processes.gx_mapping_recon:
-            gx_mapping_reconstruction(config)
-        elif config.processes.gx_mapping_readin:
-            gx_mapping_readin(config)
-        else:
-            pass
+        manifest_path = manifest.get_manifest_path(FLAGS.cohort)
+    if FLAGS.since:
+        datetime.datetime.strptime(FLAGS.since, "%Y-%m-%d")  # raises ValueError
+    threads_per_worker = FLAGS.threads_per_worker or max(
+        1, (os.cpu_count() or 1) // FLAGS.workers
+    )
+    jobs = batch.run_batch(
+        subjects,
+        n_workers=FLAGS.workers,
+        threads_per_worker=threads_per_worker,
+        timeout=FLAGS.timeout,
+        mode=mode,
+        resume=FLAGS.resume,
+        force_segmentation=FLAGS.force_segmentation,
+        memory_budget=(
+            FLAGS.memory_budget_gb * 1e9 if FLAGS.memory_budget_gb else None
+        ),
+        manifest_path=manifest_path or None,
+        only_failed=FLAGS.only_failed,
+        since=FLAGS.since,
+        segmentation_batch_size=FLAGS.segmentation_batch_size,
+        segmentation_max_wait=FLAGS.segmentation_max_wait,
+    )
+    if any(
+        job.status
+        not in (constants.BatchStatus.SUCCESS, constants.BatchStatus.SKIPPED)
+        for job in jobs
+    ):
+        logging.error("Some subjects failed.")
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,200 @@
+"""Scripts to create the quantized ventilation segmentation model.
+
+The float32 VNet is converted to TensorFlow Lite with post-training float16 or
+int8 quantization, the int8 activation ranges being calibrated on ventilation
+images. The quantized model is installed only if, on every validation image,
+its mask agrees with the mask of the float32 model within the Dice and volume
+tolerances. Subjects then use it with the cnn_vent_quantized segmentation key.
+
+    python script_quantize.py --quantization int8 \
+        --calibration_glob "data/calibration/*.nii" \
+        --validation_glob "data/validation/*.nii"
+"""
+import glob
+import json
+import logging
+import os
+import time
+from typing import Any, Dict, List
+
+import numpy as np
+from absl import app, flags
+
+import segmentation
+from utils import constants, io_utils, metrics
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_enum(
+    "quantization",
+    constants.Quantization.FLOAT16.value,
+    [quantization.value for quantization in constants.Quantization],
+    "post-training quantization of the model.",
+)
+flags.DEFINE_string(
+    "calibration_glob", None, "glob of the ventilation images used for calibration."
+)
+flags.DEFINE_string(
+    "validation_glob",
+    None,
+    "glob of the ventilation images used for validation, none of which may be a "
+    "calibration image.",
+)
+flags.DEFINE_float("dice_tolerance", 0.97, "minimum Dice coefficient per image.")
+flags.DEFINE_float(
+    "volume_tolerance", 0.02, "maximum relative difference of the mask volume."
+)
+flags.DEFINE_string(
+    "output", segmentation.VENT_QUANTIZED_PATH, "path of the quantized model."
+)
+
+
+def get_image_paths(pattern: str) -> List[str]:
+    """Get the paths of the ventilation images matching a glob.
+
+    Args:
+        pattern: glob of the nifti files
+    Returns:
+        list of str absolute file paths, sorted
+    """
+    paths = sorted(os.path.realpath(path) for path in glob.glob(pattern))
+    if not paths:
+        raise ValueError("No image matches {}".format(pattern))
+    return paths
+
+
+def load_images(paths: List[str]) -> List[np.ndarray]:
+    """Load ventilation images as input batches of the model.
+
+    Images larger than the input of the model give one batch per tile.
+
+    Args:
+        paths: paths of the nifti files
+    Returns:
+        list of input batches of a single image
+    """
+    batches = []
+    for path in paths:
+        tiles = segmentation.prepare_image(io_utils.import_nii(path))
+        batches.extend(tiles[i : i + 1] for i in range(len(tiles)))
+    return batches
+
+
+def validate(
+    reference: Any, quantized: Any, images: List[np.ndarray]
+) -> List[Dict[str, float]]:
+    """Compare the masks of the quantized model to the float32 model.
+
+    Args:
+        reference: inference engine of the float32 model
+        quantized: inference engine of the quantized model
+        images: input batches
+    Returns:
+        list of the Dice coefficient, the relative volume difference and the
+        latency of both models in seconds for each image
+    """
+    results = []
+    for image in images:
+        start = time.time()
+        mask_reference = reference.predict(image)[0, ..., 0] > 0.5
+        latency_reference = time.time() - start
+        start = time.time()
+        mask_quantized = quantized.predict(image)[0, ..., 0] > 0.5
+        latency_quantized = time.time() - start
+        volume = max(np.sum(mask_reference), 1)
+        results.append(
+            {
+                "dice": metrics.dice(mask_reference, mask_quantized),
+                "volume_difference": float(
+                    abs(np.sum(mask_quantized) - np.sum(mask_reference)) / volume
+                ),
+                "latency_reference": latency_reference,
+                "latency_quantized": latency_quantized,
+            }
+        )
+    return results
+
+
+def main(argv):
+    """Quantize, validate and install the segmentation model."""
+    from models import inference, model_vnet
+
+    if not FLAGS.calibration_glob:
+        raise ValueError("--calibration_glob is required")
+    if not FLAGS.validation_glob:
+        raise ValueError("--validation_glob is required")
+    calibration_paths = get_image_paths(FLAGS.calibration_glob)
+    validation_paths = get_image_paths(FLAGS.validation_glob)
+    shared_paths = set(calibration_paths) & set(validation_paths)
+    if shared_paths:
+        raise ValueError(
+            "Validation images must not be calibration images: {}".format(
+                sorted(shared_paths)
+            )
+        )
+    calibration_images = load_images(calibration_paths)
+    validation_images = load_images(validation_paths)
+    model = model_vnet.vnet(input_size=(128, 128, 128, 1))
+    model.load_weights(segmentation.VENT_WEIGHTS_PATH)
+    tmp_path = FLAGS.output + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(
+            inference.convert_to_tflite(
+                model, FLAGS.quantization, calibration_images
+            )
+        )
+    try:
+        results = validate(
+            segmentation.get_model(constants.ImageType.VENT.value),
+            inference.TFLiteEngine(tmp_path),
+            validation_images,
+        )
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    for i, result in enumerate(results):
+        logging.info(
+            "image {}: Dice {:.4f}, volume difference {:.2%}, "
+            "latency {:.2f} s float32, {:.2f} s {}".format(
+                i,
+                result["dice"],
+                result["volume_difference"],
+                result["latency_reference"],
+                result["latency_quantized"],
+                FLAGS.quantization,
+            )
+        )
+    failed = [
+        i
+        for i, result in enumerate(results)
+        if result["dice"] < FLAGS.dice_tolerance
+        or result["volume_difference"] > FLAGS.volume_tolerance
+    ]
+    if failed:
+        os.remove(tmp_path)
+        raise ValueError(
+            "The {} model is outside the tolerances on images {}.".format(
+                FLAGS.quantization, failed
+            )
+        )
+    os.replace(tmp_path, FLAGS.output)
+    with open(FLAGS.output + ".json", "w") as f:
+        json.dump(
+            {
+                "quantization": FLAGS.quantization,
+                "calibration_glob": FLAGS.calibration_glob,
+                "validation_glob": FLAGS.validation_glob or FLAGS.calibration_glob,
+                "dice_tolerance": FLAGS.dice_tolerance,
+                "volume_tolerance": FLAGS.volume_tolerance,
+                "results": results,
+            },
+            f,
+            indent=2,
+        )
+    logging.info(
+        "Installed the {} model in {}".format(FLAGS.quantization, FLAGS.output)
+    )
+
+
+if __name__ == "__main__":
+    app.run(main)
@@ -0,0 +1,80 @@
+"""Scripts to process subjects on several nodes through a shared work queue.
+
+Enqueue a cohort once, then start workers on every node sharing the queue
+directory:
+
+    python script_queue.py --action enqueue --cohort cteph
+    python script_queue.py --action work --workers 4
+    python script_queue.py --action status
+"""
+import logging
+import os
+
+from absl import app, flags
+
+import batch
+import work_queue
+from main import FLAGS  # also defines the pipeline flags
+
+flags.DEFINE_enum(
+    "action", "work", ["enqueue", "work", "status"], "queue action to perform."
+)
+flags.DEFINE_string("queue_dir", work_queue.QUEUE_DIR, "shared queue directory.")
+flags.DEFINE_string("cohort", "healthy", "cohort folder name in config folder")
+flags.DEFINE_string(
+    "config_glob", None, "glob of config files to enqueue instead of a cohort."
+)
+flags.DEFINE_integer(
+    "priority",
+    work_queue.PRIORITY_DEFAULT,
+    "priority of the enqueued subjects, from 0 (first) to 9 (last).",
+)
+flags.DEFINE_integer("workers", 1, "number of subjects processed concurrently.")
+flags.DEFINE_integer(
+    "threads_per_worker", None, "threads per worker, defaults to cores / workers."
+)
+flags.DEFINE_float("timeout", None, "maximum wall time per subject in seconds.")
+flags.DEFINE_float(
+    "memory_budget_gb",
+    None,
+    "memory shared by the workers in GB, defaults to 90% of the node memory.",
+)
+flags.DEFINE_bool("wait", False, "keep polling for new subjects when the queue is empty.")
+flags.DEFINE_float(
+    "stale_timeout",
+    work_queue.STALE_TIMEOUT,
+    "seconds without heartbeat after which a subject is released to other workers.",
+)
+
+
+def main(argv):
+    """Enqueue subjects, process the queue or print its status."""
+    if FLAGS.action == "enqueue":
+        mode = batch.get_mode(FLAGS.force_recon, FLAGS.force_readin)
+        for config_path in batch.get_config_paths(FLAGS.cohort, FLAGS.config_glob):
+            work_queue.enqueue(
+                FLAGS.queue_dir,
+                config_path,
+                priority=FLAGS.priority,
+                mode=mode,
+                resume=FLAGS.resume,
+                force_segmentation=FLAGS.force_segmentation,
+            )
+    elif FLAGS.action == "work":
+        work_queue.run_workers(
+            FLAGS.queue_dir,
+            n_workers=FLAGS.workers,
+            threads_per_worker=FLAGS.threads_per_worker
+            or max(1, (os.cpu_count() or 1) // FLAGS.workers),
+            timeout=FLAGS.timeout,
+            wait=FLAGS.wait,
+            stale_timeout=FLAGS.stale_timeout,
+            memory_budget=(
+                FLAGS.memory_budget_gb * 1e9 if FLAGS.memory_budget_gb else None
+            ),
+        )
+    logging.info(work_queue.summarize(FLAGS.queue_dir))
+
+
+if __name__ == "__main__":
+    app.run(main)
@@ -0,0 +1,73 @@
+"""Scripts to run a subject on the worker daemon.
+
+Replaces `python main.py --config <config>` when worker_daemon.py is running:
+the subject runs in the daemon, which has TensorFlow and the segmentation model
+already loaded, and its log is printed here.
+
+    python script_submit.py --config config/tests/subject01.py
+    python script_submit.py --action status
+"""
+import json
+import os
+import socket
+import sys
+
+from absl import app, flags
+
+from utils import constants
+
+PROTOCOL = constants.WorkerDaemon
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string("config", None, "config file of the subject.")
+flags.DEFINE_enum(
+    "action",
+    PROTOCOL.ACTION_RUN,
+    [PROTOCOL.ACTION_RUN, PROTOCOL.ACTION_STATUS, PROTOCOL.ACTION_SHUTDOWN],
+    "daemon action to perform.",
+)
+flags.DEFINE_string("socket", PROTOCOL.SOCKET_PATH, "path of the daemon Unix socket.")
+flags.DEFINE_boolean("force_recon", False, "force reconstruction for the subject")
+flags.DEFINE_boolean("force_readin", False, "force read in .mat for the subject")
+flags.DEFINE_boolean("force_segmentation", False, "run segmentation again.")
+flags.DEFINE_boolean(
+    "resume", True, "restore stages whose inputs are unchanged from checkpoints."
+)
+
+
+def main(argv):
+    """Send a request to the worker daemon and print its replies.
+
+    Returns 1 if the subject fails, so that the script can be chained in shell.
+    """
+    request = {PROTOCOL.ACTION: FLAGS.action}
+    if FLAGS.action == PROTOCOL.ACTION_RUN:
+        if not FLAGS.config:
+            raise ValueError("--config is required to run a subject")
+        request.update(
+            config_path=os.path.abspath(FLAGS.config),
+            force_recon=FLAGS.force_recon,
+            force_readin=FLAGS.force_readin,
+            force_segmentation=FLAGS.force_segmentation,
+            resume=FLAGS.resume,
+        )
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(FLAGS.socket)
+        sock.sendall((json.dumps(request) + "\n").encode())
+        for line in sock.makefile("r"):
+            message = json.loads(line)
+            if message[PROTOCOL.TYPE] == PROTOCOL.TYPE_LOG:
+                print(message["message"], flush=True)
+                continue
+            if "error" in message:
+                print(message["error"], file=sys.stderr)
+            message.pop(PROTOCOL.TYPE)
+            print(json.dumps(message, indent=2))
+            return 1 if message.get("error") else 0
+    print("The daemon closed the connection without a result.", file=sys.stderr)
+    return 1
+
+
+if __name__ == "__main__":
+    app.run(main)
@@ -2,14 +2,28 @@
 
 @author: ZiyiW Now Sup
 """
+import functools
+import itertools
 import os
+from typing import Any, List, Optional, Tuple
 
 import numpy as np
 from absl import app, flags
+from scipy import ndimage
 from scipy.ndimage import zoom
 
-from models.model_vnet import vnet
-from utils import constants, img_utils, io_utils
+from utils import (
+    compute_utils,
+    constants,
+    filter_utils,
+    img_utils,
+    io_utils,
+    lazy_import,
+)
+
+# imports TensorFlow, only once a subject is segmented with the CNN
+inference = lazy_import.lazy_module("models.inference")
+skimage_filters = lazy_import.lazy_module("skimage.filters")
 
 # define flags
 FLAGS = flags.FLAGS
@@ -17,19 +31,93 @@ FLAGS = flags.FLAGS
 flags.DEFINE_string("image_type", "vent", "either ute or vent for segmentation")
 flags.DEFINE_string("nii_filepath", "", "nii image file path")
 
+VENT_WEIGHTS_PATH = "./models/weights/model_ANATOMY_VEN.h5"
+# written by script_quantize.py once the quantized model passes validation
+VENT_QUANTIZED_PATH = "./models/weights/model_ANATOMY_VEN.tflite"
 
-def predict(
-    image: np.ndarray,
+# shape of the input image of the model, also the shape of the tiles
+VENT_INPUT_SIZE = (128, 128, 128, 1)
+# fraction of a tile overlapping the next tile
+TILE_OVERLAP = 0.5
+# standard deviation of the gaussian blending weights as a fraction of the tile
+TILE_SIGMA = 0.125
+
+# model predicting in place of get_model, see set_remote_model
+_remote_model = {"model": None}
+
+
+@functools.lru_cache(maxsize=None)
+def get_model(
     image_type: str = constants.ImageType.VENT.value,
-    erosion: int = 0,
+    precision: str = constants.Precision.FLOAT32.value,
+) -> Any:
+    """Get the segmentation model with its weights loaded.
+
+    The model is built, its batch normalization folded and its graph compiled
+    once per process, so that long-lived processes segment subsequent subjects
+    from the cached engine.
+
+    Args:
+        image_type: str of the image type ute or vent.
+        precision: str of the floating point precision, see constants.Precision.
+    Returns:
+        inference engine of the model, see models/inference.py
+    """
+    if image_type == constants.ImageType.VENT.value:
+        return inference.load_engine(
+            VENT_WEIGHTS_PATH, input_size=VENT_INPUT_SIZE, precision=precision
+        )
+    raise ValueError("image_type must be ute or vent")
+
+
+@functools.lru_cache(maxsize=None)
+def get_quantized_model(image_type: str = constants.ImageType.VENT.value) -> Any:
+    """Get the quantized segmentation model.
+
+    Args:
+        image_type: str of the image type ute or vent.
+    Returns:
+        TensorFlow Lite inference engine, see models/inference.py
+    """
+    if image_type != constants.ImageType.VENT.value:
+        raise ValueError("image_type must be ute or vent")
+    if not os.path.exists(VENT_QUANTIZED_PATH):
+        raise ValueError(
+            "Quantized model {} not found, create it with script_quantize.py".format(
+                VENT_QUANTIZED_PATH
+            )
+        )
+    return inference.TFLiteEngine(
+        VENT_QUANTIZED_PATH, num_threads=compute_utils.get_threads() or None
+    )
+
+
+def set_remote_model(model: Any):
+    """Predict with a model of another process instead of loading the model.
+
+    The batch runner sets the client of its segmentation service in each worker,
+    see segmentation_service.py.
+
+    Args:
+        model: object with the predict method of the inference engine, or None to
+            load the model again
+    """
+    _remote_model["model"] = model
+
+
+def standardize(
+    image: np.ndarray, image_type: str = constants.ImageType.VENT.value
 ) -> np.ndarray:
-    """Generate a segmentation mask from the proton or ventilation image.
+    """Resize and standardize an image for the model.
+
+    Images of 64 x 64 x n are zoomed 2 times, other sizes are kept and segmented
+    in tiles, see predict_tiled.
 
     Args:
         image: np.nd array of the input image to be segmented.
         image_type: str of the image type ute or vent.
     Returns:
-        mask: np.ndarray of type bool of the output mask.
+        np.ndarray standardized image
     """
     # get shape of the image
     img_h, img_w, _ = np.shape(image)
@@ -37,30 +125,186 @@ def predict(
     if img_h == 64 and img_w == 64:
         print("Reshaping image for segmentation")
         image = zoom(abs(image), [2, 2, 2])
-    elif img_h == 128 and img_w == 128:
-        pass
-    else:
-        raise ValueError("Segmentation Image size should be 128 x 128 x n")
 
     if image_type == constants.ImageType.VENT.value:
-        model = vnet(input_size=(128, 128, 128, 1))
-        weights_dir_current = "./models/weights/model_ANATOMY_VEN.h5"
-    else:
-        raise ValueError("image_type must be ute or vent")
+        return img_utils.standardize_image(image)
+    raise ValueError("Image type must be ute or vent")
 
-    # Load model weights
-    model.load_weights(weights_dir_current)
 
-    if image_type == constants.ImageType.VENT.value:
-        image = img_utils.standardize_image(image)
+def prepare_image(
+    image: np.ndarray, image_type: str = constants.ImageType.VENT.value
+) -> np.ndarray:
+    """Resize, standardize and tile an image into the input batch of the model.
+
+    Images of the input size of the model give a batch of one image, other sizes
+    the overlapping tiles of predict_tiled.
+
+    Args:
+        image: np.nd array of the input image to be segmented.
+        image_type: str of the image type ute or vent.
+    Returns:
+        np.ndarray float32 batch of shape (n_tiles, 128, 128, 128, 1)
+    """
+    padded = pad_to_tiles(standardize(image, image_type))
+    return np.stack([padded[tile] for tile in get_tiles(padded.shape)])[..., None]
+
+
+def get_tile_starts(size: int, tile: int, overlap: float) -> List[int]:
+    """Get the start indices of the tiles along an axis.
+
+    The tiles are evenly spread so that the first starts at 0 and the last ends
+    at the end of the axis.
+
+    Args:
+        size: number of voxels along the axis
+        tile: number of voxels of a tile
+        overlap: minimum fraction of a tile overlapping the next tile
+    Returns:
+        list of start indices
+    """
+    if size <= tile:
+        return [0]
+    step = max(int(tile * (1 - overlap)), 1)
+    n_tiles = int(np.ceil((size - tile) / step)) + 1
+    return [int(start) for start in np.linspace(0, size - tile, n_tiles).round()]
+
+
+def get_tiles(
+    shape: Tuple[int, ...],
+    tile_shape: Tuple[int, ...] = VENT_INPUT_SIZE[:3],
+    overlap: float = TILE_OVERLAP,
+) -> List[Tuple[slice, ...]]:
+    """Get the overlapping tiles covering an image padded by pad_to_tiles.
+
+    Args:
+        shape: shape of the padded image
+        tile_shape: shape of the input image of the model
+        overlap: minimum fraction of a tile overlapping the next tile
+    Returns:
+        list of the slices of each tile
+    """
+    return [
+        tuple(slice(start, start + size) for start, size in zip(starts, tile_shape))
+        for starts in itertools.product(
+            *(
+                get_tile_starts(size, tile, overlap)
+                for size, tile in zip(shape, tile_shape)
+            )
+        )
+    ]
+
+
+def pad_to_tiles(
+    image: np.ndarray, tile_shape: Tuple[int, ...] = VENT_INPUT_SIZE[:3]
+) -> np.ndarray:
+    """Pad the axes of an image shorter than the tile with the background value.
+
+    Args:
+        image: np.ndarray standardized 3-D image
+        tile_shape: shape of the input image of the model
+    Returns:
+        np.ndarray float32 padded image
+    """
+    padding = [(0, max(tile - size, 0)) for size, tile in zip(image.shape, tile_shape)]
+    return np.pad(image, padding, constant_values=np.min(image)).astype(np.float32)
+
+
+def get_gaussian_weights(shape: Tuple[int, ...], sigma: float) -> np.ndarray:
+    """Get the weights blending the predictions of overlapping tiles.
+
+    The weights decrease from the center of the tile, where the network sees the
+    most context, to its border.
+
+    Args:
+        shape: shape of a tile
+        sigma: standard deviation as a fraction of the tile size
+    Returns:
+        np.ndarray float32 weights of the given shape, with a maximum of 1
+    """
+    weights = np.ones(shape, dtype=np.float32)
+    for axis, size in enumerate(shape):
+        x = np.arange(size) - (size - 1) / 2
+        profile = np.exp(-(x**2) / (2 * (sigma * size) ** 2)).astype(np.float32)
+        weights *= profile.reshape([-1 if i == axis else 1 for i in range(len(shape))])
+    weights /= np.max(weights)
+    # the border voxels of a tile still contribute where no other tile covers them
+    return np.maximum(weights, 1e-3)
+
+
+def predict_tiled(
+    model: Any,
+    image: np.ndarray,
+    tile_shape: Tuple[int, ...] = VENT_INPUT_SIZE[:3],
+    overlap: float = TILE_OVERLAP,
+    batch_size: Optional[int] = 1,
+) -> np.ndarray:
+    """Run the model on overlapping tiles of an image and blend the predictions.
+
+    Axes shorter than the tile are padded with the background value. By default
+    the model runs on one tile at a time, so that its memory does not depend on
+    the size of the image.
+
+    Args:
+        model: inference engine of the model
+        image: np.ndarray standardized 3-D image of any size
+        tile_shape: shape of the input image of the model
+        overlap: minimum fraction of a tile overlapping the next tile
+        batch_size: number of tiles per prediction, or None to predict all the
+            tiles at once, e.g. in a single request to the segmentation service
+    Returns:
+        np.ndarray float32 output of the model of the shape of the image
+    """
+    padded = pad_to_tiles(image, tile_shape)
+    weights = get_gaussian_weights(tile_shape, TILE_SIGMA)
+    output = np.zeros(padded.shape, dtype=np.float32)
+    total = np.zeros(padded.shape, dtype=np.float32)
+    tiles = get_tiles(padded.shape, tile_shape, overlap)
+    batch_size = batch_size or len(tiles)
+    for i in range(0, len(tiles), batch_size):
+        batch = tiles[i : i + batch_size]
+        images = np.stack([padded[tile] for tile in batch])
+        predictions = model.predict(images[..., None])
+        for tile, prediction in zip(batch, predictions):
+            output[tile] += prediction[..., 0] * weights
+            total[tile] += weights
+    output /= total
+    return output[tuple(slice(0, size) for size in image.shape)]
+
+
+def predict(
+    image: np.ndarray,
+    image_type: str = constants.ImageType.VENT.value,
+    erosion: int = 0,
+    quantized: bool = False,
+) -> np.ndarray:
+    """Generate a segmentation mask from the proton or ventilation image.
+
+    Images of the input size of the model are segmented at once, other sizes in
+    overlapping tiles.
+
+    Args:
+        image: np.nd array of the input image to be segmented.
+        image_type: str of the image type ute or vent.
+        quantized: bool whether to use the quantized model.
+    Returns:
+        mask: np.ndarray of type bool of the output mask.
+    """
+    image = standardize(image, image_type)
+    if quantized:
+        model = get_quantized_model(image_type)
+    elif _remote_model["model"] is not None:
+        model = _remote_model["model"]
     else:
-        raise ValueError("Image type must be ute or vent")
+        model = get_model(image_type, compute_utils.get_precision())
     # Model Prediction
-    image = image[None, ...]
-    image = image[..., None]
-    mask = model.predict(image)
+    if image.shape == VENT_INPUT_SIZE[:3]:
+        mask = model.predict(image[None, ..., None])[0, :, :, :, 0]
+    else:
+        # the tiles are sent to the segmentation service in a single request
+        mask = predict_tiled(
+            model, image, batch_size=None if model is _remote_model["model"] else 1
+        )
     # Making mask binary
-    mask = mask[0, :, :, :, 0]
     mask[mask > 0.5] = 1
     mask[mask < 1] = 0
     # erode mask
@@ -69,6 +313,48 @@ def predict(
     return mask.astype(bool)
 
 
+def predict_threshold(
+    image: np.ndarray,
+    method: str = constants.ThresholdMethod.OTSU.value,
+    percentile: float = 90.0,
+    closing: int = 2,
+    scale: float = 0.1,
+) -> np.ndarray:
+    """Generate a segmentation mask by thresholding the ventilation image.
+
+    The image is smoothed and thresholded, the mask is closed and its holes filled,
+    and the components smaller than a fraction of the mask are removed, which keeps
+    both lungs. It needs no model, for quality assurance and preview runs.
+
+    Args:
+        image: np.nd array of the ventilation image.
+        method: str threshold method, see constants.ThresholdMethod.
+        percentile: float percentile of the intensities used as threshold with the
+            percentile method.
+        closing: int number of iterations of the morphological closing.
+        scale: float minimum size of a component as a fraction of the mask.
+    Returns:
+        mask: np.ndarray of type bool of the output mask.
+    """
+    image = filter_utils.gaussian_filter(np.abs(image).astype(np.float32), sigma=1.0)
+    if method == constants.ThresholdMethod.OTSU.value:
+        threshold = skimage_filters.threshold_otsu(image)
+    elif method == constants.ThresholdMethod.PERCENTILE.value:
+        threshold = np.percentile(image, percentile)
+    else:
+        raise ValueError("Invalid threshold method {}".format(method))
+    mask = image > threshold
+    if closing > 0:
+        # pad so that the closing does not erode the mask at the image border
+        mask = np.pad(mask, closing)
+        mask = ndimage.binary_closing(
+            mask, ndimage.generate_binary_structure(3, 1), iterations=closing
+        )
+        mask = mask[(slice(closing, -closing),) * 3]
+    mask = ndimage.binary_fill_holes(mask)
+    return img_utils.remove_small_objects(mask, scale)
+
+
 def main(argv):
     """Run CNN model inference on ute or vent image."""
     image = io_utils.import_nii(FLAGS.nii_filepath)
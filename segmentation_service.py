@@ -0,0 +1,307 @@
+"""Batched segmentation service of the batch runner.
+
+Each subject of a batch runs in its own worker process, which would load its own
+copy of the segmentation model and predict its single ventilation image. With the
+service, the batch runner instead starts one service process holding the model.
+Workers send their standardized 128^3 images, or all the tiles of a larger
+image in one request, to the service, which stacks the images of the subjects in
+flight into one batch, runs a single prediction and sends each mask output back
+to its worker.
+
+A batch is predicted as soon as it holds the maximum batch size, or once its
+first image has waited the maximum wait time, so that the latency of a subject
+stays bounded when few subjects are in flight. A request of several tiles is
+predicted without waiting.
+
+The quantized model has a fixed batch size of one and is still run by the
+workers.
+"""
+
+import logging
+import queue
+import time
+import traceback
+import uuid
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+
+from config import base_config
+from utils import compute_utils, constants
+
+# maximum wall time of a prediction seen by a worker, including the wait
+PREDICT_TIMEOUT = 600.0
+STOP_GRACE = 10.0
+
+
+class SegmentationClient(object):
+    """Client of the segmentation service used by a worker process.
+
+    It predicts like the inference engine of segmentation.get_model, so that
+    segmentation.predict uses it in place of the model.
+
+    Attributes:
+        requests (multiprocessing.Queue): queue of the requests of all workers
+        replies (multiprocessing.Queue): queue of the replies to this worker
+        slot (int): index of the worker slot of the replies queue
+        timeout (float): maximum wall time of a prediction in seconds
+    """
+
+    def __init__(
+        self, requests: Any, replies: Any, slot: int, timeout: float = PREDICT_TIMEOUT
+    ):
+        """Init object."""
+        self.requests = requests
+        self.replies = replies
+        self.slot = slot
+        self.timeout = timeout
+
+    def predict(self, image: np.ndarray) -> np.ndarray:
+        """Run the model of the service on an image.
+
+        Args:
+            image: np.ndarray batch of images of shape (n, 128, 128, 128, 1), e.g.
+                the tiles of a larger image
+        Returns:
+            np.ndarray float32 output of the model for each image
+        """
+        request_id = uuid.uuid4().hex
+        self.requests.put(
+            {
+                "id": request_id,
+                "slot": self.slot,
+                "precision": compute_utils.get_precision(),
+                "image": np.asarray(image, dtype=np.float32),
+            }
+        )
+        deadline = time.time() + self.timeout
+        while True:
+            try:
+                reply = self.replies.get(timeout=max(deadline - time.time(), 0))
+            except queue.Empty:
+                raise RuntimeError(
+                    "The segmentation service did not reply in {:.0f} s".format(
+                        self.timeout
+                    )
+                )
+            # replies to a previous job of the slot that timed out are dropped
+            if reply["id"] == request_id:
+                break
+        if "error" in reply:
+            raise RuntimeError("Segmentation service error:\n{}".format(reply["error"]))
+        return reply["output"]
+
+
+def _next_batch(
+    pending: List[Dict[str, Any]], max_batch_size: int
+) -> List[Dict[str, Any]]:
+    """Take the next batch from the pending requests.
+
+    A batch holds the oldest request and the following requests of the same
+    precision, as long as their images fit the maximum batch size.
+
+    Args:
+        pending: pending requests in order of arrival, the batch is removed
+        max_batch_size: maximum number of images of a batch
+    Returns:
+        list of requests of the batch
+    """
+    precision = pending[0]["precision"]
+    batch: List[Dict[str, Any]] = []
+    n_images = 0
+    for request in pending:
+        if request["precision"] != precision:
+            continue
+        if batch and n_images + len(request["image"]) > max_batch_size:
+            break
+        batch.append(request)
+        n_images += len(request["image"])
+    for request in batch:
+        pending.remove(request)
+    return batch
+
+
+def _serve(
+    requests: Any,
+    replies: Sequence[Any],
+    max_batch_size: int,
+    max_wait: float,
+    threads: int,
+):
+    """Serve the segmentation requests until a None request is received.
+
+    Args:
+        requests: queue of the requests
+        replies: queues of the replies by worker slot
+        max_batch_size: maximum number of images of a batch
+        max_wait: maximum time in seconds the first image of a batch waits for
+            more images
+        threads: number of threads of the model
+    """
+    import segmentation
+
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s %(processName)s %(message)s"
+    )
+    compute = base_config.Compute()
+    compute.threads = threads
+    compute_utils.apply_compute(compute)
+    pending: List[Dict[str, Any]] = []
+    arrival: Dict[str, float] = {}
+    stopping = False
+    while pending or not stopping:
+        if not pending:
+            request = requests.get()
+            if request is None:
+                break
+            pending.append(request)
+            arrival[request["id"]] = time.time()
+        deadline = arrival[pending[0]["id"]]
+        if len(pending[0]["image"]) == 1:
+            deadline += max_wait
+        while (
+            not stopping
+            and sum(len(request["image"]) for request in pending) < max_batch_size
+        ):
+            try:
+                request = requests.get(timeout=max(deadline - time.time(), 0))
+            except queue.Empty:
+                break
+            if request is None:
+                stopping = True
+                break
+            pending.append(request)
+            arrival[request["id"]] = time.time()
+        batch = _next_batch(pending, max_batch_size)
+        try:
+            model = segmentation.get_model(
+                constants.ImageType.VENT.value, batch[0]["precision"]
+            )
+            start = time.time()
+            images = np.concatenate([request["image"] for request in batch])
+            # a request of many tiles is predicted in batches of the maximum size
+            outputs = np.concatenate(
+                [
+                    model.predict(images[i : i + max_batch_size])
+                    for i in range(0, len(images), max_batch_size)
+                ]
+            )
+            logging.info(
+                "Segmented {} images in {:.2f} s".format(
+                    len(images), time.time() - start
+                )
+            )
+            i = 0
+            for request in batch:
+                n_images = len(request["image"])
+                replies[request["slot"]].put(
+                    {"id": request["id"], "output": outputs[i : i + n_images]}
+                )
+                i += n_images
+        except Exception:
+            logging.error(traceback.format_exc())
+            for request in batch:
+                replies[request["slot"]].put(
+                    {"id": request["id"], "error": traceback.format_exc(limit=-1)}
+                )
+        for request in batch:
+            del arrival[request["id"]]
+
+
+class SegmentationService(object):
+    """Segmentation service process of a batch.
+
+    Attributes:
+        max_batch_size (int): maximum number of images of a batch
+        max_wait (float): maximum time in seconds the first image of a batch waits
+            for more images
+        requests (multiprocessing.Queue): queue of the requests of all workers
+        replies (list): queues of the replies by worker slot
+        process (multiprocessing.Process): service process, or None if stopped
+    """
+
+    def __init__(
+        self,
+        ctx: Any,
+        n_slots: int,
+        max_batch_size: int,
+        max_wait: float,
+        threads: int = 1,
+    ):
+        """Init object and start the service process.
+
+        Args:
+            ctx: multiprocessing context of the workers
+            n_slots: number of workers running concurrently
+            max_batch_size: maximum number of images of a batch
+            max_wait: maximum time in seconds the first image of a batch waits
+                for more images
+            threads: number of threads of the model
+        """
+        if max_batch_size < 1:
+            raise ValueError("Invalid maximum batch size {}".format(max_batch_size))
+        if max_wait < 0:
+            raise ValueError("Invalid maximum wait {}".format(max_wait))
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._ctx = ctx
+        self._n_slots = n_slots
+        self._threads = threads
+        self.process: Optional[Any] = None
+        self._start()
+
+    def _start(self):
+        """Start the service process with new queues."""
+        self.requests = self._ctx.Queue()
+        self.replies = [self._ctx.Queue() for _ in range(self._n_slots)]
+        self.process = self._ctx.Process(
+            target=_serve,
+            args=(
+                self.requests,
+                self.replies,
+                self.max_batch_size,
+                self.max_wait,
+                self._threads,
+            ),
+            name="segmentation_service",
+            daemon=True,
+        )
+        self.process.start()
+        logging.info(
+            "Started the segmentation service (batches of up to {} images, "
+            "{:.1f} s wait)".format(self.max_batch_size, self.max_wait)
+        )
+
+    def restart(self):
+        """Restart the service process with new queues.
+
+        A worker killed while writing a request can leave the requests queue
+        corrupted or its lock held, which would block the service and every
+        other worker. Workers still holding clients of the old queues get no
+        reply and time out, the workers started afterwards get new clients.
+        """
+        if self.process is not None:
+            self.process.terminate()
+            self.process.join()
+        self._start()
+
+    def get_client(self, slot: int) -> SegmentationClient:
+        """Get the client of a worker slot.
+
+        Args:
+            slot: index of the worker slot
+        Returns:
+            client passed to the worker process
+        """
+        return SegmentationClient(self.requests, self.replies[slot], slot)
+
+    def stop(self):
+        """Stop the service process once it served the pending requests."""
+        if self.process is None:
+            return
+        self.requests.put(None)
+        self.process.join(STOP_GRACE)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self.process = None
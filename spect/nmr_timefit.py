@@ -3,14 +3,13 @@ import sys
 from typing import Optional
 
 sys.path.append("..")
-import matplotlib
-
-matplotlib.use("TkAgg")
 import numpy as np
-from matplotlib import pyplot as plt
 from scipy.optimize import least_squares
 
 from spect.nmr_mix import NMR_Mix
+from utils import lazy_import
+
+plt = lazy_import.lazy_module("matplotlib.pyplot", lazy_import.use_headless_backend)
 
 
 class NMR_TimeFit(NMR_Mix):
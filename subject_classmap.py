@@ -1,9 +1,11 @@
 """Module for gas exchange imaging subject."""
 
+import copy
 import glob
 import logging
 import os
-from typing import Any, Dict
+from concurrent.futures import Future
+from typing import Any, Dict, List
 
 import nibabel as nib
 import numpy as np
@@ -16,6 +18,7 @@ import segmentation
 from config import base_config
 from utils import (
     binning,
+    cache_utils,
     constants,
     img_utils,
     io_utils,
@@ -25,7 +28,42 @@ from utils import (
     report,
     signal_utils,
     spect_utils,
+    stats_db,
     traj_utils,
+    workspace,
+)
+
+# Instance variables saved to the mat file, which are the ones read_mat_file reads.
+MAT_FIELDS = (
+    "dict_dis",
+    "dict_dyn",
+    "dict_ute",
+    "data_dissolved",
+    "data_gas",
+    "image_dissolved",
+    "image_gas_highreso",
+    "image_gas_highsnr",
+    "image_gas_cor",
+    "image_proton",
+    "image_proton_reg",
+    "image_biasfield",
+    "mask",
+    "mask_vent",
+    "traj_dissolved",
+    "traj_gas",
+    "rbc_m_ratio",
+)
+# Images and masks that read_mat_file memory-maps, so they are left uncompressed.
+MAT_CONTIGUOUS_FIELDS = (
+    "image_dissolved",
+    "image_gas_highreso",
+    "image_gas_highsnr",
+    "image_gas_cor",
+    "image_proton",
+    "image_proton_reg",
+    "image_biasfield",
+    "mask",
+    "mask_vent",
 )
 
 """
@@ -72,6 +110,7 @@ class Subject(object):
         traj_gas (np.array): gas-phase trajectory of shape (n_projections, n_points, 3)
         traj_scaling_factor (float): scaling factor for trajectory
         traj_ute (np.array): UTE proton trajectory of shape
+        workspace (Workspace): scratch directory for intermediate and output files
     """
 
     def __init__(self, config: base_config.Config):
@@ -109,6 +148,24 @@ class Subject(object):
         self.traj_ute = np.array([])
         self.reference_data_key = str()
         self.reference_data = {}
+        self.workspace = workspace.Workspace(
+            str(config.compute.scratch_dir), prefix="{}_".format(config.subject_id)
+        )
+
+    def read_raw_files(self):
+        """Read in raw data files to dictionary.
+
+        Read in twix files, falling back to mrd files if the twix files cannot be
+        read.
+        """
+        try:
+            self.read_twix_files()
+        except:
+            logging.warning("Cannot read in twix files.")
+            try:
+                self.read_mrd_files()
+            except:
+                raise ValueError("Cannot read in raw data files.")
 
     def read_twix_files(self):
         """Read in twix files to dictionary.
@@ -158,19 +215,50 @@ class Subject(object):
             self.config.dicom_proton_dir, self.image_gas_highreso.shape
         )
 
+    def get_proton_image(self):
+        """Get the proton image.
+
+        Reconstruct the UTE image if enabled, otherwise read in the DICOM files if
+        specified. If neither is available, the proton image is set to zeros.
+        """
+        if self.config.recon.recon_proton:
+            self.reconstruction_ute()
+        elif self.config.dicom_proton_dir:
+            self.read_dicom_files()
+        else:
+            self.image_proton = np.zeros_like(self.image_gas_highreso)
+
     def read_mat_file(self):
         """Read in mat file of reconstructed images.
 
+        Supports both the MATLAB v7.3 (HDF5) checkpoint written by
+        save_subject_to_mat, which is read lazily, and legacy MATLAB v5 files.
+        The large arrays of the checkpoint are contiguous and memory-mapped, so
+        that only the voxels used by the stages that run are read from disk.
+
         Note: The mat file variable names are matched to the instance variable names.
         Thus, if the variable names are changed in the mat file, they must be changed.
         """
-        mdict = io_utils.import_mat(io_utils.get_mat_file(str(self.config.data_dir)))
-        self.dict_dis = io_utils.import_matstruct_to_dict(mdict["dict_dis"])
-        if "dict_dyn" in mdict.keys() and mdict["dict_dyn"].flatten()[0] is not None:
-            self.dict_dyn = io_utils.import_matstruct_to_dict(mdict["dict_dyn"])
-        if "dict_ute" in mdict.keys():
-            logging.info("UTE proton data found.")
-            self.dict_ute = io_utils.import_matstruct_to_dict(mdict["dict_ute"])
+        path = io_utils.get_mat_file(str(self.config.data_dir))
+        if io_utils.is_h5_mat(path):
+            mdict = io_utils.import_subject_h5(path)
+            self.dict_dis = mdict["dict_dis"]
+            if "dict_dyn" in mdict:
+                self.dict_dyn = mdict["dict_dyn"]
+            if "dict_ute" in mdict:
+                logging.info("UTE proton data found.")
+                self.dict_ute = mdict["dict_ute"]
+        else:
+            mdict = io_utils.import_mat(path)
+            self.dict_dis = io_utils.import_matstruct_to_dict(mdict["dict_dis"])
+            if (
+                "dict_dyn" in mdict.keys()
+                and mdict["dict_dyn"].flatten()[0] is not None
+            ):
+                self.dict_dyn = io_utils.import_matstruct_to_dict(mdict["dict_dyn"])
+            if "dict_ute" in mdict.keys():
+                logging.info("UTE proton data found.")
+                self.dict_ute = io_utils.import_matstruct_to_dict(mdict["dict_ute"])
         self.data_dissolved = mdict["data_dissolved"]
         self.data_gas = mdict["data_gas"]
         self.image_dissolved = mdict["image_dissolved"]
@@ -180,14 +268,16 @@ class Subject(object):
         self.image_proton = mdict["image_proton"]
         self.image_proton_reg = mdict["image_proton_reg"]
         self.image_biasfield = mdict["image_biasfield"]
-        self.mask = mdict["mask"].astype(bool)
-        self.mask_vent = mdict["mask_vent"].astype(bool)
+        self.mask = np.asarray(mdict["mask"], dtype=bool)
+        self.mask_vent = np.asarray(mdict["mask_vent"], dtype=bool)
         self.traj_dissolved = mdict["traj_dissolved"]
         self.traj_gas = mdict["traj_gas"]
         if self.config.rbc_m_ratio > 0:
             self.rbc_m_ratio = float(self.config.rbc_m_ratio)
         else:
             self.rbc_m_ratio = float(mdict["rbc_m_ratio"])
+        if isinstance(mdict, io_utils.H5Checkpoint):
+            mdict.close()
 
     def calculate_rbc_m_ratio(self):
         """Calculate RBC:M ratio using static spectroscopy.
@@ -305,8 +395,8 @@ class Subject(object):
             # rescale trajectories
             self.traj_ute *= self.traj_scaling_factor
 
-        
-        # Choose appropriate reference distribution
+    def get_reference_data(self):
+        """Choose the reference distribution used for binning and reporting."""
         self.reference_data_key = self.config.reference_data_key
 
         if self.reference_data_key == constants.ReferenceDataKey.DUKE_REFERENCE.value:
@@ -328,7 +418,6 @@ class Subject(object):
 
         elif self.reference_data_key == constants.ReferenceDataKey.MANUAL_REFERENCE.value:
             self.reference_data = constants.ReferenceDistribution.REFERENCE_MANUAL
-            
 
     def reconstruction_ute(self):
         """Reconstruct the UTE image."""
@@ -355,7 +444,44 @@ class Subject(object):
             orientation=orientation,
             system_vendor=system_vendor,
         )
-        io_utils.export_nii(np.abs(self.image_proton), "tmp/image_proton.nii")
+        io_utils.export_nii(
+            np.abs(self.image_proton), self.workspace.path("image_proton.nii")
+        )
+
+    def _reconstruct_gas_image(
+        self, data: np.ndarray, traj: np.ndarray, kernel_sharpness: float
+    ) -> np.ndarray:
+        """Reconstruct a gas phase image at the matrix size in the image orientation.
+
+        Args:
+            data (np.ndarray): gas-phase data of shape (n_projections, n_points)
+            traj (np.ndarray): trajectory of shape (n_projections, n_points, 3)
+            kernel_sharpness (float): sharpness of the reconstruction kernel
+        Returns:
+            np.ndarray reconstructed image
+        """
+        if self.config.recon.recon_key == constants.ReconKey.ROBERTSON.value:
+            image = reconstruction.reconstruct(
+                data=(recon_utils.flatten_data(data)),
+                traj=recon_utils.flatten_traj(traj),
+                kernel_sharpness=kernel_sharpness,
+                kernel_extent=9 * kernel_sharpness,
+                image_size=int(self.config.recon.recon_size),
+            )
+        elif self.config.recon.recon_key == constants.ReconKey.PLUMMER.value:
+            raise NotImplementedError("Plummer CS reconstruction not implemented.")
+        else:
+            raise ValueError(
+                f"Unknown reconstruction key: {self.config.recon.recon_key}"
+            )
+        image = img_utils.interp(
+            image, self.config.recon.matrix_size // self.config.recon.recon_size
+        )
+        return img_utils.flip_and_rotate_image(
+            image,
+            orientation=self.dict_dis[constants.IOFields.ORIENTATION],
+            system_vendor=self.dict_dis[constants.IOFields.SYSTEM_VENDOR],
+        )
 
     def reconstruction_gas(self):
         """Reconstruct the gas phase image."""
@@ -370,55 +496,27 @@ class Subject(object):
         
         `reconstruction.py` as a file demonstrates how the `reconstruct()` function is used.
         
-        We can save to a directory of our choice instead of the `tmp/` directory.
+        We can save to a directory of our choice instead of the workspace directory.
         
         
         """
-        if self.config.recon.recon_key == constants.ReconKey.ROBERTSON.value:
-            self.image_gas_highsnr = reconstruction.reconstruct(
-                data=(recon_utils.flatten_data(self.data_gas)),
-                traj=recon_utils.flatten_traj(self.traj_gas),
-                kernel_sharpness=float(self.config.recon.kernel_sharpness_lr),
-                kernel_extent=9 * float(self.config.recon.kernel_sharpness_lr),
-                image_size=int(self.config.recon.recon_size),
-            )
-            self.image_gas_highreso = reconstruction.reconstruct(
-                data=(recon_utils.flatten_data(self.data_gas)),
-                traj=recon_utils.flatten_traj(self.traj_gas),
-                kernel_sharpness=float(self.config.recon.kernel_sharpness_hr),
-                kernel_extent=9 * float(self.config.recon.kernel_sharpness_hr),
-                image_size=int(self.config.recon.recon_size),
-            )
-            orientation = self.dict_dis[constants.IOFields.ORIENTATION]
-            system_vendor = self.dict_dis[constants.IOFields.SYSTEM_VENDOR]
-        elif self.config.recon.recon_key == constants.ReconKey.PLUMMER.value:
-            raise NotImplementedError("Plummer CS reconstruction not implemented.")
-        else:
-            raise ValueError(
-                f"Unknown reconstruction key: {self.config.recon.recon_key}"
-            )
-
-        self.image_gas_highreso = img_utils.interp(
-            self.image_gas_highreso,
-            self.config.recon.matrix_size // self.config.recon.recon_size,
-        )
-        self.image_gas_highsnr = img_utils.interp(
-            self.image_gas_highsnr,
-            self.config.recon.matrix_size // self.config.recon.recon_size,
+        self.image_gas_highsnr = self._reconstruct_gas_image(
+            self.data_gas,
+            self.traj_gas,
+            kernel_sharpness=float(self.config.recon.kernel_sharpness_lr),
         )
-        self.image_gas_highsnr = img_utils.flip_and_rotate_image(
-            self.image_gas_highsnr,
-            orientation=orientation,
-            system_vendor=system_vendor,
+        self.image_gas_highreso = self._reconstruct_gas_image(
+            self.data_gas,
+            self.traj_gas,
+            kernel_sharpness=float(self.config.recon.kernel_sharpness_hr),
         )
-        self.image_gas_highreso = img_utils.flip_and_rotate_image(
-            self.image_gas_highreso,
-            orientation=orientation,
-            system_vendor=system_vendor,
+        io_utils.export_nii(
+            np.abs(self.image_gas_highsnr),
+            self.workspace.path("image_gas_highsnr.nii"),
         )
-        io_utils.export_nii(np.abs(self.image_gas_highsnr), "tmp/image_gas_highsnr.nii")
         io_utils.export_nii(
-            np.abs(self.image_gas_highreso), "tmp/image_gas_highreso.nii"
+            np.abs(self.image_gas_highreso),
+            self.workspace.path("image_gas_highreso.nii"),
         )
 
     def reconstruction_dissolved(self):
@@ -452,6 +550,18 @@ class Subject(object):
         if self.config.segmentation_key == constants.SegmentationKey.CNN_VENT.value:
             logging.info("Performing neural network segmenation.")
             self.mask = segmentation.predict(self.image_gas_highreso)
+        elif (
+            self.config.segmentation_key
+            == constants.SegmentationKey.CNN_VENT_QUANTIZED.value
+        ):
+            logging.info("Performing quantized neural network segmenation.")
+            self.mask = segmentation.predict(self.image_gas_highreso, quantized=True)
+        elif (
+            self.config.segmentation_key
+            == constants.SegmentationKey.THRESHOLD_VENT.value
+        ):
+            logging.info("Performing threshold segmentation.")
+            self.mask = segmentation.predict_threshold(self.image_gas_highreso)
         elif self.config.segmentation_key == constants.SegmentationKey.SKIP.value:
             self.mask = np.ones_like(self.image_gas_highreso)
         elif (
@@ -470,20 +580,32 @@ class Subject(object):
     def registration(self):
         """Register moving image to target image.
 
-        Uses ANTs registration to register the proton image to the xenon image.
+        Uses ANTs or the native rigid registration, see config.registration_engine,
+        to register the proton image to the xenon image. The registrations are
+        cached by content, see registration.register.
         """
         if self.config.registration_key == constants.RegistrationKey.MASK2GAS.value:
             logging.info("Run registration algorithm, vent is fixed, mask is moving")
             self.mask, self.image_proton_reg = np.abs(
-                registration.register_ants(
-                    abs(self.image_gas_highreso), self.mask, self.image_proton
+                registration.register(
+                    abs(self.image_gas_highreso),
+                    self.mask,
+                    self.image_proton,
+                    engine=self.config.registration_engine,
+                    tmp_dir=self.workspace.root,
+                    cache_dir=cache_utils.get_cache_dir(self.config),
                 )
             )
         elif self.config.registration_key == constants.RegistrationKey.PROTON2GAS.value:
             logging.info("Run registration algorithm, vent is fixed, proton is moving")
             self.image_proton_reg, mask = np.abs(
-                registration.register_ants(
-                    abs(self.image_gas_highreso), self.image_proton, self.mask
+                registration.register(
+                    abs(self.image_gas_highreso),
+                    self.image_proton,
+                    self.mask,
+                    engine=self.config.registration_engine,
+                    tmp_dir=self.workspace.root,
+                    cache_dir=cache_utils.get_cache_dir(self.config),
                 )
             )
             if (
@@ -509,19 +631,58 @@ class Subject(object):
             raise ValueError("Invalid registration key.")
 
     def biasfield_correction(self):
-        """Correct ventilation image for bias field."""
+        """Correct ventilation image for bias field.
+
+        The N4 bias fields are cached by content, see biasfield.correct_biasfield_n4.
+        The RF-depolarization bias field is calculated from the gas images of the
+        first and second halves of the projections.
+        """
         if self.config.bias_key == constants.BiasfieldKey.SKIP.value:
             logging.info("Skipping bias field correction.")
             self.image_gas_cor = abs(self.image_gas_highreso)
             self.image_biasfield = np.ones(self.image_gas_highreso.shape)
-        elif self.config.bias_key == constants.BiasfieldKey.N4ITK.value:
-            logging.info("Performing N4ITK bias field correction.")
+        elif self.config.bias_key in [
+            constants.BiasfieldKey.N4ITK.value,
+            constants.BiasfieldKey.N4_NATIVE.value,
+        ]:
+            logging.info(
+                "Performing {} bias field correction.".format(self.config.bias_key)
+            )
+            (
+                self.image_gas_cor,
+                self.image_biasfield,
+            ) = biasfield.correct_biasfield_n4(
+                image=abs(self.image_gas_highreso),
+                mask=self.mask.astype(bool),
+                bias_key=self.config.bias_key,
+                tmp_dir=self.workspace.root,
+                cache_dir=cache_utils.get_cache_dir(self.config),
+            )
+        elif self.config.bias_key == constants.BiasfieldKey.RF_DEPOLARIZATION.value:
+            logging.info("Performing RF-depolarization bias field correction.")
+            n_proj = self.data_gas.shape[0]
+            if self.data_gas.ndim != 2 or n_proj < 2:
+                raise ValueError("RF-depolarization correction requires gas data.")
+            # images of the first and second halves of the projections
+            images = [
+                np.abs(
+                    self._reconstruct_gas_image(
+                        self.data_gas[projections],
+                        self.traj_gas[projections],
+                        kernel_sharpness=float(self.config.recon.kernel_sharpness_lr),
+                    )
+                )
+                for projections in [slice(0, n_proj // 2), slice(n_proj // 2, None)]
+            ]
             (
                 self.image_gas_cor,
                 self.image_biasfield,
-            ) = biasfield.correct_biasfield_n4itk(
+            ) = biasfield.correct_biasfield_rf(
                 image=abs(self.image_gas_highreso),
+                image1=images[0],
+                image2=images[1],
                 mask=self.mask.astype(bool),
+                n_proj=n_proj,
             )
         else:
             raise ValueError("Invalid bias field correction key.")
@@ -819,19 +980,19 @@ class Subject(object):
         )
         plot.plot_montage_grey(
             image=np.abs(self.image_gas_highreso),
-            path="tmp/montage_vent.png",
+            path=self.workspace.path("montage_vent.png"),
             index_start=index_start,
             index_skip=index_skip,
         )
         plot.plot_montage_grey(
             image=np.abs(self.image_membrane),
-            path="tmp/montage_membrane.png",
+            path=self.workspace.path("montage_membrane.png"),
             index_start=index_start,
             index_skip=index_skip,
         )
         plot.plot_montage_grey(
             image=np.abs(self.image_rbc),
-            path="tmp/montage_rbc.png",
+            path=self.workspace.path("montage_rbc.png"),
             index_start=index_start,
             index_skip=index_skip,
         )
@@ -839,7 +1000,7 @@ class Subject(object):
             image=plot.map_and_overlay_to_rgb(
                 self.image_gas_binned, proton_reg, constants.CMAP.VENT_BIN2COLOR
             ),
-            path="tmp/montage_gas_binned.png",
+            path=self.workspace.path("montage_gas_binned.png"),
             index_start=index_start,
             index_skip=index_skip,
         )
@@ -847,7 +1008,7 @@ class Subject(object):
             image=plot.map_and_overlay_to_rgb(
                 self.image_rbc2gas_binned, proton_reg, constants.CMAP.RBC_BIN2COLOR
             ),
-            path="tmp/montage_rbc_binned.png",
+            path=self.workspace.path("montage_rbc_binned.png"),
             index_start=index_start,
             index_skip=index_skip,
         )
@@ -857,13 +1018,13 @@ class Subject(object):
                 proton_reg,
                 constants.CMAP.MEMBRANE_BIN2COLOR,
             ),
-            path="tmp/montage_membrane_binned.png",
+            path=self.workspace.path("montage_membrane_binned.png"),
             index_start=index_start,
             index_skip=index_skip,
         )
         plot.plot_montage_color(
             image=plot.overlay_mask_on_image(proton_reg, self.mask.astype("uint8")),
-            path="tmp/montage_proton_qa.png",
+            path=self.workspace.path("montage_proton_qa.png"),
             index_start=index_start,
             index_skip=index_skip,
         )
@@ -871,7 +1032,7 @@ class Subject(object):
             image=plot.overlay_mask_on_image(
                 np.abs(self.image_gas_highreso), self.mask.astype("uint8")
             ),
-            path="tmp/montage_vent_qa.png",
+            path=self.workspace.path("montage_vent_qa.png"),
             index_start=index_start,
             index_skip=index_skip,
         )
@@ -879,7 +1040,7 @@ class Subject(object):
             image=plot.overlay_mask_on_image(
                 np.abs(self.image_dissolved), self.mask.astype("uint8")
             ),
-            path="tmp/montage_dissolved_qa.png",
+            path=self.workspace.path("montage_dissolved_qa.png"),
             index_start=index_start,
             index_skip=index_skip,
         )
@@ -887,7 +1048,7 @@ class Subject(object):
             data=img_utils.normalize(self.image_gas_cor, self.mask)[
                 np.array(self.mask, dtype=bool)
             ].flatten(),
-            path="tmp/hist_vent.png",
+            path=self.workspace.path("hist_vent.png"),
             color=constants.VENTHISTOGRAMFields.COLOR,
             xlim=constants.VENTHISTOGRAMFields.XLIM,
             ylim=constants.VENTHISTOGRAMFields.YLIM,
@@ -903,7 +1064,7 @@ class Subject(object):
             data=np.abs(self.image_rbc2gas)[
                 np.array(self.mask_vent, dtype=bool)
             ].flatten(),
-            path="tmp/hist_rbc.png",
+            path=self.workspace.path("hist_rbc.png"),
             color=constants.RBCHISTOGRAMFields.COLOR,
             xlim=constants.RBCHISTOGRAMFields.XLIM,
             ylim=constants.RBCHISTOGRAMFields.YLIM,
@@ -919,7 +1080,7 @@ class Subject(object):
             data=np.abs(self.image_membrane2gas)[
                 np.array(self.mask_vent, dtype=bool)
             ].flatten(),
-            path="tmp/hist_membrane.png",
+            path=self.workspace.path("hist_membrane.png"),
             color=constants.MEMBRANEHISTOGRAMFields.COLOR,
             xlim=constants.MEMBRANEHISTOGRAMFields.XLIM,
             ylim=constants.MEMBRANEHISTOGRAMFields.YLIM,
@@ -936,148 +1097,170 @@ class Subject(object):
         """Generate HTML and PDF files."""
         # generate individual PDFs
         pdf_list = [
-            os.path.join("tmp", pdf)
+            self.workspace.path(pdf)
             for pdf in ["intro.pdf", "clinical.pdf", "grayscale.pdf", "qa"]
         ]
-        report.intro(self.dict_info, path=pdf_list[0])
+        report.intro(
+            self.dict_info, path=pdf_list[0], tmp_dir=self.workspace.root
+        )
         report.clinical(
             {**self.dict_stats, **self.reference_data['reference_stats']},
             path=pdf_list[1],
+            tmp_dir=self.workspace.root,
         )
         report.grayscale(
             {**self.dict_stats, **self.reference_data['reference_stats']},
             path=pdf_list[2],
+            tmp_dir=self.workspace.root,
         )
         report.qa(
             {**self.dict_stats, **self.reference_data['reference_stats']},
             path=pdf_list[3],
+            tmp_dir=self.workspace.root,
         )
 
         # combine PDFs into one
-        path = "tmp/{}_report.pdf".format(self.config.subject_id)
+        path = self.workspace.path("{}_report.pdf".format(self.config.subject_id))
         report.combine_pdfs(pdf_list, path)
 
     def write_stats_to_csv(self):
-        """Write statistics to file."""
-        # write to combined csv of recently processed subjects
-        io_utils.export_subject_csv(
-            {**self.dict_info, **self.dict_stats}, path="data/stats_all.csv"
-        )
+        """Write statistics to file.
+
+        The combined statistics of all subjects are stored in the cohort statistics
+        database of this node. Use script_export_stats.py to merge the databases
+        of all nodes into data/stats_all.csv.
+        """
+        # write to combined database of processed subjects
+        stats_db.upsert_stats({**self.dict_info, **self.dict_stats})
 
         # write to individual subject csv
         io_utils.export_subject_csv(
             {**self.dict_info, **self.dict_stats},
-            path="tmp/{}_stats.csv".format(self.config.subject_id),
+            path=self.workspace.path("{}_stats.csv".format(self.config.subject_id)),
             overwrite=True,
         )
 
-    def save_subject_to_mat(self):
-        """Save the instance variables into a mat file."""
-        path = os.path.join("tmp", self.config.subject_id + ".mat")
-        io_utils.export_subject_mat(self, path)
+    def save_subject_to_mat(self) -> List[Future]:
+        """Save the instance variables read by read_mat_file into a mat file.
+
+        The MATLAB v7.3 (HDF5) file is written in the background from a snapshot
+        of the instance variables. The images and masks are contiguous so that
+        read_mat_file memory-maps them, the other arrays are compressed. Wait for
+        it with io_utils.wait_for_exports.
 
-    def save_files(self):
-        """Save select images to nifti files and instance variable to mat."""
+        Returns:
+            futures of the background exports
+        """
+        path = self.workspace.path(self.config.subject_id + ".mat")
+        snapshot = copy.copy(self)
+        return [
+            io_utils.submit_export(
+                io_utils.export_subject_h5,
+                snapshot,
+                path,
+                fields=MAT_FIELDS,
+                contiguous=MAT_CONTIGUOUS_FIELDS,
+            )
+        ]
+
+    def save_files(self) -> List[Future]:
+        """Save select images to nifti files.
+
+        The files are written in the background, bins and masks as uint8 and
+        images as float32. Wait for them with io_utils.wait_for_exports.
+
+        Returns:
+            futures of the background exports
+        """
+        fov = self.dict_dis[constants.IOFields.FOV]
         proton_reg = img_utils.normalize(
             np.abs(self.image_proton),
             self.mask,
             method=constants.NormalizationMethods.PERCENTILE,
         )
-        io_utils.export_nii(
-            self.image_rbc2gas_binned,
-            "tmp/rbc_binned.nii",
-            self.dict_dis[constants.IOFields.FOV],
-        )
-        io_utils.export_nii(
-            np.abs(self.image_gas_highreso),
-            "tmp/gas_highreso.nii",
-            self.dict_dis[constants.IOFields.FOV],
-        )
-        io_utils.export_nii(
-            np.abs(self.image_gas_highsnr),
-            "tmp/gas_highsnr.nii",
-            self.dict_dis[constants.IOFields.FOV],
-        )
-        io_utils.export_nii(
-            np.abs(self.image_rbc),
-            "tmp/rbc.nii",
-            self.dict_dis[constants.IOFields.FOV],
-        )
-        io_utils.export_nii(
-            np.abs(self.image_membrane),
-            "tmp/membrane.nii",
-            self.dict_dis[constants.IOFields.FOV],
-        )
-        io_utils.export_nii(
-            np.abs(self.image_membrane2gas),
-            "tmp/membrane2gas.nii",
-            self.dict_dis[constants.IOFields.FOV],
-        )
-        io_utils.export_nii(
-            self.mask.astype(float),
-            "tmp/mask_reg.nii",
-            self.dict_dis[constants.IOFields.FOV],
-        )
-        io_utils.export_nii(
-            np.abs(self.image_dissolved),
-            "tmp/dissolved.nii",
-            self.dict_dis[constants.IOFields.FOV],
-        )
+        nii_files = [
+            (self.image_rbc2gas_binned, "rbc_binned", "uint8"),
+            (np.abs(self.image_gas_highreso), "gas_highreso", "float32"),
+            (np.abs(self.image_gas_highsnr), "gas_highsnr", "float32"),
+            (np.abs(self.image_rbc), "rbc", "float32"),
+            (np.abs(self.image_membrane), "membrane", "float32"),
+            (np.abs(self.image_membrane2gas), "membrane2gas", "float32"),
+            ((np.asarray(self.mask) > 0).astype("uint8"), "mask_reg", "uint8"),
+            (np.abs(self.image_dissolved), "dissolved", "float32"),
+        ]
         if self.config.recon.recon_proton:
-            io_utils.export_nii(
-                np.abs(self.image_proton),
-                "tmp/proton.nii",
-                self.dict_dis[constants.IOFields.FOV],
+            nii_files += [
+                (np.abs(self.image_proton), "proton", "float32"),
+                (np.abs(self.image_proton_reg), "proton_reg", "float32"),
+            ]
+        exports = [
+            io_utils.submit_export(
+                io_utils.export_nii, image, self._get_nii_path(name), fov, dtype
             )
-            io_utils.export_nii(
-                np.abs(self.image_proton_reg),
-                "tmp/proton_reg.nii",
-                self.dict_dis[constants.IOFields.FOV],
-            ),
-        io_utils.export_nii_4d(
-            plot.map_and_overlay_to_rgb(
-                self.image_rbc2gas_binned, proton_reg, constants.CMAP.RBC_BIN2COLOR
-            ),
-            "tmp/rbc2gas_rgb.nii",
-        )
-        io_utils.export_nii_4d(
-            plot.map_and_overlay_to_rgb(
+            for image, name, dtype in nii_files
+        ]
+        rgb_files = [
+            (self.image_rbc2gas_binned, constants.CMAP.RBC_BIN2COLOR, "rbc2gas_rgb"),
+            (
                 self.image_membrane2gas_binned,
-                proton_reg,
                 constants.CMAP.MEMBRANE_BIN2COLOR,
+                "membrane2gas_rgb",
             ),
-            "tmp/membrane2gas_rgb.nii",
-        )
-        io_utils.export_nii_4d(
-            plot.map_and_overlay_to_rgb(
-                self.image_gas_binned,
-                proton_reg,
-                constants.CMAP.VENT_BIN2COLOR,
-            ),
-            "tmp/gas_rgb.nii",
-        )
+            (self.image_gas_binned, constants.CMAP.VENT_BIN2COLOR, "gas_rgb"),
+        ]
+        for image, cmap, name in rgb_files:
+            exports.append(
+                io_utils.submit_export(
+                    lambda image, cmap, path: io_utils.export_nii_4d(
+                        plot.map_and_overlay_to_rgb(image, proton_reg, cmap), path
+                    ),
+                    image,
+                    cmap,
+                    self._get_nii_path(name),
+                )
+            )
+        return exports
+
+    def _get_nii_path(self, name: str) -> str:
+        """Get the path of an exported nifti file.
+
+        Args:
+            name: file name without extension
+        Returns:
+            str path of the nifti file, ending with .nii.gz if compressed
+        """
+        extension = ".nii.gz" if self.config.compress_nifti else ".nii"
+        return self.workspace.path(name + extension)
 
     def save_config_as_json(self):
         """Save subject config .py file as json."""
         io_utils.export_config_to_json(
             self.config,
-            "tmp/{}_config_gx_imaging.json".format(self.config.subject_id),
+            self.workspace.path(
+                "{}_config_gx_imaging.json".format(self.config.subject_id)
+            ),
         )
 
     def move_output_files(self):
-        """Move output files into dedicated directory."""
+        """Move output files into dedicated directory.
+
+        The files written in the background by save_files and save_subject_to_mat
+        must be finished, see io_utils.wait_for_exports.
+        """
         # define files to move
         output_files = (
-            "tmp/{}_config_gx_imaging.json".format(self.config.subject_id),
-            "tmp/{}.mat".format(self.config.subject_id),
-            "tmp/{}_report.pdf".format(self.config.subject_id),
-            "tmp/{}_stats.csv".format(self.config.subject_id),
-            "tmp/gas_highreso.nii",
-            "tmp/gas_rgb.nii",
-            "tmp/mask_reg.nii",
-            "tmp/membrane2gas_rgb.nii",
-            "tmp/proton_reg.nii",
-            "tmp/rbc2gas_rgb.nii",
+            self.workspace.path(
+                "{}_config_gx_imaging.json".format(self.config.subject_id)
+            ),
+            self.workspace.path("{}.mat".format(self.config.subject_id)),
+            self.workspace.path("{}_report.pdf".format(self.config.subject_id)),
+            self.workspace.path("{}_stats.csv".format(self.config.subject_id)),
+            self._get_nii_path("gas_highreso"),
+            self._get_nii_path("gas_rgb"),
+            self._get_nii_path("mask_reg"),
+            self._get_nii_path("membrane2gas_rgb"),
+            self._get_nii_path("proton_reg"),
+            self._get_nii_path("rbc2gas_rgb"),
         )
 
         # move files
@@ -0,0 +1,230 @@
+"""B-spline util functions.
+
+Uniform tensor product B-splines of 3-D images. A B-spline is defined by its
+control point lattice and, along each axis, by its number of spans over the
+parametric domain and its order. Since the basis is separable, it is stored as
+one basis matrix per axis, and fitting and evaluating the B-spline over a grid
+of voxels are sequences of matrix products along the axes.
+
+The fit is a level of the multilevel B-spline approximation of Lee et al.,
+Scattered data interpolation with multilevel B-splines, IEEE TVCG 1997, with the
+weighted extension used by ITK in N4 (Tustison et al., N4ITK: improved N3 bias
+correction, IEEE TMI 2010). The approximation of images instead fits each level
+by regularized weighted least squares, whose normal matrix is sparse since each
+control point only overlaps its neighbors.
+"""
+
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+from scipy import interpolate, sparse
+from scipy.sparse import linalg
+
+# ridge of the least squares fit relative to the mean diagonal of the normal matrix
+REGULARIZATION = 1e-3
+
+
+def get_basis(
+    coords: np.ndarray, n_spans: int, order: int, domain: Tuple[float, float]
+) -> np.ndarray:
+    """Get the B-spline basis functions at coordinates along an axis.
+
+    Args:
+        coords: coordinates of the voxels along the axis
+        n_spans: number of spans of the B-spline over the domain
+        order: order of the B-spline
+        domain: first and last coordinates of the parametric domain
+    Returns:
+        np.ndarray basis matrix of shape (len(coords), n_spans + order)
+    """
+    low, high = domain
+    u = np.clip((np.asarray(coords, dtype=float) - low) / (high - low), 0, 1)
+    knots = np.arange(-order, n_spans + order + 1, dtype=float)
+    return interpolate.BSpline.design_matrix(u * n_spans, knots, order).toarray()
+
+
+def get_bases(
+    coords: Sequence[np.ndarray],
+    n_spans: Sequence[int],
+    order: int,
+    domains: Sequence[Tuple[float, float]],
+) -> List[np.ndarray]:
+    """Get the B-spline basis functions of a grid of voxels.
+
+    Args:
+        coords: coordinates of the voxels along each axis
+        n_spans: number of spans along each axis
+        order: order of the B-spline
+        domains: parametric domain along each axis
+    Returns:
+        list of the basis matrices of each axis
+    """
+    return [
+        get_basis(axis_coords, axis_spans, order, domain)
+        for axis_coords, axis_spans, domain in zip(coords, n_spans, domains)
+    ]
+
+
+def _contract(image: np.ndarray, bases: Sequence[np.ndarray]) -> np.ndarray:
+    """Contract each axis of a grid with the basis functions of the axis.
+
+    Args:
+        image: values of the voxels
+        bases: basis matrices of each axis
+    Returns:
+        np.ndarray array of the shape of the control point lattice
+    """
+    for basis in bases:
+        # the contracted axis is the first one, and the new one is appended
+        image = np.tensordot(image, basis, axes=([0], [0]))
+    return image
+
+
+def evaluate(lattice: np.ndarray, bases: Sequence[np.ndarray]) -> np.ndarray:
+    """Evaluate a B-spline over a grid of voxels.
+
+    Args:
+        lattice: control point lattice
+        bases: basis matrices of each axis of the grid
+    Returns:
+        np.ndarray values of the B-spline of the shape of the grid
+    """
+    for basis in bases:
+        lattice = np.tensordot(lattice, basis, axes=([0], [1]))
+    return lattice
+
+
+def fit(
+    values: np.ndarray, weights: np.ndarray, bases: Sequence[np.ndarray]
+) -> np.ndarray:
+    """Fit a B-spline to a grid of voxels with one level of approximation.
+
+    Every voxel proposes the control points of its support that reproduce its
+    value with the least change, and each control point is the average of the
+    proposals weighted by the squared basis functions and the voxel weights.
+    Control points without any voxel of nonzero weight in their support are 0.
+
+    Args:
+        values: values of the voxels
+        weights: confidence of the voxels, 0 outside the mask
+        bases: basis matrices of each axis of the grid
+    Returns:
+        np.ndarray control point lattice
+    """
+    # sum of the squared basis functions over the support of each voxel
+    norm = np.ones(values.shape)
+    for axis, basis in enumerate(bases):
+        shape = [1] * values.ndim
+        shape[axis] = -1
+        norm = norm * np.sum(basis**2, axis=1).reshape(shape)
+    numerator = _contract(weights * values / norm, [basis**3 for basis in bases])
+    denominator = _contract(weights, [basis**2 for basis in bases])
+    lattice = np.zeros(numerator.shape)
+    nonzero = denominator > 0
+    lattice[nonzero] = numerator[nonzero] / denominator[nonzero]
+    return lattice
+
+
+def refine(lattice: np.ndarray, n_spans: Sequence[int], order: int) -> np.ndarray:
+    """Refine a control point lattice to twice the number of spans.
+
+    The refined B-spline is the same function, since the B-splines of a mesh are
+    also B-splines of the mesh twice as fine.
+
+    Args:
+        lattice: control point lattice
+        n_spans: number of spans along each axis of the lattice
+        order: order of the B-spline
+    Returns:
+        np.ndarray control point lattice with 2 * n_spans spans along each axis
+    """
+    for axis_spans in n_spans:
+        u = np.linspace(0, 1, 4 * (2 * axis_spans + order))
+        coarse = get_basis(u, axis_spans, order, (0, 1))
+        fine = get_basis(u, 2 * axis_spans, order, (0, 1))
+        refinement = np.linalg.lstsq(fine, coarse, rcond=None)[0]
+        lattice = np.tensordot(lattice, refinement, axes=([0], [1]))
+    return lattice
+
+
+def fit_least_squares(
+    values: np.ndarray,
+    weights: np.ndarray,
+    bases: Sequence[np.ndarray],
+    regularization: float = REGULARIZATION,
+) -> np.ndarray:
+    """Fit a B-spline to a grid of voxels by weighted least squares.
+
+    Minimizes the weighted squared error of the B-spline plus a ridge on the
+    control points, which keeps the control points without any voxel of nonzero
+    weight in their support at 0.
+
+    Args:
+        values: values of the voxels
+        weights: confidence of the voxels, 0 outside the mask
+        bases: basis matrices of each axis of the grid
+        regularization: ridge relative to the mean diagonal of the normal matrix
+    Returns:
+        np.ndarray control point lattice
+    """
+    shape = tuple(basis.shape[1] for basis in bases)
+    # normal matrix with the axes (i0, i0', i1, i1', ...) of the pairs of control
+    # points along each axis
+    normal = weights
+    for basis in bases:
+        products = (basis[:, :, None] * basis[:, None, :]).reshape(len(basis), -1)
+        normal = np.tensordot(normal, products, axes=([0], [0]))
+    normal = normal.reshape([size for size in shape for _ in range(2)])
+    normal = normal.transpose(
+        list(range(0, 2 * len(shape), 2)) + list(range(1, 2 * len(shape), 2))
+    ).reshape(int(np.prod(shape)), -1)
+    ridge = regularization * max(np.mean(np.diag(normal)), np.finfo(float).tiny)
+    normal = sparse.csr_matrix(normal) + ridge * sparse.identity(len(normal))
+    rhs = _contract(weights * values, bases).ravel()
+    return linalg.spsolve(normal.tocsc(), rhs).reshape(shape)
+
+
+def approximate(
+    image: np.ndarray,
+    mask: Optional[np.ndarray] = None,
+    order: int = 3,
+    n_levels: int = 4,
+    n_spans: int = 1,
+    regularization: float = REGULARIZATION,
+) -> np.ndarray:
+    """Approximate an image with a multilevel B-spline.
+
+    Each level fits the residual of the previous levels with twice as many spans
+    along each axis, so that the coarse levels carry the smooth trend of the
+    image, also outside the mask, and the finer levels its details.
+
+    Args:
+        image: image to approximate
+        mask: mask of the voxels fitted. Defaults to all voxels with a finite
+            value.
+        order: order of the B-spline
+        n_levels: number of levels
+        n_spans: number of spans along each axis at the first level
+        regularization: ridge of the fit of each level, see fit_least_squares
+    Returns:
+        np.ndarray B-spline approximation of the image over all voxels
+    """
+    weights = np.ones(image.shape) if mask is None else (mask > 0).astype(float)
+    # voxels without a finite value are not fitted
+    weights[~np.isfinite(image)] = 0
+    image = np.nan_to_num(np.asarray(image, dtype=float), posinf=0.0, neginf=0.0)
+    coords = [np.arange(size) for size in image.shape]
+    domains = [(0.0, size - 1.0) for size in image.shape]
+    spans = [n_spans] * image.ndim
+    lattice = np.zeros([axis_spans + order for axis_spans in spans])
+    approximation = np.zeros(image.shape)
+    for level in range(n_levels):
+        if level > 0:
+            lattice = refine(lattice, spans, order)
+            spans = [2 * axis_spans for axis_spans in spans]
+        bases = get_bases(coords, spans, order, domains)
+        lattice = lattice + fit_least_squares(
+            image - approximation, weights, bases, regularization
+        )
+        approximation = evaluate(lattice, bases)
+    return approximation
@@ -0,0 +1,208 @@
+"""Content hashing util functions for caching pipeline results."""
+
+import enum
+import hashlib
+import logging
+import os
+import sys
+import tempfile
+import time
+from typing import Any, Dict, Iterable, List, Optional
+
+sys.path.append("..")
+import numpy as np
+
+# folder of the cache directory holding the results cached by content hash
+RESULTS_DIR = "results"
+# the least recently used results beyond this size in bytes are removed
+RESULTS_MAX_SIZE = 2 * 1024**3
+# results not used for this many seconds are removed
+RESULTS_MAX_AGE = 30 * 24 * 3600.0
+
+
+def _update_hash(hasher: Any, value: Any):
+    """Update a hash object with the content of a value.
+
+    Supports numpy arrays, dictionaries, lists, tuples, scalars, strings, enums
+    and config objects. Other objects are hashed through their instance variables.
+
+    Args:
+        hasher: hashlib hash object
+        value: value to hash
+    """
+    if isinstance(value, np.ndarray):
+        array = np.ascontiguousarray(value)
+        hasher.update("ndarray{}{}".format(array.dtype.str, array.shape).encode())
+        hasher.update(memoryview(array.reshape(-1)).cast("B"))
+    elif isinstance(value, dict):
+        hasher.update(b"dict")
+        for key in sorted(value.keys(), key=str):
+            _update_hash(hasher, str(key))
+            _update_hash(hasher, value[key])
+    elif isinstance(value, (list, tuple)):
+        hasher.update("{}{}".format(type(value).__name__, len(value)).encode())
+        for item in value:
+            _update_hash(hasher, item)
+    elif isinstance(value, enum.Enum):
+        _update_hash(hasher, value.value)
+    elif isinstance(value, (str, bytes, bool, int, float, complex, np.generic)):
+        hasher.update("{}:{!r}".format(type(value).__name__, value).encode())
+    elif value is None:
+        hasher.update(b"None")
+    elif hasattr(value, "to_dict"):
+        _update_hash(hasher, value.to_dict())
+    elif hasattr(value, "__dict__"):
+        _update_hash(hasher, vars(value))
+    else:
+        hasher.update(repr(value).encode())
+
+
+def get_hash(*values: Any) -> str:
+    """Get a hex digest of the content of the values.
+
+    Args:
+        values: values to hash
+    Returns:
+        str hex digest
+    """
+    hasher = hashlib.blake2b(digest_size=16)
+    for value in values:
+        _update_hash(hasher, value)
+    return hasher.hexdigest()
+
+
+def get_file_stats(paths: Iterable[str]) -> List[Any]:
+    """Get the name, size and modification time of files.
+
+    Used to hash large input files without reading them. Missing files are
+    recorded as such.
+
+    Args:
+        paths: file paths
+    Returns:
+        list of (name, size, modification time in ns) for each file
+    """
+    stats = []
+    for path in sorted(paths):
+        try:
+            stat = os.stat(path)
+            stats.append((os.path.basename(path), stat.st_size, stat.st_mtime_ns))
+        except FileNotFoundError:
+            stats.append((os.path.basename(path), None, None))
+    return stats
+
+
+def get_file_hash(path: str, chunk_size: int = 1 << 20) -> str:
+    """Get a hex digest of the content of a file.
+
+    Args:
+        path: file path
+        chunk_size: number of bytes to read at a time
+    Returns:
+        str hex digest
+    """
+    hasher = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def get_cache_dir(config: Any) -> str:
+    """Get the cache directory of a subject.
+
+    The cache directory is in the cache directory of the config if set, e.g. on a
+    local disk when the data directory is on a network filesystem.
+
+    Args:
+        config: config of the subject
+    Returns:
+        str path of the directory
+    """
+    if config.compute.cache_dir:
+        return os.path.join(str(config.compute.cache_dir), str(config.subject_id))
+    return os.path.join(str(config.data_dir), "stages")
+
+
+def load_arrays(cache_dir: str, key: str) -> Optional[Dict[str, np.ndarray]]:
+    """Load the arrays cached under a key.
+
+    Args:
+        cache_dir: cache directory
+        key: content hash of the inputs of the result, see get_hash
+    Returns:
+        dict of the arrays by name, or None if the key is not cached
+    """
+    path = os.path.join(cache_dir, RESULTS_DIR, key + ".npz")
+    try:
+        with np.load(path) as data:
+            arrays = {name: data[name] for name in data.files}
+        os.utime(path)  # marks the result as recently used
+        return arrays
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logging.warning("Ignoring invalid cached result {}: {}".format(path, e))
+        return None
+
+
+def save_arrays(cache_dir: str, key: str, arrays: Dict[str, np.ndarray]):
+    """Cache arrays under a key.
+
+    The arrays are written to a temporary file which is then renamed, so that
+    concurrent or interrupted runs never leave a partial result behind. The
+    cache is then pruned, see prune_arrays.
+
+    Args:
+        cache_dir: cache directory
+        key: content hash of the inputs of the result, see get_hash
+        arrays: arrays by name
+    """
+    results_dir = os.path.join(cache_dir, RESULTS_DIR)
+    os.makedirs(results_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=results_dir, prefix=".", suffix=".npz")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, os.path.join(results_dir, key + ".npz"))
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    prune_arrays(cache_dir)
+
+
+def prune_arrays(
+    cache_dir: str,
+    max_size: float = RESULTS_MAX_SIZE,
+    max_age: float = RESULTS_MAX_AGE,
+):
+    """Remove the cached arrays not used recently.
+
+    Results not used for max_age seconds are removed, then the least recently
+    used ones until the results fit max_size bytes. The most recent result is
+    always kept.
+
+    Args:
+        cache_dir: cache directory
+        max_size: maximum size of the cached results in bytes
+        max_age: maximum time in seconds since a result was last used
+    """
+    results_dir = os.path.join(cache_dir, RESULTS_DIR)
+    results = []
+    for name in os.listdir(results_dir):
+        if name.endswith(".npz") and not name.startswith("."):
+            try:
+                stat = os.stat(os.path.join(results_dir, name))
+            except FileNotFoundError:
+                continue  # removed by a concurrent run
+            results.append((stat.st_mtime, stat.st_size, name))
+    results.sort(reverse=True)
+    size = 0
+    for i, (mtime, file_size, name) in enumerate(results):
+        if i and (size + file_size > max_size or time.time() - mtime > max_age):
+            try:
+                os.remove(os.path.join(results_dir, name))
+            except FileNotFoundError:
+                pass
+        else:
+            size += file_size
@@ -0,0 +1,225 @@
+"""Compute resource util functions.
+
+The numerical libraries each size their thread pools from the number of cores:
+BLAS and OpenMP through numpy and scipy, numba, TensorFlow and the ITK based ANTs
+executables. config.compute sets them all to the same number of threads, so that
+subjects running side by side do not oversubscribe the node.
+
+Environment variables are only read when a library starts, which is before the
+config is loaded for the libraries imported by the pipeline modules. The thread
+pools of these are resized at runtime instead, and the environment variables
+cover TensorFlow, which is imported lazily, and the executables, which inherit
+the environment of the pipeline. The numba threads are set per thread, so the
+threads running pipeline stages set them again, see set_numba_threads. Stages
+running side by side share the threads of the config, see stage_threads.
+"""
+
+import contextlib
+import logging
+import os
+import sys
+import threading
+from typing import Any, Dict, Iterator
+
+sys.path.append("..")
+from utils import constants
+
+try:
+    import threadpoolctl
+except ImportError:  # BLAS threads are then only capped through the environment
+    threadpoolctl = None
+
+# environment variables read by BLAS, OpenMP, numba, TensorFlow and ITK (ANTs)
+THREAD_ENV_VARS = (
+    "OMP_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+    "NUMBA_NUM_THREADS",
+    "TF_NUM_INTRAOP_THREADS",
+    "TF_NUM_INTEROP_THREADS",
+    "ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS",
+)
+
+# compute resources applied by apply_compute
+_applied = {"threads": 0, "precision": constants.Precision.FLOAT32.value}
+# threads of the calling thread set by stage_threads
+_local = threading.local()
+# environment and BLAS limits before apply_compute, restored with threads 0
+_defaults: Dict[str, Any] = {
+    "env": {name: os.environ.get(name) for name in THREAD_ENV_VARS},
+    "limits": None,
+}
+
+
+def get_thread_env(threads: int) -> Dict[str, str]:
+    """Get the environment variables capping the threads of the libraries.
+
+    Args:
+        threads: number of threads
+    Returns:
+        dictionary of environment variables
+    """
+    return {name: str(threads) for name in THREAD_ENV_VARS}
+
+
+# serializes the threads starting processes in a capped environment
+_env_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def thread_env(threads: int) -> Iterator[None]:
+    """Cap the threads of the processes started in the context.
+
+    Processes inherit the environment when they start, so the environment
+    variables are set for the context only and restored on exit.
+
+    Args:
+        threads: number of threads of the started processes
+    """
+    with _env_lock:
+        env = get_thread_env(threads)
+        previous = {name: os.environ.get(name) for name in env}
+        os.environ.update(env)
+        try:
+            yield
+        finally:
+            for name, value in previous.items():
+                if value is None:
+                    os.environ.pop(name, None)
+                else:
+                    os.environ[name] = value
+
+
+def get_threads() -> int:
+    """Get the number of threads of the calling thread.
+
+    Returns:
+        number of threads set by stage_threads for the calling thread, else by
+        apply_compute, 0 if the libraries keep their defaults
+    """
+    return getattr(_local, "threads", 0) or _applied["threads"]
+
+
+@contextlib.contextmanager
+def stage_threads(threads: int) -> Iterator[None]:
+    """Cap the threads used by the calling thread in the context.
+
+    Caps numba and the libraries sized with get_threads, such as scipy.fft and
+    the CNN, for a pipeline stage running beside other stages.
+
+    Args:
+        threads: number of threads of the calling thread
+    """
+    previous = getattr(_local, "threads", 0)
+    _local.threads = threads
+    set_numba_threads()
+    try:
+        yield
+    finally:
+        _local.threads = previous
+        set_numba_threads()
+
+
+@contextlib.contextmanager
+def blas_threads(threads: int) -> Iterator[None]:
+    """Cap the BLAS threads of the process in the context.
+
+    Args:
+        threads: number of BLAS threads
+    """
+    if threadpoolctl is None:
+        yield
+        return
+    with threadpoolctl.threadpool_limits(limits=threads):
+        yield
+
+
+def get_precision() -> str:
+    """Get the precision of the CNN inference set by apply_compute.
+
+    Returns:
+        str precision, see constants.Precision
+    """
+    return _applied["precision"]
+
+
+def cap_threads(compute: Any, threads: int):
+    """Cap the threads of a config to the threads available to a worker.
+
+    Args:
+        compute: compute resources of the config, see base_config.Compute
+        threads: number of threads of the worker
+    """
+    if not compute.threads or compute.threads > threads:
+        compute.threads = threads
+
+
+def set_numba_threads():
+    """Set the numba threads of the calling thread to the threads of the config.
+
+    numba keeps its number of threads per thread, so every thread running
+    parallel numba kernels, such as the pipeline stages, calls this first.
+    """
+    if "numba" not in sys.modules:
+        return
+    numba = sys.modules["numba"]
+    threads = numba.config.NUMBA_NUM_THREADS
+    if get_threads():
+        threads = min(get_threads(), threads)
+    numba.set_num_threads(threads)
+
+
+def _restore_defaults():
+    """Restore the environment variables and BLAS threads before apply_compute."""
+    for name, value in _defaults["env"].items():
+        if value is None:
+            os.environ.pop(name, None)
+        else:
+            os.environ[name] = value
+    if _defaults["limits"] is not None:
+        _defaults["limits"].restore_original_limits()
+        _defaults["limits"] = None
+
+
+def apply_compute(compute: Any):
+    """Apply the compute resources of a config to the libraries.
+
+    The numba threads are set for the calling thread only, see set_numba_threads.
+    With 0 threads, the libraries are reset to their defaults, undoing the cap of
+    a subject run before in the same process.
+
+    Args:
+        compute: compute resources of the config, see base_config.Compute
+    """
+    precisions = [precision.value for precision in constants.Precision]
+    if compute.precision not in precisions:
+        raise ValueError(
+            "Invalid precision {}, expected one of {}".format(
+                compute.precision, precisions
+            )
+        )
+    _applied["precision"] = compute.precision
+    threads = int(compute.threads)
+    if threads < 0:
+        raise ValueError("Invalid number of threads {}".format(threads))
+    _applied["threads"] = threads
+    _restore_defaults()
+    set_numba_threads()
+    if not threads:
+        return
+    # read by the executables and by the libraries not started yet
+    os.environ.update(get_thread_env(threads))
+    if threadpoolctl is not None:
+        _defaults["limits"] = threadpoolctl.threadpool_limits(limits=threads)
+    if "tensorflow" in sys.modules:
+        tf = sys.modules["tensorflow"]
+        try:
+            tf.config.threading.set_intra_op_parallelism_threads(threads)
+            tf.config.threading.set_inter_op_parallelism_threads(threads)
+        except RuntimeError:
+            logging.warning(
+                "TensorFlow is already initialized, keeping its thread pools."
+            )
+    logging.info("Using {} threads.".format(threads))
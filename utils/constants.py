@@ -98,6 +98,14 @@ class SegmentationKey(enum.Enum):
     MANUAL_PROTON = "manual_proton"
     SKIP = "skip"
     THRESHOLD_VENT = "threshold_vent"
+    CNN_VENT_QUANTIZED = "cnn_vent_quantized"
+
+
+class ThresholdMethod(enum.Enum):
+    """Threshold of the threshold_vent segmentation."""
+
+    OTSU = "otsu"
+    PERCENTILE = "percentile"
 
 
 class RegistrationKey(enum.Enum):
@@ -119,15 +127,30 @@ class RegistrationKey(enum.Enum):
     SKIP = "skip"
 
 
+class RegistrationEngine(enum.Enum):
+    """Registration engines.
+
+    ANTS: Run the antsRegistration and antsApplyTransforms executables of bin/.
+    NATIVE: Run the in-memory rigid registration of utils/registration_utils.py.
+    """
+
+    ANTS = "ants"
+    NATIVE = "native"
+
+
 class BiasfieldKey(enum.Enum):
     """Biasfield correction flags.
 
     Defines how and if biasfield correction is performed. Options:
     N4ITK: Use N4ITK bias field correction.
+    N4_NATIVE: Use the in-memory implementation of the N4ITK bias field correction.
     SKIP: Skip bias field ocrrection entirely.
+    RF_DEPOLARIZATION: Use the RF-depolarization bias field of the gas images of
+        the first and second halves of the projections.
     """
 
     N4ITK = "n4itk"
+    N4_NATIVE = "n4_native"
     SKIP = "skip"
     RF_DEPOLARIZATION = "rf_depolarization"
 
@@ -409,6 +432,44 @@ class PipelineVersion(object):
     VERSION_NUMBER = 4
 
 
+class Precision(enum.Enum):
+    """Floating point precision of the CNN inference."""
+
+    FLOAT32 = "float32"
+    MIXED_FLOAT16 = "mixed_float16"
+
+
+class Quantization(enum.Enum):
+    """Post-training quantization of the TensorFlow Lite segmentation model."""
+
+    FLOAT16 = "float16"
+    INT8 = "int8"
+
+
+class BatchStatus(enum.Enum):
+    """Status of a subject in a batch run."""
+
+    PENDING = "pending"
+    RUNNING = "running"
+    SUCCESS = "success"
+    FAILED = "failed"
+    TIMEOUT = "timeout"
+    SKIPPED = "skipped"
+
+
+class WorkerDaemon(object):
+    """Protocol of the worker daemon, see worker_daemon.py."""
+
+    SOCKET_PATH = "tmp/gx_worker.sock"
+    ACTION = "action"
+    ACTION_RUN = "run"
+    ACTION_STATUS = "status"
+    ACTION_SHUTDOWN = "shutdown"
+    TYPE = "type"
+    TYPE_LOG = "log"
+    TYPE_RESULT = "result"
+
+
 class ReferenceDistribution(object):
     """Reference distributions for binning based on RF excitation.
 
@@ -0,0 +1,213 @@
+"""Filter util functions of 3-D images.
+
+Box filters and morphology with box structuring elements are separable, so they
+run as a sequence of 1-D filters along the axes, whose cost per voxel does not
+depend on the size of the box. The median filter runs in parallel over the first
+axis with numba.
+"""
+
+from typing import Optional, Sequence, Union
+
+import numpy as np
+from numba import njit, prange
+from scipy import ndimage
+
+Size = Union[int, Sequence[int]]
+
+
+def _get_sizes(size: Size, ndim: int) -> Sequence[int]:
+    """Get the size of a box along each axis.
+
+    Args:
+        size: size of the box, the same along all axes, or along each axis
+        ndim: number of axes
+    Returns:
+        sizes along each axis
+    """
+    if np.isscalar(size):
+        return [int(size)] * ndim  # type: ignore
+    if len(size) != ndim:  # type: ignore
+        raise ValueError("Invalid size {} of a {}-D box".format(size, ndim))
+    return [int(axis_size) for axis_size in size]  # type: ignore
+
+
+def box_filter(image: np.ndarray, size: Size, mode: str = "constant") -> np.ndarray:
+    """Average an image over a box around each voxel.
+
+    Same as ndimage.convolve with a uniform kernel of the size of the box.
+
+    Args:
+        image: image
+        size: size of the box, the same along all axes, or along each axis
+        mode: how the image is extended beyond its borders, see ndimage.
+            Defaults to zeros.
+    Returns:
+        np.ndarray float filtered image, complex for a complex image
+    """
+    if np.iscomplexobj(image):
+        return box_filter(np.real(image), size, mode) + 1j * box_filter(
+            np.imag(image), size, mode
+        )
+    image = np.asarray(image, dtype=float)
+    for axis, axis_size in enumerate(_get_sizes(size, image.ndim)):
+        # an even box extends one more voxel before the voxel than the convolution
+        image = ndimage.uniform_filter1d(
+            image, axis_size, axis=axis, mode=mode, origin=-((axis_size + 1) % 2)
+        )
+    return image
+
+
+def gaussian_filter(
+    image: np.ndarray, sigma: float, truncate: float = 4.0
+) -> np.ndarray:
+    """Smooth an image with a Gaussian kernel, one axis at a time.
+
+    Args:
+        image: image
+        sigma: standard deviation of the kernel in voxels
+        truncate: radius of the kernel in standard deviations
+    Returns:
+        np.ndarray filtered image of the dtype of the image
+    """
+    return ndimage.gaussian_filter(image, sigma=sigma, truncate=truncate)
+
+
+def _apply_box(
+    filter_1d, image: np.ndarray, size: Size, axes: Optional[Sequence[int]], mode: str
+) -> np.ndarray:
+    """Apply a 1-D filter along the axes of an image.
+
+    Args:
+        filter_1d: 1-D minimum or maximum filter of ndimage
+        image: image
+        size: size of the box, the same along all axes, or along each axis
+        axes: axes filtered. Defaults to all axes.
+        mode: how the image is extended beyond its borders, see ndimage
+    Returns:
+        np.ndarray filtered image
+    """
+    axes = list(range(image.ndim)) if axes is None else list(axes)
+    for axis, axis_size in zip(axes, _get_sizes(size, len(axes))):
+        image = filter_1d(image, axis_size, axis=axis, mode=mode)
+    return image
+
+
+def dilate(
+    image: np.ndarray,
+    size: Size,
+    axes: Optional[Sequence[int]] = None,
+    mode: str = "constant",
+) -> np.ndarray:
+    """Dilate an image with a box, the maximum over a box around each voxel.
+
+    Args:
+        image: image, binary images are dilated as uint8
+        size: size of the box, the same along all axes, or along each axis
+        axes: axes of the box, e.g. (0, 1) to dilate slice by slice. Defaults to
+            all axes.
+        mode: how the image is extended beyond its borders, see ndimage. Defaults
+            to zeros, "nearest" ignores the voxels beyond the borders.
+    Returns:
+        np.ndarray dilated image of the dtype of the image
+    """
+    image = np.asarray(image)
+    if image.dtype == bool:
+        return dilate(image.view(np.uint8), size, axes, mode).view(bool)
+    return _apply_box(ndimage.maximum_filter1d, image, size, axes, mode)
+
+
+def erode(
+    image: np.ndarray,
+    size: Size,
+    axes: Optional[Sequence[int]] = None,
+    mode: str = "constant",
+) -> np.ndarray:
+    """Erode an image with a box, the minimum over a box around each voxel.
+
+    Args:
+        image: image, binary images are eroded as uint8
+        size: size of the box, the same along all axes, or along each axis
+        axes: axes of the box, e.g. (0, 1) to erode slice by slice. Defaults to
+            all axes.
+        mode: how the image is extended beyond its borders, see ndimage. Defaults
+            to zeros, "nearest" ignores the voxels beyond the borders.
+    Returns:
+        np.ndarray eroded image of the dtype of the image
+    """
+    image = np.asarray(image)
+    if image.dtype == bool:
+        return erode(image.view(np.uint8), size, axes, mode).view(bool)
+    return _apply_box(ndimage.minimum_filter1d, image, size, axes, mode)
+
+
+@njit(parallel=True, nogil=True, cache=True)
+def _median_filter(padded: np.ndarray, size: int, output: np.ndarray):
+    """Median filter of a padded 3-D image, in parallel over the first axis.
+
+    The window of a voxel is made of the planes of size x size values at the
+    positions of the window along the last axis. Each plane is sorted once and
+    shared by the windows of the row that contain it, and the median of a window
+    is found by merging its sorted planes up to the middle rank.
+
+    Args:
+        padded: image padded by size // 2 voxels along each axis
+        size: size of the cubic window, odd
+        output: filtered image of the shape of the image before padding
+    """
+    n_x, n_y, n_z = output.shape
+    n_plane = size * size
+    rank = size * n_plane // 2
+    for i in prange(n_x):
+        # sorted planes, followed by enough infinite values that a head never
+        # passes the end of its plane, even when heads tie
+        planes = np.full((n_z + size - 1, n_plane + rank), np.inf)
+        heads = np.empty(size, dtype=np.int64)
+        for j in range(n_y):
+            for z in range(n_z + size - 1):
+                # insertion sort of the plane
+                n = 0
+                for di in range(size):
+                    for dj in range(size):
+                        value = padded[i + di, j + dj, z]
+                        m = n
+                        while m > 0 and planes[z, m - 1] > value:
+                            planes[z, m] = planes[z, m - 1]
+                            m -= 1
+                        planes[z, m] = value
+                        n += 1
+            for k in range(n_z):
+                heads[:] = 0
+                for _ in range(rank):
+                    # pass the smallest head of the planes of the window
+                    best = 0
+                    for dk in range(1, size):
+                        if planes[k + dk, heads[dk]] < planes[k + best, heads[best]]:
+                            best = dk
+                    heads[best] += 1
+                value = planes[k, heads[0]]
+                for dk in range(1, size):
+                    value = min(value, planes[k + dk, heads[dk]])
+                output[i, j, k] = value
+
+
+def median_filter(image: np.ndarray, size: int = 3) -> np.ndarray:
+    """Apply a median filter over a cube around each voxel of a 3-D image.
+
+    Same as scipy.signal.medfilt, the image is extended with zeros beyond its
+    borders. NaN values are ordered as infinite values.
+
+    Args:
+        image: 3-D image
+        size: size of the cubic window, odd
+    Returns:
+        np.ndarray float filtered image
+    """
+    if size < 1 or size % 2 == 0:
+        raise ValueError("Invalid median filter size {}".format(size))
+    image = np.asarray(image, dtype=float)
+    if image.ndim != 3:
+        raise ValueError("Invalid {}-D image of the median filter".format(image.ndim))
+    output = np.empty(image.shape)
+    padded = np.pad(np.where(np.isnan(image), np.inf, image), size // 2)
+    _median_filter(padded, size, output)
+    return output
@@ -1,21 +1,16 @@
 """Miscellaneous util functions mostly image processing."""
 
-import os
 import sys
 
-import cv2 as cv
-
 sys.path.append("..")
 from typing import Any, List, Optional, Tuple
 
-import matplotlib
-
-matplotlib.use("TkAgg")
 import numpy as np
-import skimage
 from scipy import ndimage
 
-from utils import constants, io_utils
+from utils import bspline_utils, constants, filter_utils, lazy_import
+
+skimage = lazy_import.lazy_module("skimage")
 
 
 def remove_small_objects(mask: np.ndarray, scale: float = 0.1):
@@ -133,7 +128,7 @@ def standardize_image(image: np.ndarray) -> np.ndarray:
 def erode_image(image: np.ndarray, erosion: int) -> np.ndarray:
     """Erode image.
 
-    Erodes image slice by slice.
+    Erodes image slice by slice, the voxels beyond the borders are ignored.
 
     Args:
         image (np.ndarray): 3-D image to erode.
@@ -141,9 +136,7 @@ def erode_image(image: np.ndarray, erosion: int) -> np.ndarray:
     Returns:
         Eroded image.
     """
-    kernel = np.ones((erosion, erosion), np.uint8)
-    for i in range(image.shape[2]):
-        image[:, :, i] = cv.erode(image[:, :, i], kernel, iterations=1)
+    image[...] = filter_utils.erode(image, erosion, axes=(0, 1), mode="nearest")
     return image
 
 
@@ -178,8 +171,7 @@ def smooth_image(image: np.ndarray, kernel: int = 11) -> np.ndarray:
         image (np.ndarray): 3D image to smooth.
         kernel (int, optional): size of the kernel. Defaults to 11.
     """
-    kernel = np.ones((kernel, kernel, kernel)) / (kernel**3)  # type: ignore
-    return ndimage.convolve(image, kernel, mode="constant")
+    return filter_utils.box_filter(image, kernel, mode="constant")
 
 
 def interp(img: np.ndarray, factor: int = 1):
@@ -332,32 +324,27 @@ def calculate_rbc_oscillation(
 
 
 def approximate_image_with_bspline(
-    image: np.ndarray, mask: Optional[np.ndarray] = None
+    image: np.ndarray,
+    mask: Optional[np.ndarray] = None,
+    order: int = 3,
+    n_levels: int = 4,
+    n_spans: int = 1,
 ) -> np.ndarray:
     """Approximate image with B-spline.
 
+    Multilevel B-spline approximation in memory, with the parameters of the
+    ApproximateImageWithBSplines call it replaces, see bspline_utils.approximate.
+
     Args:
         image (np.ndarray): image to approximate.
         mask (np.ndarray, optional): mask of the image. Defaults to None.
+        order (int): order of the B-spline. Defaults to 3.
+        n_levels (int): number of levels. Defaults to 4.
+        n_spans (int): number of spans along each axis at the first level.
+            Defaults to 1.
     Returns:
         Approximated image
     """
-    current_path = os.path.dirname(__file__)
-    tmp_path = os.path.abspath(os.path.join(current_path, "..", "tmp"))
-    bin_path = os.path.abspath(os.path.join(current_path, "..", "bin"))
-    pathInput = os.path.join(tmp_path, "image.nii")
-    pathOutput = os.path.join(tmp_path, "bspline.nii")
-    pathMask = os.path.join(tmp_path, "mask.nii")
-    pathExec = bin_path + "/ApproximateImageWithBSplines"
-    # save the inputs into nii files so the executable can read in
-    io_utils.export_nii(image, pathInput)
-    if isinstance(mask, np.ndarray):
-        io_utils.export_nii(mask.astype(float), pathMask)  # type: ignore
-    # command string
-    cmd = pathExec + " 3 " + pathInput + " " + pathOutput + " 3 4 1 "
-    if isinstance(mask, np.ndarray):
-        cmd = cmd + pathMask
-    # registration command
-    os.system(cmd)
-    # read in the output
-    return io_utils.import_nii(pathOutput)
+    return bspline_utils.approximate(
+        image, mask, order=order, n_levels=n_levels, n_spans=n_spans
+    )
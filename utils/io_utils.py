@@ -6,9 +6,16 @@ import sys
 sys.path.append("..")
 import csv
 import glob
+import logging
 import shutil
-from typing import Any, Dict, List, Optional, Tuple
-
+import subprocess
+from collections import OrderedDict
+from concurrent import futures
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import h5py
 import ismrmrd
 import mapvbvd
 import nibabel as nib
@@ -17,8 +24,36 @@ import pandas as pd
 import pydicom
 import scipy.io as sio
 from ml_collections import config_dict
-
-from utils import constants, img_utils, mrd_utils, twix_utils
+from scipy import ndimage
+
+from utils import compute_utils, constants, mrd_utils, twix_utils
+
+# decoded DICOM volumes keyed by series instance UID and file stats
+_DICOM_CACHE: "OrderedDict[Tuple[Any, ...], np.ndarray]" = OrderedDict()
+_DICOM_CACHE_SIZE = 4
+
+# background writer pool for output files
+EXPORT_WORKERS = 4
+NII_COMPRESSION_THREADS = 4
+_EXPORT_EXECUTOR: Optional[ThreadPoolExecutor] = None
+
+# MATLAB v7.3 (HDF5) mat files
+MAT73_USERBLOCK_SIZE = 512
+H5_COMPRESSION_MIN_SIZE = 1024
+H5_TYPE_ATTR = "python_type"
+MATLAB_CLASSES = {
+    "bool": "logical",
+    "float64": "double",
+    "float32": "single",
+    "int8": "int8",
+    "int16": "int16",
+    "int32": "int32",
+    "int64": "int64",
+    "uint8": "uint8",
+    "uint16": "uint16",
+    "uint32": "uint32",
+    "uint64": "uint64",
+}
 
 
 def import_np(path: str) -> np.ndarray:
@@ -192,6 +227,54 @@ def get_mat_file(path: str) -> str:
         raise ValueError("Can't find mat file in path.")
 
 
+def read_dis_twix_header(path: str) -> Dict[str, Any]:
+    """Read the header of a 1-point dixon dissolved phase imaging twix file.
+
+    Only the header is parsed, the FIDs are not read.
+
+    Args:
+        path: str file path of twix file
+    Returns: dictionary containing the scan date in YYYY-MM-DD format, the
+        protocol name, the institution name, the system vendor and the field
+        strength in Tesla.
+    """
+    try:
+        twix_obj = mapvbvd.mapVBVD(path)
+    except:
+        raise ValueError("Invalid twix file.")
+    return {
+        constants.IOFields.SCAN_DATE: twix_utils.get_scan_date(twix_obj),
+        constants.IOFields.PROTOCOL_NAME: twix_utils.get_protocol_name(twix_obj),
+        constants.IOFields.INSTITUTION: twix_utils.get_institution_name(twix_obj),
+        constants.IOFields.SYSTEM_VENDOR: twix_utils.get_system_vendor(twix_obj),
+        constants.IOFields.FIELD_STRENGTH: twix_utils.get_field_strength(twix_obj),
+    }
+
+
+def read_dis_mrd_header(path: str) -> Dict[str, Any]:
+    """Read the header of a 1-point dixon dissolved phase imaging mrd file.
+
+    Args:
+        path: str file path of mrd file
+    Returns: dictionary containing the subject id, the scan date in YYYY-MM-DD
+        format, the protocol name, the institution name, the system vendor and
+        the field strength in Tesla.
+    """
+    try:
+        dataset = ismrmrd.Dataset(path, "dataset", create_if_needed=False)
+        header = ismrmrd.xsd.CreateFromDocument(dataset.read_xml_header())
+    except:
+        raise ValueError("Invalid mrd file.")
+    return {
+        constants.IOFields.SUBJECT_ID: mrd_utils.get_subject_id(header),
+        constants.IOFields.SCAN_DATE: mrd_utils.get_scan_date(header),
+        constants.IOFields.PROTOCOL_NAME: mrd_utils.get_protocol_name(header),
+        constants.IOFields.INSTITUTION: mrd_utils.get_institution_name(header),
+        constants.IOFields.SYSTEM_VENDOR: mrd_utils.get_system_vendor(header),
+        constants.IOFields.FIELD_STRENGTH: mrd_utils.get_field_strength(header),
+    }
+
+
 def read_dyn_twix(path: str) -> Dict[str, Any]:
     """Read dynamic spectroscopy twix file.
 
@@ -480,6 +563,87 @@ def read_ute_mrd(path: str) -> Dict[str, Any]:
     }
 
 
+def _read_dicom_header(path: str) -> Any:
+    """Read the header of a DICOM file without its pixel data.
+
+    Args:
+        path (str): path to DICOM file
+    Returns:
+        pydicom dataset without pixel data.
+    """
+    return pydicom.dcmread(path, stop_before_pixels=True)
+
+
+def _get_dicom_dtype(header: Any) -> np.dtype:
+    """Get the native numpy dtype of the stored DICOM pixel data.
+
+    Args:
+        header: pydicom dataset
+    Returns:
+        numpy dtype matching BitsAllocated and PixelRepresentation.
+    """
+    bits = int(header.BitsAllocated)
+    signed = int(getattr(header, "PixelRepresentation", 0)) == 1
+    return np.dtype("{}{}".format("int" if signed else "uint", bits))
+
+
+def read_dicom_series(path: str, n_workers: int = 8) -> np.ndarray:
+    """Read a DICOM series in a directory as a numpy array of the native dtype.
+
+    Headers are read once without pixel data to order the slices by instance
+    number. Pixel data is then decoded in a thread pool directly into a
+    preallocated array. Decoded volumes are cached by series instance UID and by
+    the path, size and modification time of the files, so that a series whose
+    files are replaced is read again.
+
+    Args:
+        path (str): path to directory of DICOM slices
+        n_workers (int): number of threads used to read and decode the slices
+    Returns:
+        np.ndarray: volume of shape (rows, columns, n_slices).
+    """
+    files = [
+        os.path.join(path, f)
+        for f in sorted(os.listdir(path))
+        if not f.startswith(".") and os.path.isfile(os.path.join(path, f))
+    ]
+    if not files:
+        raise ValueError("Can't find DICOM files in path.")
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        headers = list(executor.map(_read_dicom_header, files))
+
+    series_uid = str(getattr(headers[0], "SeriesInstanceUID", os.path.abspath(path)))
+    file_stats = []
+    for file in files:
+        stat = os.stat(file)
+        file_stats.append((os.path.abspath(file), stat.st_size, stat.st_mtime_ns))
+    key = (series_uid, tuple(file_stats))
+    if key in _DICOM_CACHE:
+        _DICOM_CACHE.move_to_end(key)
+        return _DICOM_CACHE[key]
+
+    # order slices by instance number, fall back to file name order
+    order = sorted(
+        range(len(files)),
+        key=lambda i: int(getattr(headers[i], "InstanceNumber", i + 1) or i + 1),
+    )
+    volume = np.empty(
+        (int(headers[0].Rows), int(headers[0].Columns), len(files)),
+        dtype=_get_dicom_dtype(headers[0]),
+    )
+
+    def decode_slice(index: int):
+        volume[:, :, index] = pydicom.dcmread(files[order[index]]).pixel_array
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        list(executor.map(decode_slice, range(len(files))))
+
+    _DICOM_CACHE[key] = volume
+    if len(_DICOM_CACHE) > _DICOM_CACHE_SIZE:
+        _DICOM_CACHE.popitem(last=False)
+    return volume
+
+
 def read_dicom(path: str, shape_gas: Tuple[int, int, int]) -> np.ndarray:
     """Read in DICOM image as numpy array.
 
@@ -490,37 +654,33 @@ def read_dicom(path: str, shape_gas: Tuple[int, int, int]) -> np.ndarray:
     Returns:
         np.ndarray: numpy array from DICOM image.
     """
-    files = os.listdir(path)
-    file1 = os.path.join(path, files[0])
-    RefDs = pydicom.dcmread(file1)
-    ConstPixelDims = (int(RefDs.Columns), int(RefDs.Rows), len(files))
-    dicom = np.zeros(ConstPixelDims)
-
-    for i in range(0, len(files)):
-        if files[i] == ".DS_Store":
-            continue
-        file_with_path = os.path.join(path, files[i])
-        RefDs = pydicom.dcmread(file_with_path)
-        slice_num = int(RefDs.InstanceNumber)
-        ds = pydicom.read_file(file_with_path)
-        dicom[:, :, slice_num - 1] = ds.pixel_array
-
-    image = dicom.astype("float64")
+    image = read_dicom_series(path).astype("float32")
 
     if image.shape[0] != shape_gas[0]:
-        image = img_utils.interp(image, shape_gas[0] / image.shape[0])
+        image = ndimage.zoom(image, shape_gas[0] / image.shape[0])
 
     return image
 
 
-def export_nii(image: np.ndarray, path: str, fov: Optional[float] = None):
+def export_nii(
+    image: np.ndarray,
+    path: str,
+    fov: Optional[float] = None,
+    dtype: Optional[str] = None,
+):
     """Export image as nifti file.
 
+    If the path ends with .gz, the file is compressed with pigz if available and
+    gzip otherwise.
+
     Args:
         image: np.ndarray 3D image to be exported
         path: str file path of nifti file
         fov: float field of view in cm
+        dtype: data type of the exported image. Defaults to the image data type.
     """
+    if dtype:
+        image = np.asarray(image, dtype=dtype)
     nii_imge = nib.Nifti1Image(image, np.eye(4))
     if fov:
         nii_imge.header["pixdim"][1:4] = [
@@ -528,7 +688,7 @@ def export_nii(image: np.ndarray, path: str, fov: Optional[float] = None):
             fov / np.shape(image)[0] / 10,
             fov / np.shape(image)[0] / 10,
         ]
-    nib.save(nii_imge, path)
+    _save_nii(nii_imge, path)
 
 
 def export_nii_4d(image, path, fov=None):
@@ -539,18 +699,21 @@ def export_nii_4d(image, path, fov=None):
         path: str file path of nifti file
         fov: float field of view in cm
     """
-    color = (np.copy(image) * 255).astype("uint8")  # need uint8 to save to RGB
-    # some fancy and tricky re-arrange
-    color = np.transpose(color, [2, 3, 0, 1])
-    cline = np.reshape(color, (1, np.size(color)))
-    color = np.reshape(cline, np.shape(image), order="A")
-    color = np.transpose(color, [2, 1, 0, 3])
-    # stake the RGB channels
+    # scale to uint8 (needed to save to RGB) while reading in (z, rgb, x, y) order
+    color = np.empty(
+        (image.shape[2], image.shape[3], image.shape[0], image.shape[1]), dtype="uint8"
+    )
+    np.multiply(np.transpose(image, [2, 3, 0, 1]), 255, out=color, casting="unsafe")
+    # some fancy and tricky re-arrange: reinterpret as (x,y,z,rgb) and swap x and z,
+    # written once into the stacked RGB channels
     shape_3d = image.shape[0:3]
     rgb_dtype = np.dtype([("R", "u1"), ("G", "u1"), ("B", "u1")])
-    nii_data = (
-        color.copy().view(dtype=rgb_dtype).reshape(shape_3d)
-    )  # copy used to force fresh internal structure
+    nii_data = np.empty(shape_3d[::-1], dtype=rgb_dtype)
+    np.copyto(
+        nii_data.view("u1").reshape(nii_data.shape + (3,)),
+        np.transpose(np.reshape(color, np.shape(image)), [2, 1, 0, 3]),
+    )
+    nii_data = nii_data.reshape(shape_3d)
 
     # write voxel dimensions to nifti header if available
     nii_imge = nib.Nifti1Image(nii_data, np.eye(4))
@@ -560,17 +723,337 @@ def export_nii_4d(image, path, fov=None):
             fov / np.shape(image)[0] / 10,
             fov / np.shape(image)[0] / 10,
         ]
-    nib.save(nii_imge, path)
+    _save_nii(nii_imge, path)
+
+
+def _save_nii(nii_imge: nib.Nifti1Image, path: str):
+    """Save nifti image, compressing with pigz if the path ends with .gz.
+
+    Args:
+        nii_imge: nifti image
+        path: str file path of nifti file
+    """
+    pigz = shutil.which("pigz")
+    if not path.endswith(".gz") or not pigz:
+        nib.save(nii_imge, path)
+        return
+    nib.save(nii_imge, path[: -len(".gz")])
+    subprocess.run(
+        [
+            pigz,
+            "-f",
+            "-p",
+            str(compute_utils.get_threads() or NII_COMPRESSION_THREADS),
+            path[: -len(".gz")],
+        ],
+        check=True,
+    )
+
+
+def submit_export(function: Callable[..., Any], *args: Any, **kwargs: Any) -> Future:
+    """Run an export function in the background writer pool.
+
+    Args:
+        function: export function, e.g. export_nii
+        args: positional arguments of the function
+        kwargs: keyword arguments of the function
+    Returns:
+        future of the export
+    """
+    global _EXPORT_EXECUTOR
+    if _EXPORT_EXECUTOR is None:
+        _EXPORT_EXECUTOR = ThreadPoolExecutor(
+            max_workers=EXPORT_WORKERS, thread_name_prefix="export"
+        )
+    return _EXPORT_EXECUTOR.submit(function, *args, **kwargs)
+
+
+def wait_for_exports(exports: Sequence[Future]):
+    """Wait for background exports to finish.
+
+    All the exports finish before any error is raised, so that no writer is
+    left running, e.g. in a workspace about to be removed.
+
+    Args:
+        exports: futures of the exports, see submit_export
+    Raises:
+        the error of the export if a single export failed, or a RuntimeError
+        listing the errors if several failed
+    """
+    futures.wait(exports)
+    errors = [future.exception() for future in exports if future.exception()]
+    for error in errors:
+        logging.error("Background export failed: {}".format(error))
+    if len(errors) == 1:
+        raise errors[0]  # type: ignore
+    elif errors:
+        raise RuntimeError(
+            "{} background exports failed: {}".format(
+                len(errors), "; ".join(str(error) for error in errors)
+            )
+        ) from errors[0]
+
+
+def _get_mat73_header() -> bytes:
+    """Get the 512 byte user block identifying a MATLAB v7.3 mat file."""
+    text = (
+        "MATLAB 7.3 MAT-file, Platform: {}, Created on: {} HDF5 schema 1.00 .".format(
+            sys.platform, datetime.now().strftime("%a %b %d %H:%M:%S %Y")
+        )
+    )
+    header = text.encode("ascii").ljust(116, b" ") + b"\x00" * 8 + b"\x00\x02IM"
+    return header.ljust(MAT73_USERBLOCK_SIZE, b"\x00")
+
+
+def _write_h5_value(
+    group: h5py.Group, key: str, value: Any, compression: Optional[str]
+):
+    """Write a value to a HDF5 group following the MATLAB v7.3 conventions.
+
+    Arrays are written as one dataset each, dictionaries as groups (MATLAB
+    structs) and strings as uint16 character arrays. Arrays are written in numpy
+    (row-major) order, so MATLAB sees them with their dimensions reversed.
 
+    Args:
+        group: h5py group to write to
+        key: name of the dataset or group
+        value: value to write
+        compression: HDF5 compression filter for arrays, or None
+    """
+    if isinstance(value, dict):
+        subgroup = group.create_group(key)
+        subgroup.attrs["MATLAB_class"] = np.bytes_("struct")
+        for subkey, subvalue in value.items():
+            _write_h5_value(subgroup, str(subkey), subvalue, compression)
+        return
+    if value is None:
+        dataset = group.create_dataset(key, data=np.zeros(2, dtype="uint64"))
+        dataset.attrs["MATLAB_class"] = np.bytes_("double")
+        dataset.attrs["MATLAB_empty"] = np.uint8(1)
+        dataset.attrs[H5_TYPE_ATTR] = np.bytes_("none")
+        return
+    if isinstance(value, str):
+        data = np.frombuffer(value.encode("utf-16-le"), dtype="uint16")
+        dataset = group.create_dataset(key, data=data.reshape(-1, 1))
+        dataset.attrs["MATLAB_class"] = np.bytes_("char")
+        dataset.attrs["MATLAB_int_decode"] = np.int32(2)
+        dataset.attrs[H5_TYPE_ATTR] = np.bytes_("str")
+        return
+
+    python_type = None
+    if isinstance(value, (tuple, list)):
+        python_type = type(value).__name__
+    elif np.ndim(value) == 0:
+        python_type = "scalar"
+    data = np.asarray(value)
+    if data.dtype == object or data.dtype.kind in ("U", "S", "V"):
+        logging.debug("Skipping %s: cannot write %s to mat file.", key, data.dtype)
+        return
+    if data.ndim == 1 and python_type is None:
+        python_type = "vector"
+
+    matlab_class = MATLAB_CLASSES.get(data.dtype.name)
+    if data.dtype == bool:
+        data = data.astype("uint8")
+    elif np.iscomplexobj(data):
+        matlab_class = "double" if data.dtype == np.complex128 else "single"
+        part = data.real.dtype
+        data = np.ascontiguousarray(data).view([("real", part), ("imag", part)])
+    if data.ndim < 2:
+        data = data.reshape(-1, 1)
+    if compression and data.size >= H5_COMPRESSION_MIN_SIZE:
+        dataset = group.create_dataset(
+            key, data=data, chunks=True, compression=compression, shuffle=True
+        )
+    else:
+        dataset = group.create_dataset(key, data=data)
+    if matlab_class:
+        dataset.attrs["MATLAB_class"] = np.bytes_(matlab_class)
+    if matlab_class == "logical":
+        dataset.attrs["MATLAB_int_decode"] = np.int32(1)
+    if python_type:
+        dataset.attrs[H5_TYPE_ATTR] = np.bytes_(python_type)
+
+
+def export_h5(
+    mdict: Dict[str, Any],
+    path: str,
+    compression: Optional[str] = "gzip",
+    contiguous: Sequence[str] = (),
+):
+    """Export a dictionary of variables to a MATLAB v7.3 (HDF5) mat file.
+
+    Every array is written to its own dataset and every dictionary to a group,
+    so that the file can be read back lazily with import_subject_h5.
 
-def export_subject_mat(subject: object, path: str):
-    """Export select subject instance variables to mat file.
+    Args:
+        mdict: dictionary of variable names and values
+        path: str file path of mat file
+        compression: HDF5 compression filter for arrays, or None to write
+            contiguous datasets that can be memory-mapped on read.
+        contiguous: names of variables written as contiguous datasets
+            regardless of the compression.
+    """
+    with h5py.File(path, "w", userblock_size=MAT73_USERBLOCK_SIZE) as f:
+        for key, value in mdict.items():
+            _write_h5_value(
+                f, key, value, None if key in contiguous else compression
+            )
+    with open(path, "r+b") as f:
+        f.write(_get_mat73_header())
+
+
+def export_subject_h5(
+    subject: object,
+    path: str,
+    fields: Optional[Sequence[str]] = None,
+    contiguous: Sequence[str] = (),
+    compression: Optional[str] = "gzip",
+    exclude: Tuple[str, ...] = ("config", "workspace"),
+):
+    """Export subject instance variables to a MATLAB v7.3 (HDF5) mat file.
+
+    Arrays are compressed, except the contiguous ones, which reading the file in
+    memory-maps instead of decompressing.
 
     Args:
         subject: subject instance
         path: str file path of mat file
+        fields: names of instance variables to export, or None to export all of
+            them along with the config as a json string.
+        contiguous: names of instance variables written as contiguous datasets
+        compression: HDF5 compression filter for the other arrays, or None
+        exclude: names of instance variables not to export
+    """
+    if fields is None:
+        mdict = {
+            key: value
+            for key, value in vars(subject).items()
+            if key not in exclude and not key.startswith("_")
+        }
+        if hasattr(subject, "config") and hasattr(
+            subject.config, "to_json_best_effort"
+        ):
+            mdict["config_json"] = subject.config.to_json_best_effort()
+    else:
+        mdict = {
+            key: getattr(subject, key)
+            for key in fields
+            if key not in exclude and hasattr(subject, key)
+        }
+    export_h5(mdict, path, compression, contiguous)
+
+
+def is_h5_mat(path: str) -> bool:
+    """Check if a mat file is a MATLAB v7.3 (HDF5) file.
+
+    Args:
+        path: str file path of mat file
+    Returns:
+        True if the file is HDF5 based.
+    """
+    return h5py.is_hdf5(path)
+
+
+class H5Checkpoint(object):
+    """Read-only lazy view of a MATLAB v7.3 mat file written by export_subject_h5.
+
+    Datasets are only read from disk when accessed. Contiguous (uncompressed)
+    datasets, real or complex, are memory-mapped copy-on-write instead of being
+    read.
+
+    Attributes:
+        path (str): file path of mat file
+    """
+
+    def __init__(self, path: str):
+        """Open the file.
+
+        Args:
+            path (str): file path of mat file
+        """
+        self.path = path
+        self._file = h5py.File(path, "r")
+
+    def __enter__(self) -> "H5Checkpoint":
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._file
+
+    def __getitem__(self, key: str) -> Any:
+        return self._read(self._file[key])
+
+    def keys(self) -> List[str]:
+        """Get the names of the stored variables."""
+        return list(self._file.keys())
+
+    def close(self):
+        """Close the file."""
+        self._file.close()
+
+    def _read(self, node: Any) -> Any:
+        """Read a dataset or group into the matching python object."""
+        if isinstance(node, h5py.Group):
+            return {key: self._read(node[key]) for key in node.keys()}
+        python_type = _decode_attr(node.attrs.get(H5_TYPE_ATTR, b""))
+        if python_type == "none":
+            return None
+        if python_type == "str":
+            return node[()].astype("uint16").tobytes().decode("utf-16-le")
+        data = self._read_array(node)
+        if _decode_attr(node.attrs.get("MATLAB_class", b"")) == "logical":
+            data = data.astype(bool)
+        if python_type == "scalar":
+            return data.reshape(-1)[0].item()
+        elif python_type == "vector":
+            return data.reshape(-1)
+        elif python_type in ("tuple", "list"):
+            values = data.reshape(-1).tolist() if data.shape[-1] == 1 else data.tolist()
+            return tuple(values) if python_type == "tuple" else values
+        return data
+
+    def _read_array(self, dataset: h5py.Dataset) -> np.ndarray:
+        """Read or memory-map a dataset."""
+        offset = dataset.id.get_offset()
+        dtype = dataset.dtype
+        if dtype.names == ("real", "imag") and dtype["real"] == dtype["imag"]:
+            # the compound of two floats has the layout of the complex type
+            dtype = np.result_type(dtype["real"], np.complex64)
+            if dtype.itemsize != dataset.dtype.itemsize:
+                dtype = dataset.dtype
+        if (
+            offset is not None
+            and dataset.chunks is None
+            and dtype.names is None
+            and dataset.size >= H5_COMPRESSION_MIN_SIZE
+        ):
+            return np.memmap(
+                self.path, dtype=dtype, mode="c", offset=offset, shape=dataset.shape
+            )
+        data = dataset[()]
+        if data.dtype.names == ("real", "imag"):
+            data = data["real"] + 1j * data["imag"]
+        return data
+
+
+def _decode_attr(value: Any) -> str:
+    """Decode a HDF5 string attribute."""
+    return value.decode() if isinstance(value, bytes) else str(value)
+
+
+def import_subject_h5(path: str) -> H5Checkpoint:
+    """Import a MATLAB v7.3 mat file written by export_subject_h5 lazily.
+
+    Args:
+        path: str file path of mat file
+    Returns:
+        Lazy mapping from variable names to values.
     """
-    sio.savemat(path, vars(subject))
+    return H5Checkpoint(path)
 
 
 def export_np(arr: np.ndarray, path: str):
@@ -0,0 +1,125 @@
+"""Lazy import of heavy dependencies.
+
+TensorFlow, matplotlib, scikit-image and the report dependencies take seconds
+to import and are only needed by some stages of the pipeline. Modules bind them
+at import time with lazy_module, and the dependency is imported on the first
+attribute access, that is when a stage first uses it:
+
+    skimage_filters = lazy_import.lazy_module("skimage.filters")
+    plt = lazy_import.lazy_module("matplotlib.pyplot", lazy_import.use_headless_backend)
+"""
+
+import importlib
+import os
+import sys
+import threading
+import types
+from typing import Any, Callable, List, Optional
+
+# the backend used unless the MPLBACKEND environment variable is set
+HEADLESS_BACKEND = "Agg"
+
+
+class LazyModule(types.ModuleType):
+    """Module imported on the first attribute access.
+
+    Attributes:
+        name (str): full name of the module
+        before_import (callable): function called once before importing the
+            module, or None
+    """
+
+    def __init__(self, name: str, before_import: Optional[Callable[[], Any]] = None):
+        """Init object."""
+        super().__init__(name)
+        self.__dict__["_before_import"] = before_import
+        self.__dict__["_module"] = None
+        self.__dict__["_lock"] = threading.Lock()
+
+    def _load(self) -> types.ModuleType:
+        """Import the module if it is not imported yet.
+
+        Returns:
+            the imported module
+        """
+        module = self.__dict__["_module"]
+        if module is None:
+            # stages running concurrently may use the module at the same time
+            with self.__dict__["_lock"]:
+                module = self.__dict__["_module"]
+                if module is None:
+                    if self.__dict__["_before_import"] is not None:
+                        self.__dict__["_before_import"]()
+                    module = importlib.import_module(self.__name__)
+                    self.__dict__["_module"] = module
+        return module
+
+    def __getattr__(self, name: str) -> Any:
+        """Get an attribute of the module, importing it first."""
+        return getattr(self._load(), name)
+
+    def __dir__(self) -> List[str]:
+        """List the attributes of the module, importing it first."""
+        return dir(self._load())
+
+    def __repr__(self) -> str:
+        """Represent the module without importing it."""
+        state = "imported" if self.__dict__["_module"] is not None else "not imported"
+        return "<lazy module '{}' ({})>".format(self.__name__, state)
+
+
+def lazy_module(
+    name: str, before_import: Optional[Callable[[], Any]] = None
+) -> types.ModuleType:
+    """Get a module that is imported on the first attribute access.
+
+    If the module is already imported, it is returned as is.
+
+    Args:
+        name: full name of the module, such as "matplotlib.pyplot"
+        before_import: function called once before importing the module
+    Returns:
+        the module or a lazy module standing for it
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    return LazyModule(name, before_import)
+
+
+def load(module: types.ModuleType) -> types.ModuleType:
+    """Import a lazy module now.
+
+    Args:
+        module: module or lazy module
+    Returns:
+        the imported module
+    """
+    if isinstance(module, LazyModule):
+        return module._load()
+    return module
+
+
+def is_imported(name: str) -> bool:
+    """Check whether a module is imported.
+
+    Args:
+        name: full name of the module
+    Returns:
+        True if the module is imported
+    """
+    return name in sys.modules
+
+
+def use_headless_backend():
+    """Select a matplotlib backend that does not need a display.
+
+    Figures are only saved to files, so the Agg backend is used, which also works
+    on cluster nodes and in the worker daemon. Setting the MPLBACKEND environment
+    variable selects another backend, for instance to show the spectroscopy fit
+    interactively.
+    """
+    if os.environ.get("MPLBACKEND"):
+        return
+    import matplotlib
+
+    matplotlib.use(HEADLESS_BACKEND)
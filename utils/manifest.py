@@ -0,0 +1,151 @@
+"""Batch manifest util functions.
+
+The manifest of a cohort is a json file recording, for every subject config, the
+status, runtime and output files of its last batch run together with a key
+hashing the config, the input files and the pipeline version. A subject whose
+last run succeeded with the same key is up to date and is skipped on reruns.
+"""
+
+import datetime
+import glob
+import json
+import logging
+import os
+import sys
+import tempfile
+from typing import Any, Dict, List
+
+sys.path.append("..")
+from utils import cache_utils, constants
+
+MANIFEST_DIR = "data/manifests"
+
+
+def get_manifest_path(cohort: str) -> str:
+    """Get the default manifest path of a cohort.
+
+    Args:
+        cohort: name of the cohort
+    Returns:
+        str path of the manifest file
+    """
+    return os.path.join(MANIFEST_DIR, "{}.json".format(cohort))
+
+
+def get_input_files(config: Any) -> List[str]:
+    """Get the paths of the files read by the pipeline for a subject.
+
+    Args:
+        config: config of the subject
+    Returns:
+        list of file paths
+    """
+    data_dir = str(config.data_dir)
+    paths = []
+    for pattern in ("*.dat", "*.h5", "*.mat"):
+        paths += glob.glob(os.path.join(data_dir, pattern))
+    paths += glob.glob(str(config.manual_seg_filepath))
+    paths += glob.glob(str(config.manual_reg_filepath))
+    if config.dicom_proton_dir:
+        paths += glob.glob(os.path.join(str(config.dicom_proton_dir), "*"))
+    return paths
+
+
+def get_key(config: Any, mode: str, force_segmentation: bool) -> str:
+    """Get the key identifying the inputs of a subject run.
+
+    The key changes whenever the config, the input files, the pipeline mode or
+    the pipeline version change.
+
+    Args:
+        config: config of the subject
+        mode: pipeline mode, see batch.run_subject
+        force_segmentation: whether segmentation is run again when reading in
+    Returns:
+        str hex digest
+    """
+    return cache_utils.get_hash(
+        constants.PipelineVersion.VERSION_NUMBER,
+        config,
+        mode,
+        force_segmentation,
+        cache_utils.get_file_stats(get_input_files(config)),
+    )
+
+
+def get_output_files(config: Any, since: float) -> List[str]:
+    """Get the files written to the data directory of a subject by a run.
+
+    Args:
+        config: config of the subject
+        since: start time of the run in seconds since the epoch
+    Returns:
+        sorted list of file paths
+    """
+    data_dir = str(config.data_dir)
+    paths = glob.glob(os.path.join(data_dir, "*"))
+    return sorted(
+        path for path in paths if os.path.isfile(path) and os.path.getmtime(path) >= since
+    )
+
+
+def load_manifest(path: str) -> Dict[str, Dict[str, Any]]:
+    """Load a manifest.
+
+    Args:
+        path: path of the manifest file
+    Returns:
+        dictionary of entries by config path, empty if there is no manifest
+    """
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except ValueError:
+        logging.warning("Ignoring corrupted manifest {}".format(path))
+        return {}
+
+
+def update_manifest(path: str, config_path: str, entry: Dict[str, Any]):
+    """Record the run of a subject in a manifest.
+
+    The manifest is written to a temporary file which then replaces the
+    manifest, so that an interrupted batch never leaves a truncated manifest.
+
+    Args:
+        path: path of the manifest file
+        config_path: path of the subject config file
+        entry: status, runtime, outputs and key of the run
+    """
+    manifest = load_manifest(path)
+    manifest[config_path] = dict(
+        entry, finished=datetime.datetime.now().isoformat(timespec="seconds")
+    )
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def is_up_to_date(entry: Dict[str, Any], key: str) -> bool:
+    """Check whether the last run of a subject succeeded with the same inputs.
+
+    Args:
+        entry: manifest entry of the subject
+        key: key of the current inputs, see get_key
+    Returns:
+        True if the subject does not need to run again
+    """
+    return (
+        entry.get("status") == constants.BatchStatus.SUCCESS.value
+        and entry.get("key") == key
+    )
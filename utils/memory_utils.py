@@ -0,0 +1,226 @@
+"""Peak memory estimation util functions for batch scheduling.
+
+The peak resident memory of a subject is dominated by the preallocated index and
+distance arrays of recon/sparse_gridding_distance.py, whose size is the number
+of k-space samples times the cube of the overgridded kernel width, and by the
+overgridded image grids. The peak is modeled as a linear function of these
+quantities, computed from the config and the raw data file sizes before the
+subject is run. The coefficients are calibrated by least squares from the peak
+resident memory recorded for past runs.
+"""
+
+import json
+import logging
+import os
+import resource
+import sys
+from typing import Any, Dict, List, Optional
+
+sys.path.append("..")
+import numpy as np
+
+from utils import constants, io_utils
+
+# bytes per raw k-space sample (complex64)
+BYTES_PER_SAMPLE = 8
+# bytes per entry of the 3 preallocated float64 gridding arrays
+BYTES_PER_GRID_ENTRY = 3 * 8
+OVERGRID_FACTOR = 3
+KERNEL_EXTENT_FACTOR = 9
+FEATURES = ("intercept", "gridding", "image", "cnn")
+# uncalibrated coefficients: 1.5 GB baseline, the features are in bytes
+DEFAULT_COEFFICIENTS = {
+    "intercept": 1.5e9,
+    "gridding": 1.0,
+    "image": 8.0,
+    "cnn": 1.0e9,
+}
+SAFETY_FACTOR = 1.2
+MIN_CALIBRATION_RUNS = 2 * len(FEATURES)
+HISTORY_PATH = "data/batch_memory.jsonl"
+
+
+def _get_file_size(get_file: Any, path: str) -> int:
+    """Get the size of a raw data file, or 0 if it cannot be found.
+
+    Args:
+        get_file: io_utils function returning the file path in a directory
+        path: data directory
+    Returns:
+        file size in bytes
+    """
+    try:
+        return os.path.getsize(get_file(path))
+    except (ValueError, OSError):
+        return 0
+
+
+def get_features(config: Any) -> Dict[str, float]:
+    """Get the features of the peak memory model of a subject.
+
+    Args:
+        config: config of the subject
+    Returns:
+        dictionary of feature values
+    """
+    data_dir = str(config.data_dir)
+    size_dis = _get_file_size(io_utils.get_dis_twix_files, data_dir) or (
+        _get_file_size(io_utils.get_dis_mrd_files, data_dir)
+    )
+    size_ute = 0
+    if config.recon.recon_proton:
+        size_ute = _get_file_size(io_utils.get_ute_twix_files, data_dir) or (
+            _get_file_size(io_utils.get_ute_mrd_files, data_dir)
+        )
+    # the gridding arrays scale with the cube of the kernel width (see
+    # recon/proximity.py); the sharpest kernel is the widest
+    kernel_width = (
+        OVERGRID_FACTOR * KERNEL_EXTENT_FACTOR * float(config.recon.kernel_sharpness_hr)
+    )
+    n_neighbors = int(kernel_width + 1) ** 3
+    # the dissolved-phase file holds both gas and dissolved samples, which are
+    # gridded separately
+    n_samples = max(size_dis / BYTES_PER_SAMPLE / 2, size_ute / BYTES_PER_SAMPLE)
+    grid_size = OVERGRID_FACTOR * int(config.recon.recon_size)
+    return {
+        "intercept": 1.0,
+        "gridding": float(n_samples * n_neighbors * BYTES_PER_GRID_ENTRY),
+        "image": float(grid_size**3 * 2 * BYTES_PER_SAMPLE),
+        "cnn": float(
+            config.segmentation_key
+            in (
+                constants.SegmentationKey.CNN_VENT.value,
+                constants.SegmentationKey.CNN_VENT_QUANTIZED.value,
+            )
+        ),
+    }
+
+
+def get_peak_rss() -> int:
+    """Get the peak resident memory of this process and its children.
+
+    Returns:
+        peak resident memory in bytes
+    """
+    # ru_maxrss is in kilobytes on Linux
+    return 1024 * max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+
+
+def get_total_memory() -> int:
+    """Get the physical memory of the node.
+
+    Returns:
+        memory in bytes
+    """
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+class MemoryModel(object):
+    """Linear model of the peak resident memory of a subject.
+
+    Attributes:
+        coefficients (dict): coefficient of each feature
+        n_runs (int): number of past runs the model is calibrated on
+    """
+
+    def __init__(self, coefficients: Optional[Dict[str, float]] = None):
+        """Init object."""
+        self.coefficients = dict(coefficients or DEFAULT_COEFFICIENTS)
+        self.n_runs = 0
+
+    def predict(self, features: Dict[str, float]) -> float:
+        """Estimate the peak resident memory of a subject.
+
+        Args:
+            features: features of the subject, see get_features
+        Returns:
+            estimated peak memory in bytes, including a safety margin
+        """
+        return SAFETY_FACTOR * sum(
+            self.coefficients[name] * features[name] for name in FEATURES
+        )
+
+    def fit(self, runs: List[Dict[str, Any]]):
+        """Calibrate the model from past runs.
+
+        Keeps the default coefficients if there are too few runs. Negative
+        coefficients are set to 0 and the model is refit without them.
+
+        Args:
+            runs: past runs with "features" and "peak_rss" (bytes)
+        """
+        if len(runs) < MIN_CALIBRATION_RUNS:
+            logging.info(
+                "Only {} past runs, using default memory model.".format(len(runs))
+            )
+            return
+        features = np.array(
+            [[run["features"][name] for name in FEATURES] for run in runs]
+        )
+        peak_rss = np.array([run["peak_rss"] for run in runs], dtype=float)
+        active = np.ones(len(FEATURES), dtype=bool)
+        while True:
+            # scale the columns so that byte-sized and 0/1 features are comparable
+            scale = np.maximum(np.abs(features[:, active]).max(axis=0), 1.0)
+            solution, _, _, _ = np.linalg.lstsq(
+                features[:, active] / scale, peak_rss, rcond=None
+            )
+            solution = solution / scale
+            if np.all(solution >= 0):
+                break
+            active[np.flatnonzero(active)[solution < 0]] = False
+        coefficients = np.zeros(len(FEATURES))
+        coefficients[active] = solution
+        self.coefficients = dict(zip(FEATURES, coefficients.tolist()))
+        self.n_runs = len(runs)
+
+
+def load_history(path: str = HISTORY_PATH) -> List[Dict[str, Any]]:
+    """Load the peak memory of past runs.
+
+    Args:
+        path: path of the json lines history file
+    Returns:
+        list of runs with "features" and "peak_rss"
+    """
+    if not os.path.exists(path):
+        return []
+    runs = []
+    with open(path, "r") as f:
+        for line in f:
+            try:
+                run = json.loads(line)
+            except ValueError:
+                continue
+            if run.get("status") == constants.BatchStatus.SUCCESS.value:
+                runs.append(run)
+    return runs
+
+
+def append_history(run: Dict[str, Any], path: str = HISTORY_PATH):
+    """Record the peak memory of a run.
+
+    Args:
+        run: run with "features", "peak_rss" and "status"
+        path: path of the json lines history file
+    """
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "a") as f:
+        f.write(json.dumps(run) + "\n")
+
+
+def get_calibrated_model(path: str = HISTORY_PATH) -> MemoryModel:
+    """Get the memory model calibrated from the past runs.
+
+    Args:
+        path: path of the json lines history file
+    Returns:
+        calibrated memory model
+    """
+    model = MemoryModel()
+    model.fit(load_history(path))
+    return model
@@ -5,9 +5,8 @@ from datetime import datetime
 
 sys.path.append("..")
 import numpy as np
-from scipy.ndimage.morphology import binary_dilation
 
-from utils import constants
+from utils import constants, filter_utils
 
 
 def _get_dilation_kernel(x: int) -> int:
@@ -33,8 +32,7 @@ def snr(image: np.ndarray, mask: np.ndarray, window_size: int = 8):
         _get_dilation_kernel(shape[1]),
         _get_dilation_kernel(shape[2]),
     )
-    dilate_struct = np.ones((kernel_shape))
-    noise_mask = binary_dilation(mask, dilate_struct).astype(bool)
+    noise_mask = filter_utils.dilate(np.asarray(mask) > 0, kernel_shape)
 
     noise_temp = np.copy(image)
     noise_temp[noise_mask] = np.nan
@@ -70,6 +68,23 @@ def snr(image: np.ndarray, mask: np.ndarray, window_size: int = 8):
     return SNR, SNR * 0.66, image_noise
 
 
+def dice(mask_a: np.ndarray, mask_b: np.ndarray) -> float:
+    """Calculate the Dice similarity coefficient of two masks.
+
+    Args:
+        mask_a: np.ndarray boolean mask.
+        mask_b: np.ndarray boolean mask of the same shape.
+    Returns:
+        Dice coefficient between 0 and 1, 1 if both masks are empty.
+    """
+    mask_a = np.asarray(mask_a).astype(bool)
+    mask_b = np.asarray(mask_b).astype(bool)
+    total = np.sum(mask_a) + np.sum(mask_b)
+    if total == 0:
+        return 1.0
+    return float(2 * np.sum(mask_a & mask_b) / total)
+
+
 def inflation_volume(mask: np.ndarray, fov: float) -> float:
     """Calculate the inflation volume of isotropic 3D image.
 
@@ -3,15 +3,13 @@
 import sys
 from typing import Dict, List, Optional, Tuple
 
-import skimage
-from matplotlib.ticker import ScalarFormatter
-
 sys.path.append("..")
-import cv2
-import matplotlib.pyplot as plt
 import numpy as np
 
-from utils import io_utils
+from utils import filter_utils, io_utils, lazy_import
+
+plt = lazy_import.lazy_module("matplotlib.pyplot", lazy_import.use_headless_backend)
+skimage = lazy_import.lazy_module("skimage")
 
 
 def _merge_rgb_and_gray(gray_slice: np.ndarray, rgb_slice: np.ndarray) -> np.ndarray:
@@ -131,22 +129,12 @@ def overlay_mask_on_image(image: np.ndarray, mask: np.ndarray) -> np.ndarray:
     # divide by the maximum value to normalize to [0, 1]
     image = image / np.max(image)
 
-    def border_mask(mask: np.ndarray) -> np.ndarray:
-        mask_dilated = np.zeros_like(mask)
-        for i in range(mask.shape[2]):
-            mask_dilated[:, :, i] = cv2.dilate(
-                mask[:, :, i].astype(np.uint8), np.ones((3, 3)), iterations=1
-            )
-        return mask_dilated - mask
+    # dilate the mask slice by slice with a 3x3 square
+    mask = np.asarray(mask, dtype=np.uint8)
+    border = filter_utils.dilate(mask, 3, axes=(0, 1), mode="nearest") - mask
 
-    border = border_mask(mask)
-
-    image_out = np.zeros((image.shape[0], image.shape[1], image.shape[2], 3))
-    for i in range(image.shape[2]):
-        image_slice = np.repeat(image[:, :, i][:, :, np.newaxis], 3, axis=2)
-        border_slice = border[:, :, i][:, :, np.newaxis]
-        image_slice[border_slice[..., 0] == 1] = [1, 0, 0]
-        image_out[:, :, i, :] = image_slice
+    image_out = np.repeat(image[..., np.newaxis], 3, axis=3).astype(float)
+    image_out[border == 1] = [1, 0, 0]
 
     return image_out
 
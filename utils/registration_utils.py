@@ -0,0 +1,285 @@
+"""Rigid registration util functions.
+
+In-memory counterpart of the rigid antsRegistration call of registration.py. The
+moving image is registered to the static image by maximizing their mutual
+information over a rigid transform, from the coarsest to the finest level of the
+shrink schedule.
+
+The mutual information is computed from a joint histogram of the voxel
+intensities, where the moving intensities are split linearly between their two
+nearest bins. This makes it differentiable, and its gradient with respect to the
+transform parameters is computed analytically from the gradient of the moving
+image. The parameters follow a regular step gradient ascent, which halves the
+step whenever the mutual information decreases.
+
+Transforms map the voxel coordinates of the static image to those of the moving
+image, as scipy.ndimage.affine_transform expects them:
+
+    x_moving = rotation @ x_static + offset
+"""
+
+import logging
+from typing import List, Sequence, Tuple
+
+import numpy as np
+from scipy import ndimage
+
+# same schedule and metric as the antsRegistration call of registration.py
+SHRINK_FACTORS = (4, 2, 1)
+ITERATIONS = (20, 20, 20)
+N_BINS = 32
+# levels with more voxels are sampled on a regular grid of about as many voxels
+MAX_SAMPLES = 2**18
+# initial step of the gradient ascent in voxels of each level
+LEARNING_RATE = 1.0
+# the ascent of a level stops once the step is below this fraction of a voxel
+MIN_STEP = 0.01
+
+
+def get_rotation(angles: np.ndarray) -> np.ndarray:
+    """Get the rotation matrix of Euler angles.
+
+    Args:
+        angles: rotations in radians about the first, second and third axes,
+            applied in that order
+    Returns:
+        np.ndarray rotation matrix of shape (3, 3)
+    """
+    cos, sin = np.cos(angles), np.sin(angles)
+    rotation_0 = np.array([[1, 0, 0], [0, cos[0], -sin[0]], [0, sin[0], cos[0]]])
+    rotation_1 = np.array([[cos[1], 0, sin[1]], [0, 1, 0], [-sin[1], 0, cos[1]]])
+    rotation_2 = np.array([[cos[2], -sin[2], 0], [sin[2], cos[2], 0], [0, 0, 1]])
+    return rotation_2 @ rotation_1 @ rotation_0
+
+
+def get_rigid_transform(
+    params: np.ndarray, center: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Get the rotation and offset of rigid transform parameters.
+
+    Args:
+        params: three Euler angles in radians and three translations in voxels
+        center: center of rotation in voxels
+    Returns:
+        Tuple of the rotation matrix and the offset of the transform
+    """
+    rotation = get_rotation(params[:3])
+    return rotation, center + params[3:] - rotation @ center
+
+
+def _get_rotation_derivatives(angles: np.ndarray) -> List[np.ndarray]:
+    """Get the derivatives of the rotation matrix with respect to the angles.
+
+    Args:
+        angles: Euler angles in radians
+    Returns:
+        list of the three derivatives of shape (3, 3)
+    """
+    derivatives = []
+    for axis in range(3):
+        delta = np.zeros(3)
+        delta[axis] = 1e-6
+        derivatives.append(
+            (get_rotation(angles + delta) - get_rotation(angles - delta)) / 2e-6
+        )
+    return derivatives
+
+
+def _to_bins(image: np.ndarray, n_bins: int) -> np.ndarray:
+    """Scale the intensities of an image to fractional bin indices.
+
+    Args:
+        image: image
+        n_bins: number of bins of the histogram
+    Returns:
+        np.ndarray float image in [0, n_bins - 1]
+    """
+    low, high = np.min(image), np.max(image)
+    if high <= low:
+        return np.zeros(image.shape)
+    return (image - low) * ((n_bins - 1) / (high - low))
+
+
+def _shrink(image: np.ndarray, factor: int) -> np.ndarray:
+    """Shrink an image by averaging blocks of voxels.
+
+    The block of voxels [k * factor, (k + 1) * factor) along each axis becomes the
+    voxel k, centered on the voxel k * factor + (factor - 1) / 2 of the image.
+
+    Args:
+        image: image
+        factor: shrink factor
+    Returns:
+        np.ndarray shrunk image
+    """
+    if factor == 1:
+        return image
+    padding = [(0, -size % factor) for size in image.shape]
+    image = np.pad(image, padding, mode="edge")
+    shape = []
+    for size in image.shape:
+        shape += [size // factor, factor]
+    return image.reshape(shape).mean(axis=(1, 3, 5))
+
+
+def mutual_information(
+    fixed_bins: np.ndarray, moving_values: np.ndarray, n_bins: int = N_BINS
+) -> Tuple[float, np.ndarray]:
+    """Compute the mutual information of two images and its derivative.
+
+    The moving intensities are split linearly between their two nearest bins of
+    the joint histogram. With the marginal of the fixed image constant, the
+    derivative of the mutual information with respect to the joint probability
+    p_ij is log(p_ij / p_j).
+
+    Args:
+        fixed_bins: int bin indices of the fixed intensities of the samples
+        moving_values: fractional bin indices in [0, n_bins - 1] of the moving
+            intensities of the samples
+        n_bins: number of bins of each image
+    Returns:
+        Tuple of the mutual information and its derivative with respect to the
+        moving value of each sample
+    """
+    n_samples = len(moving_values)
+    lower = np.minimum(moving_values.astype(int), n_bins - 2)
+    weight = moving_values - lower
+    index = fixed_bins * n_bins + lower
+    joint = np.bincount(index, 1 - weight, n_bins**2) + np.bincount(
+        index + 1, weight, n_bins**2
+    )
+    joint = joint.reshape(n_bins, n_bins) / n_samples
+    p_fixed = np.sum(joint, axis=1, keepdims=True)
+    p_moving = np.sum(joint, axis=0, keepdims=True)
+    nonzero = joint > 0
+    information = np.sum(
+        joint[nonzero] * np.log(joint[nonzero] / (p_fixed @ p_moving)[nonzero])
+    )
+    # half a sample keeps the derivative finite next to empty bins
+    epsilon = 0.5 / n_samples
+    log_ratio = np.log(joint + epsilon) - np.log(p_moving + epsilon)
+    derivative = (
+        log_ratio[fixed_bins, lower + 1] - log_ratio[fixed_bins, lower]
+    ) / n_samples
+    return float(information), derivative
+
+
+def register_rigid(
+    fixed: np.ndarray,
+    moving: np.ndarray,
+    shrink_factors: Sequence[int] = SHRINK_FACTORS,
+    iterations: Sequence[int] = ITERATIONS,
+    n_bins: int = N_BINS,
+    learning_rate: float = LEARNING_RATE,
+    max_samples: int = MAX_SAMPLES,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Register a moving image to a fixed image with a rigid transform.
+
+    Args:
+        fixed: fixed image
+        moving: moving image
+        shrink_factors: shrink factor of each level
+        iterations: maximum number of iterations of each level
+        n_bins: number of bins of each image in the joint histogram
+        learning_rate: initial step of the gradient ascent in voxels of each level
+        max_samples: maximum number of voxels sampled on a regular grid per level
+    Returns:
+        Tuple of the rotation matrix and the offset of the transform
+    """
+    fixed = _to_bins(np.abs(fixed), n_bins)
+    moving = _to_bins(np.abs(moving), n_bins)
+    center = (np.array(fixed.shape) - 1) / 2
+    # a rotation of one radian moves the voxels at this radius by as many voxels
+    radius = np.mean(fixed.shape) / 4
+    scales = np.array([radius] * 3 + [1.0] * 3)
+    params = np.zeros(6)
+    for factor, n_iterations in zip(shrink_factors, iterations):
+        fixed_level = _shrink(fixed, factor)
+        moving_level = _shrink(moving, factor)
+        shift = (factor - 1) / 2
+        stride = int(np.ceil((fixed_level.size / max_samples) ** (1 / 3)))
+        sampling = (slice(None, None, stride),) * 3
+        # full resolution coordinates of the sampled voxels of the level
+        points = np.indices(fixed_level.shape)[(slice(None),) + sampling]
+        points = points.reshape(3, -1).T * factor + shift
+        fixed_bins = np.minimum(
+            fixed_level[sampling].ravel().astype(int), n_bins - 1
+        )
+        gradients = np.gradient(moving_level)
+        upper = np.array(moving_level.shape)[:, None] - 1
+        step = learning_rate * factor
+        best = None
+        for _ in range(n_iterations):
+            rotation, offset = get_rigid_transform(params, center)
+            coords = ((points @ rotation.T + offset - shift) / factor).T
+            inside = np.all((coords >= 0) & (coords <= upper), axis=0)
+            coords = coords[:, inside]
+            information, derivative = mutual_information(
+                fixed_bins[inside],
+                ndimage.map_coordinates(moving_level, coords, order=1),
+                n_bins,
+            )
+            if best is not None and information < best[0]:
+                # overshot, step again from the best parameters with half the step
+                params = best[1]
+                step /= 2
+            else:
+                # derivative with respect to the full resolution moving coordinates
+                d_coords = np.stack(
+                    [
+                        ndimage.map_coordinates(gradient, coords, order=1)
+                        for gradient in gradients
+                    ]
+                ) * (derivative / factor)
+                moment = d_coords @ (points[inside] - center)
+                d_params = np.concatenate(
+                    [
+                        [
+                            np.sum(moment * d_rotation)
+                            for d_rotation in _get_rotation_derivatives(params[:3])
+                        ],
+                        np.sum(d_coords, axis=1),
+                    ]
+                )
+                best = (information, params, d_params)
+            if step < MIN_STEP * factor:
+                break
+            direction = best[2] / scales
+            norm = np.linalg.norm(direction)
+            if norm == 0:
+                break
+            params = best[1] + step * direction / norm / scales
+        params = best[1]
+        logging.info(
+            "Shrink factor {}: mutual information {:.4f}".format(factor, best[0])
+        )
+    return get_rigid_transform(params, center)
+
+
+def apply_rigid(
+    image: np.ndarray,
+    rotation: np.ndarray,
+    offset: np.ndarray,
+    output_shape: Tuple[int, ...],
+    order: int = 1,
+) -> np.ndarray:
+    """Resample an image with a rigid transform.
+
+    Args:
+        image: moving image
+        rotation: rotation matrix of the transform
+        offset: offset of the transform
+        output_shape: shape of the fixed image
+        order: order of the spline interpolation, 1 for linear and 3 for B-spline
+    Returns:
+        np.ndarray image resampled on the fixed image
+    """
+    return ndimage.affine_transform(
+        image,
+        rotation,
+        offset,
+        output_shape=output_shape,
+        order=order,
+        mode="constant",
+        cval=0.0,
+    )
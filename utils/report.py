@@ -4,12 +4,13 @@ import sys
 from typing import Any, Dict
 
 import numpy as np
-import pdfkit
-import PyPDF2
-from git.repo import Repo
 
 sys.path.append("..")
-from utils import constants
+from utils import constants, lazy_import
+
+git_repo = lazy_import.lazy_module("git.repo")
+pdfkit = lazy_import.lazy_module("pdfkit")
+PyPDF2 = lazy_import.lazy_module("PyPDF2")
 
 PDF_OPTIONS = {
     "page-width": 300,
@@ -31,11 +32,26 @@ def get_git_branch() -> str:
         str: current git branch, if not in git repo, return "unknown"
     """
     try:
-        return Repo("./").active_branch.name
+        return git_repo.Repo("./").active_branch.name
     except:
         return "unknown"
 
 
+def get_template_paths(tmp_dir: str) -> Dict[str, str]:
+    """Get the directories referenced by the html report templates.
+
+    Args:
+        tmp_dir (str): directory of the figures
+    Returns:
+        Dict[str, str]: absolute paths of the figure and asset directories
+    """
+    current_path = os.path.dirname(__file__)
+    return {
+        "workspace": os.path.abspath(tmp_dir),
+        "assets": os.path.abspath(os.path.join(current_path, os.pardir, "assets")),
+    }
+
+
 def format_dict(dict_stats: Dict[str, Any]) -> Dict[str, Any]:
     """Format dictionary for report.
 
@@ -94,96 +110,100 @@ def format_dict(dict_stats: Dict[str, Any]) -> Dict[str, Any]:
     return dict_stats
 
 
-def clinical(dict_stats: Dict[str, Any], path: str):
+def clinical(dict_stats: Dict[str, Any], path: str, tmp_dir: str = "tmp"):
     """Make clinical report with colormap images.
 
     First converts dictionary to html format. Then saves to path.
     Args:
         dict_stats (Dict[str, Any]): dictionary of statistics
         path (str): path to save report
+        tmp_dir (str): directory of the figures and the intermediate html file
     """
     dict_stats = format_dict(dict_stats)
     current_path = os.path.dirname(__file__)
     path_clinical = os.path.abspath(
         os.path.join(current_path, os.pardir, "assets", "html", "clinical.html")
     )
-    path_html = os.path.join("tmp", "clinical.html")
+    path_html = os.path.join(tmp_dir, "clinical.html")
     # write report to html
     with open(path_clinical, "r") as f:
         file = f.read()
-        rendered = file.format(**dict_stats)
+        rendered = file.format(**dict_stats, **get_template_paths(tmp_dir))
     with open(path_html, "w") as o:
         o.write(rendered)
     # write clinical report to pdf
     pdfkit.from_file(path_html, path, options=PDF_OPTIONS)
 
 
-def grayscale(dict_stats: Dict[str, Any], path: str):
+def grayscale(dict_stats: Dict[str, Any], path: str, tmp_dir: str = "tmp"):
     """Make clinical report with grayscale images.
 
     First converts dictionary to html format. Then saves to path.
     Args:
         dict_stats (Dict[str, Any]): dictionary of statistics
         path (str): path to save report
+        tmp_dir (str): directory of the figures and the intermediate html file
     """
     dict_stats = format_dict(dict_stats)
     current_path = os.path.dirname(__file__)
     path_clinical = os.path.abspath(
         os.path.join(current_path, os.pardir, "assets", "html", "grayscale.html")
     )
-    path_html = os.path.join("tmp", "grayscale.html")
+    path_html = os.path.join(tmp_dir, "grayscale.html")
     # write report to html
     with open(path_clinical, "r") as f:
         file = f.read()
-        rendered = file.format(**dict_stats)
+        rendered = file.format(**dict_stats, **get_template_paths(tmp_dir))
     with open(path_html, "w") as o:
         o.write(rendered)
     # write clinical report to pdf
     pdfkit.from_file(path_html, path, options=PDF_OPTIONS)
 
 
-def intro(dict_info: Dict[str, Any], path: str):
+def intro(dict_info: Dict[str, Any], path: str, tmp_dir: str = "tmp"):
     """Make info report.
 
     First converts dictionary to html format. Then saves to path.
     Args:
         dict_info (Dict[str, Any]): dictionary of statistics
         path (str): path to save report
+        tmp_dir (str): directory of the figures and the intermediate html file
     """
     dict_info = format_dict(dict_info)
     current_path = os.path.dirname(__file__)
     path_clinical = os.path.abspath(
         os.path.join(current_path, os.pardir, "assets", "html", "intro.html")
     )
-    path_html = os.path.join("tmp", "intro.html")
+    path_html = os.path.join(tmp_dir, "intro.html")
     # write report to html
     with open(path_clinical, "r") as f:
         file = f.read()
-        rendered = file.format(**dict_info)
+        rendered = file.format(**dict_info, **get_template_paths(tmp_dir))
     with open(path_html, "w") as o:
         o.write(rendered)
     # write clinical report to pdf
     pdfkit.from_file(path_html, path, options=PDF_OPTIONS)
 
 
-def qa(dict_stats: Dict[str, Any], path: str):
+def qa(dict_stats: Dict[str, Any], path: str, tmp_dir: str = "tmp"):
     """Make quality assurance report.
 
     First converts dictionary to html format. Then saves to path.
     Args:
         dict_info (Dict[str, Any]): dictionary of statistics
         path (str): path to save report
+        tmp_dir (str): directory of the figures and the intermediate html file
     """
     dict_stats = format_dict(dict_stats)
     current_path = os.path.dirname(__file__)
     path_clinical = os.path.abspath(
         os.path.join(current_path, os.pardir, "assets", "html", "qa.html")
     )
-    path_html = os.path.join("tmp", "qa.html")
+    path_html = os.path.join(tmp_dir, "qa.html")
     # write report to html
     with open(path_clinical, "r") as f:
         file = f.read()
-        rendered = file.format(**dict_stats)
+        rendered = file.format(**dict_stats, **get_template_paths(tmp_dir))
     with open(path_html, "w") as o:
         o.write(rendered)
     # write clinical report to pdf
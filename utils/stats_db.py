@@ -0,0 +1,333 @@
+"""Cohort statistics store util functions.
+
+Statistics of every processed subject are stored in SQLite databases, one per
+node, so that the pipeline processes of a node never share a database with those
+of another node over a network filesystem. The processes of a node write to
+their database concurrently, waiting for each other's locks. Rows are keyed by
+(subject_id, scan_date, pipeline_version): reprocessing a subject with the same
+pipeline version replaces its row. Queries merge the databases of all nodes.
+"""
+
+import csv
+import glob
+import logging
+import os
+import re
+import socket
+import sqlite3
+import sys
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+sys.path.append("..")
+import numpy as np
+import pandas as pd
+
+from utils import constants
+
+STATS_DB_DIR = "data/stats_db"
+STATS_CSV_PATH = "data/stats_all.csv"
+TABLE = "stats"
+BUSY_TIMEOUT_MS = 60000
+
+# columns in the order of the legacy csv file, with their python types
+COLUMNS: List[Tuple[str, type]] = [
+    (constants.IOFields.SUBJECT_ID, str),
+    (constants.IOFields.SCAN_DATE, str),
+    (constants.IOFields.PROCESS_DATE, str),
+    (constants.IOFields.SCAN_TYPE, str),
+    (constants.IOFields.PIPELINE_VERSION, int),
+    (constants.IOFields.SOFTWARE_VERSION, str),
+    (constants.IOFields.GIT_BRANCH, str),
+    (constants.IOFields.REFERENCE_DATA_KEY, str),
+    (constants.IOFields.BANDWIDTH, float),
+    (constants.IOFields.SAMPLE_TIME, float),
+    (constants.IOFields.FA_DIS, float),
+    (constants.IOFields.FA_GAS, float),
+    (constants.IOFields.FIELD_STRENGTH, float),
+    (constants.IOFields.FLIP_ANGLE_FACTOR, float),
+    (constants.IOFields.FOV, float),
+    (constants.IOFields.XE_DISSOLVED_OFFSET_FREQUENCY, float),
+    (constants.IOFields.GRAD_DELAY_X, float),
+    (constants.IOFields.GRAD_DELAY_Y, float),
+    (constants.IOFields.GRAD_DELAY_Z, float),
+    (constants.IOFields.HB_CORRECTION_KEY, str),
+    (constants.IOFields.HB, float),
+    (constants.IOFields.RBC_HB_CORRECTION_FACTOR, float),
+    (constants.IOFields.MEMBRANE_HB_CORRECTION_FACTOR, float),
+    (constants.IOFields.KERNEL_SHARPNESS, float),
+    (constants.IOFields.N_SKIP_START, int),
+    (constants.IOFields.N_DIS_REMOVED, int),
+    (constants.IOFields.N_GAS_REMOVED, int),
+    (constants.IOFields.REMOVE_NOISE, bool),
+    (constants.IOFields.SHAPE_FIDS, str),
+    (constants.IOFields.SHAPE_IMAGE, str),
+    (constants.IOFields.T2_CORRECTION_FACTOR_MEMBRANE, float),
+    (constants.IOFields.T2_CORRECTION_FACTOR_RBC, float),
+    (constants.IOFields.TE90, float),
+    (constants.IOFields.TR_DIS, float),
+    (constants.StatsIOFields.INFLATION, float),
+    (constants.StatsIOFields.RBC_M_RATIO, float),
+    (constants.StatsIOFields.VENT_SNR, float),
+    (constants.StatsIOFields.VENT_DEFECT_PCT, float),
+    (constants.StatsIOFields.VENT_LOW_PCT, float),
+    (constants.StatsIOFields.VENT_HIGH_PCT, float),
+    (constants.StatsIOFields.VENT_MEAN, float),
+    (constants.StatsIOFields.VENT_MEDIAN, float),
+    (constants.StatsIOFields.VENT_STDDEV, float),
+    (constants.StatsIOFields.RBC_SNR, float),
+    (constants.StatsIOFields.RBC_DEFECT_PCT, float),
+    (constants.StatsIOFields.RBC_LOW_PCT, float),
+    (constants.StatsIOFields.RBC_HIGH_PCT, float),
+    (constants.StatsIOFields.RBC_MEAN, float),
+    (constants.StatsIOFields.RBC_MEDIAN, float),
+    (constants.StatsIOFields.RBC_STDDEV, float),
+    (constants.StatsIOFields.MEMBRANE_SNR, float),
+    (constants.StatsIOFields.MEMBRANE_DEFECT_PCT, float),
+    (constants.StatsIOFields.MEMBRANE_LOW_PCT, float),
+    (constants.StatsIOFields.MEMBRANE_HIGH_PCT, float),
+    (constants.StatsIOFields.MEMBRANE_MEAN, float),
+    (constants.StatsIOFields.MEMBRANE_MEDIAN, float),
+    (constants.StatsIOFields.MEMBRANE_STDDEV, float),
+    (constants.StatsIOFields.ALVEOLAR_VOLUME, float),
+    (constants.StatsIOFields.KCO_EST, float),
+    (constants.StatsIOFields.DLCO_EST, float),
+]
+KEY_COLUMNS = (
+    constants.IOFields.SUBJECT_ID,
+    constants.IOFields.SCAN_DATE,
+    constants.IOFields.PIPELINE_VERSION,
+)
+INDEX_COLUMNS = (
+    constants.IOFields.SUBJECT_ID,
+    constants.IOFields.SCAN_DATE,
+    constants.IOFields.PROCESS_DATE,
+)
+SQL_TYPES = {str: "TEXT", int: "INTEGER", float: "REAL", bool: "INTEGER"}
+
+
+def get_db_path(db_dir: str = STATS_DB_DIR) -> str:
+    """Get the path of the statistics database of this node.
+
+    Args:
+        db_dir: str directory of the databases
+    Returns:
+        str file path of the database
+    """
+    return os.path.join(
+        db_dir, "stats_{}.db".format(re.sub(r"\W", "_", socket.gethostname()))
+    )
+
+
+def get_db_paths(db_dir: str = STATS_DB_DIR) -> List[str]:
+    """Get the paths of the statistics databases of all nodes.
+
+    Args:
+        db_dir: str directory of the databases
+    Returns:
+        list of str file paths of the databases
+    """
+    return sorted(glob.glob(os.path.join(db_dir, "stats_*.db")))
+
+
+def connect(path: str) -> sqlite3.Connection:
+    """Connect to a statistics database, creating it if needed.
+
+    The database uses a rollback journal rather than WAL, which needs memory
+    shared by all the processes using the database and is unsafe on network
+    filesystems.
+
+    Args:
+        path: str file path of the database
+    Returns:
+        sqlite3 connection
+    """
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT_MS / 1000)
+    conn.execute("PRAGMA journal_mode=DELETE")
+    conn.execute("PRAGMA busy_timeout={}".format(BUSY_TIMEOUT_MS))
+    columns = ", ".join(
+        '"{}" {}'.format(name, SQL_TYPES[type_]) for name, type_ in COLUMNS
+    )
+    key = ", ".join('"{}"'.format(name) for name in KEY_COLUMNS)
+    with conn:
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS {} ({}, PRIMARY KEY ({}))".format(
+                TABLE, columns, key
+            )
+        )
+        for name in INDEX_COLUMNS:
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS idx_{0}_{1} ON {0} ("{1}")'.format(
+                    TABLE, name
+                )
+            )
+    return conn
+
+
+def _to_sql_value(value: Any, type_: type) -> Any:
+    """Convert a statistic to its database representation.
+
+    Args:
+        value: value of the statistic
+        type_: python type of the column
+    Returns:
+        value that can be stored by sqlite3
+    """
+    if value is None:
+        return None
+    if isinstance(value, np.generic):
+        value = value.item()
+    if type_ is str:
+        return str(value)
+    try:
+        return type_(value)
+    except (TypeError, ValueError):
+        logging.warning("Cannot convert {} to {}.".format(value, type_.__name__))
+        return None
+
+
+def upsert_stats(dict_stats: Dict[str, Any], db_dir: str = STATS_DB_DIR):
+    """Insert the statistics of a subject, replacing any existing row.
+
+    The row is written to the database of this node. Rows are keyed by subject
+    id, scan date and pipeline version. Statistics that are not part of the schema
+    are ignored.
+
+    Args:
+        dict_stats: dictionary of statistics and information of the subject
+        db_dir: str directory of the databases
+    """
+    unknown = set(dict_stats.keys()) - set(name for name, _ in COLUMNS)
+    if unknown:
+        logging.warning("Ignoring statistics not in schema: {}".format(unknown))
+    names = [name for name, _ in COLUMNS if name in dict_stats]
+    values = [
+        _to_sql_value(dict_stats[name], type_)
+        for name, type_ in COLUMNS
+        if name in dict_stats
+    ]
+    updates = ", ".join(
+        '"{0}"=excluded."{0}"'.format(name) for name in names if name not in KEY_COLUMNS
+    )
+    conn = connect(get_db_path(db_dir))
+    try:
+        with conn:
+            conn.execute(
+                "INSERT INTO {} ({}) VALUES ({}) ON CONFLICT ({}) DO UPDATE SET {}".format(
+                    TABLE,
+                    ", ".join('"{}"'.format(name) for name in names),
+                    ", ".join("?" * len(names)),
+                    ", ".join('"{}"'.format(name) for name in KEY_COLUMNS),
+                    updates,
+                ),
+                values,
+            )
+    finally:
+        conn.close()
+
+
+def _select_rows(
+    db_dir: str, conditions: Sequence[str] = (), params: Sequence[Any] = ()
+) -> List[Tuple[Any, ...]]:
+    """Select the rows of the databases of all nodes.
+
+    A subject processed on several nodes has a row in each of their databases,
+    the row processed last is kept.
+
+    Args:
+        db_dir: str directory of the databases
+        conditions: SQL conditions that the rows must all meet
+        params: parameters of the conditions
+    Returns:
+        list of rows with the columns of COLUMNS, ordered by process date
+    """
+    query = "SELECT {} FROM {}".format(
+        ", ".join('"{}"'.format(name) for name, _ in COLUMNS), TABLE
+    )
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    names = [name for name, _ in COLUMNS]
+    key_indices = [names.index(name) for name in KEY_COLUMNS]
+    date_index = names.index(constants.IOFields.PROCESS_DATE)
+    rows: Dict[Tuple[Any, ...], Tuple[Any, ...]] = {}
+    for path in get_db_paths(db_dir):
+        conn = connect(path)
+        try:
+            db_rows = conn.execute(query, list(params)).fetchall()
+        finally:
+            conn.close()
+        for row in db_rows:
+            key = tuple(row[i] for i in key_indices)
+            if key not in rows or (row[date_index] or "") >= (
+                rows[key][date_index] or ""
+            ):
+                rows[key] = row
+    return sorted(rows.values(), key=lambda row: row[date_index] or "")
+
+
+def query_stats(
+    db_dir: str = STATS_DB_DIR,
+    subject_ids: Optional[Sequence[str]] = None,
+    pipeline_version: Optional[int] = None,
+    scan_date_from: Optional[str] = None,
+    scan_date_to: Optional[str] = None,
+) -> pd.DataFrame:
+    """Query the statistics of the cohort from the databases of all nodes.
+
+    Args:
+        db_dir: str directory of the databases
+        subject_ids: only return these subjects
+        pipeline_version: only return rows processed with this pipeline version
+        scan_date_from: only return scans on or after this date
+        scan_date_to: only return scans on or before this date
+    Returns:
+        dataframe of statistics, one row per subject, scan date and pipeline version
+    """
+    conditions = []
+    params: List[Any] = []
+    if subject_ids:
+        conditions.append(
+            '"{}" IN ({})'.format(
+                constants.IOFields.SUBJECT_ID, ", ".join("?" * len(subject_ids))
+            )
+        )
+        params += list(subject_ids)
+    if pipeline_version is not None:
+        conditions.append('"{}" = ?'.format(constants.IOFields.PIPELINE_VERSION))
+        params.append(pipeline_version)
+    if scan_date_from:
+        conditions.append('"{}" >= ?'.format(constants.IOFields.SCAN_DATE))
+        params.append(scan_date_from)
+    if scan_date_to:
+        conditions.append('"{}" <= ?'.format(constants.IOFields.SCAN_DATE))
+        params.append(scan_date_to)
+    df = pd.DataFrame(
+        _select_rows(db_dir, conditions, params),
+        columns=[name for name, _ in COLUMNS],
+    )
+    for name, type_ in COLUMNS:
+        if type_ is bool:
+            df[name] = df[name].map(lambda x: None if pd.isnull(x) else bool(x))
+    return df
+
+
+def export_csv(db_dir: str = STATS_DB_DIR, path_csv: str = STATS_CSV_PATH):
+    """Regenerate the legacy cohort csv file from the databases of all nodes.
+
+    Args:
+        db_dir: str directory of the databases
+        path_csv: str file path of the csv file
+    """
+    rows = _select_rows(db_dir)
+    types = [type_ for _, type_ in COLUMNS]
+    with open(path_csv, "w", newline="") as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow([name for name, _ in COLUMNS])
+        for row in rows:
+            writer.writerow(
+                [
+                    "" if value is None else (bool(value) if type_ is bool else value)
+                    for value, type_ in zip(row, types)
+                ]
+            )
@@ -0,0 +1,74 @@
+"""Per-subject scratch workspace."""
+
+import contextlib
+import os
+import shutil
+import tempfile
+import weakref
+from typing import Iterator, Optional
+
+DEFAULT_ROOT = "tmp"
+
+
+class Workspace(object):
+    """Isolated scratch directory for the intermediate and output files of a subject.
+
+    Every subject gets its own directory under the scratch root, so that several
+    subjects can be processed concurrently from the same tree. The root can be
+    placed on tmpfs (e.g. /dev/shm) or on a per-job scratch disk. The directory
+    is removed by cleanup, when used as a context manager exits, or when the
+    workspace is garbage collected.
+
+    Attributes:
+        root (str): absolute path of the workspace directory
+    """
+
+    def __init__(self, scratch_dir: str = DEFAULT_ROOT, prefix: str = ""):
+        """Init object.
+
+        Args:
+            scratch_dir: directory in which the workspace directory is created
+            prefix: prefix of the workspace directory name, e.g. the subject id
+        """
+        os.makedirs(scratch_dir, exist_ok=True)
+        self.root = os.path.abspath(tempfile.mkdtemp(prefix=prefix, dir=scratch_dir))
+        self._finalizer = weakref.finalize(
+            self, shutil.rmtree, self.root, ignore_errors=True
+        )
+
+    def __enter__(self) -> "Workspace":
+        return self
+
+    def __exit__(self, *args):
+        self.cleanup()
+
+    def path(self, name: str) -> str:
+        """Get the path of a file in the workspace.
+
+        Args:
+            name: file name
+        Returns:
+            str absolute file path
+        """
+        return os.path.join(self.root, name)
+
+    def cleanup(self):
+        """Remove the workspace directory and its content."""
+        self._finalizer()
+
+
+@contextlib.contextmanager
+def scratch_dir(path: Optional[str] = None) -> Iterator[str]:
+    """Get a scratch directory for intermediate files.
+
+    Args:
+        path: directory to use. If None, a temporary directory is created and
+            removed on exit.
+    Yields:
+        str path of the scratch directory
+    """
+    if path:
+        yield path
+    else:
+        with tempfile.TemporaryDirectory() as tmp_path:
+            yield tmp_path
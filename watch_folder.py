@@ -0,0 +1,369 @@
+"""Watch-folder ingestion of new scans.
+
+Technologists export the raw data of every scan session to its own folder in a
+watched directory. Once a folder holds a complete file set (the Dixon
+dissolved-phase and the calibration files, plus the UTE file if it was acquired)
+and its files stopped changing, a config is generated under config/auto/ from
+the base config, the scan header and the site overrides, and is enqueued in the
+work queue at high priority.
+
+The site overrides are a json file mapping an institution name (lowercase, as in
+constants.Institution) or "default" to config fields by dotted name:
+
+    {"default": {"segmentation_key": "cnn_vent"},
+     "duke": {"recon.scan_type": "fast", "hb_correction_key": "rbc_and_membrane"}}
+"""
+
+import json
+import logging
+import os
+import re
+import time
+from typing import Any, Dict, Optional, Tuple
+
+from absl import app, flags
+
+import work_queue
+from utils import constants, io_utils
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string("watch_dir", "data/incoming", "directory of the scan folders.")
+flags.DEFINE_string("config_dir", "config/auto", "directory of the generated configs.")
+flags.DEFINE_string("queue_dir", work_queue.QUEUE_DIR, "shared queue directory.")
+flags.DEFINE_string(
+    "site_overrides", "config/site_overrides.json", "json file of site overrides."
+)
+flags.DEFINE_float(
+    "settle_time", 60.0, "seconds without change before a file set is complete."
+)
+flags.DEFINE_float("poll_interval", 10.0, "seconds between scans of the directory.")
+flags.DEFINE_bool(
+    "once", False, "exit once no complete file set is still being written."
+)
+
+CONFIG_TEMPLATE = '''"""Config generated by watch_folder.py from {data_dir}."""
+import sys
+
+from ml_collections import config_dict
+
+# parent directory
+sys.path.append("..")
+
+from config import base_config, config_utils
+
+
+def get_config() -> config_dict.ConfigDict:
+    """Return the config dict. This is a required function.
+
+    Returns:
+        a ml_collections.config_dict.ConfigDict
+    """
+    config = base_config.Config()
+{assignments}
+    return config
+'''
+DEFAULT_SITE = "default"
+STATE_FILE = "ingested.json"
+
+
+def get_file_set(scan_dir: str) -> Dict[str, Optional[str]]:
+    """Get the raw data files of a scan folder.
+
+    Twix files are preferred over MRD files, as when reading the raw data.
+
+    Args:
+        scan_dir: scan folder
+    Returns:
+        dictionary with the path of the "dis", "dyn" and "ute" files, None for the
+        missing ones
+    """
+    getters = {
+        "dis": (io_utils.get_dis_twix_files, io_utils.get_dis_mrd_files),
+        "dyn": (io_utils.get_dyn_twix_files, io_utils.get_dyn_mrd_files),
+        "ute": (io_utils.get_ute_twix_files, io_utils.get_ute_mrd_files),
+    }
+    file_set: Dict[str, Optional[str]] = {}
+    for name, (get_twix, get_mrd) in getters.items():
+        file_set[name] = None
+        for get_file in (get_twix, get_mrd):
+            try:
+                file_set[name] = get_file(scan_dir)
+                break
+            except ValueError:
+                continue
+    return file_set
+
+
+def is_complete(file_set: Dict[str, Optional[str]]) -> bool:
+    """Check whether a file set holds the Dixon and the calibration files.
+
+    Args:
+        file_set: raw data files, see get_file_set
+    Returns:
+        True if the file set can be processed
+    """
+    return file_set["dis"] is not None and file_set["dyn"] is not None
+
+
+def read_header(path: str) -> Optional[Dict[str, Any]]:
+    """Read the header of a Dixon file.
+
+    Args:
+        path: path of the twix or MRD Dixon file
+    Returns:
+        dictionary of header fields, empty if the header lacks the fields, or None
+        if the file cannot be read
+    """
+    try:
+        if path.endswith(".h5"):
+            return io_utils.read_dis_mrd_header(path)
+        return io_utils.read_dis_twix_header(path)
+    except ValueError:
+        logging.warning("Cannot read header of {}, using defaults.".format(path))
+        return {}
+    except Exception as e:
+        logging.warning("Cannot read {}: {}".format(path, e))
+        return None
+
+
+def load_site_overrides(path: str) -> Dict[str, Dict[str, Any]]:
+    """Load the site overrides.
+
+    Args:
+        path: path of the json file of site overrides
+    Returns:
+        dictionary of config fields by dotted name for each site, empty if the
+        file does not exist
+    """
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def get_fields(
+    scan_dir: str,
+    file_set: Dict[str, Optional[str]],
+    header: Dict[str, Any],
+    site_overrides: Dict[str, Dict[str, Any]],
+) -> Dict[str, Any]:
+    """Get the config fields of a scan that differ from the base config.
+
+    Args:
+        scan_dir: scan folder
+        file_set: raw data files, see get_file_set
+        header: header fields of the Dixon file, see read_header
+        site_overrides: config fields for each site, see load_site_overrides
+    Returns:
+        dictionary of config fields by dotted name, in assignment order
+    """
+    subject_id = header.get(constants.IOFields.SUBJECT_ID) or os.path.basename(
+        os.path.normpath(scan_dir)
+    )
+    fields = {
+        "subject_id": str(subject_id),
+        "data_dir": scan_dir,
+        "recon.recon_proton": file_set["ute"] is not None,
+    }
+    site = str(header.get(constants.IOFields.INSTITUTION, "")).lower()
+    fields.update(site_overrides.get(DEFAULT_SITE, {}))
+    fields.update(site_overrides.get(site, {}))
+    return fields
+
+
+def write_config(fields: Dict[str, Any], config_dir: str) -> str:
+    """Write the config file of a scan.
+
+    The config is named after the subject and the scan folder. An existing config
+    is never replaced, a numbered name is used instead.
+
+    Args:
+        fields: config fields by dotted name, see get_fields
+        config_dir: directory of the generated configs
+    Returns:
+        str path of the config file
+    """
+    assignments = [
+        "    config.{} = {!r}".format(name, value) for name, value in fields.items()
+    ]
+    if "recon.n_skip_start" not in fields:
+        assignments.append(
+            "    config.recon.n_skip_start = config_utils.get_n_skip_start("
+            "config.recon.scan_type)"
+        )
+    os.makedirs(config_dir, exist_ok=True)
+    name = get_config_name(fields["subject_id"], fields["data_dir"])
+    path = os.path.join(config_dir, name + ".py")
+    n_configs = 1
+    while os.path.exists(path):
+        n_configs += 1
+        path = os.path.join(config_dir, "{}_{}.py".format(name, n_configs))
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write(
+            CONFIG_TEMPLATE.format(
+                data_dir=fields["data_dir"], assignments="\n".join(assignments)
+            )
+        )
+    os.replace(tmp_path, path)
+    return path
+
+
+def get_config_name(subject_id: str, scan_dir: str) -> str:
+    """Get the module name of the generated config of a scan.
+
+    Visits of the same subject are in different scan folders, so the name
+    includes the scan folder as well as the subject id.
+
+    Args:
+        subject_id: subject id
+        scan_dir: scan folder
+    Returns:
+        str name that is a valid module name, without the .py extension
+    """
+    scan_name = os.path.basename(os.path.normpath(scan_dir))
+    return re.sub(r"\W", "_", "subject_{}_{}".format(subject_id, scan_name))
+
+
+class Watcher(object):
+    """Watcher of the directory of the scan folders.
+
+    Scan folders are ingested once. The ingested folders are recorded in a state
+    file in the config directory, so that restarting the watcher does not read
+    their headers again.
+
+    Attributes:
+        watch_dir (str): directory of the scan folders
+        config_dir (str): directory of the generated configs
+        queue_dir (str): queue directory
+        site_overrides (dict): config fields for each site, see
+            load_site_overrides
+        settle_time (float): seconds without change before a file set is complete
+        ingested (dict): generated config path of each ingested scan folder
+    """
+
+    def __init__(
+        self,
+        watch_dir: str,
+        config_dir: str,
+        queue_dir: str,
+        site_overrides: Dict[str, Dict[str, Any]],
+        settle_time: float,
+    ):
+        """Init object."""
+        self.watch_dir = watch_dir
+        self.config_dir = config_dir
+        self.queue_dir = queue_dir
+        self.site_overrides = site_overrides
+        self.settle_time = settle_time
+        self.ingested: Dict[str, str] = {}
+        if os.path.exists(self._state_path):
+            with open(self._state_path, "r") as f:
+                self.ingested = json.load(f)
+        self._last_stats: Dict[str, Tuple[Any, ...]] = {}
+
+    @property
+    def _state_path(self) -> str:
+        return os.path.join(self.config_dir, STATE_FILE)
+
+    def _is_stable(self, scan_dir: str) -> bool:
+        """Check whether the files of a scan folder stopped changing.
+
+        Args:
+            scan_dir: scan folder
+        Returns:
+            True if no file changed since the last scan nor during the settle time
+        """
+        paths = sorted(os.path.join(scan_dir, name) for name in os.listdir(scan_dir))
+        stats = tuple(
+            (path, os.path.getsize(path), os.path.getmtime(path))
+            for path in paths
+            if os.path.isfile(path)
+        )
+        stable = self._last_stats.get(scan_dir) == stats and all(
+            time.time() - mtime >= self.settle_time for _, _, mtime in stats
+        )
+        if stable:
+            del self._last_stats[scan_dir]
+        else:
+            self._last_stats[scan_dir] = stats
+        return stable
+
+    def _ingest(
+        self,
+        scan_dir: str,
+        file_set: Dict[str, Optional[str]],
+        header: Dict[str, Any],
+    ):
+        """Generate and enqueue the config of a scan folder.
+
+        Args:
+            scan_dir: scan folder
+            file_set: raw data files, see get_file_set
+            header: header fields of the Dixon file, see read_header
+        """
+        fields = get_fields(scan_dir, file_set, header, self.site_overrides)
+        config_path = write_config(fields, self.config_dir)
+        work_queue.enqueue(
+            self.queue_dir, config_path, priority=work_queue.PRIORITY_HIGH
+        )
+        logging.info("Enqueued {} from {}".format(config_path, scan_dir))
+        self.ingested[scan_dir] = config_path
+        tmp_path = self._state_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.ingested, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self._state_path)
+
+    def scan(self) -> int:
+        """Ingest the new scan folders whose file set is complete.
+
+        A folder whose Dixon file cannot be read is skipped until the next scan.
+
+        Returns:
+            number of ingested scan folders
+        """
+        n_ingested = 0
+        for name in sorted(os.listdir(self.watch_dir)):
+            scan_dir = os.path.join(self.watch_dir, name)
+            if not os.path.isdir(scan_dir) or scan_dir in self.ingested:
+                continue
+            file_set = get_file_set(scan_dir)
+            if is_complete(file_set) and self._is_stable(scan_dir):
+                header = read_header(file_set["dis"])
+                if header is None:
+                    logging.warning("Skipping {} until the next scan.".format(scan_dir))
+                    continue
+                self._ingest(scan_dir, file_set, header)
+                n_ingested += 1
+        return n_ingested
+
+    def watch(self, poll_interval: float, once: bool = False):
+        """Poll the directory for new scan folders.
+
+        Args:
+            poll_interval: seconds between scans of the directory
+            once: whether to stop once no complete file set is still changing
+        """
+        while True:
+            self.scan()
+            if once and not self._last_stats:
+                return
+            time.sleep(poll_interval)
+
+
+def main(argv):
+    """Watch the incoming directory and enqueue new scans."""
+    os.makedirs(FLAGS.watch_dir, exist_ok=True)
+    watcher = Watcher(
+        FLAGS.watch_dir,
+        FLAGS.config_dir,
+        FLAGS.queue_dir,
+        load_site_overrides(FLAGS.site_overrides),
+        FLAGS.settle_time,
+    )
+    watcher.watch(FLAGS.poll_interval, FLAGS.once)
+
+
+if __name__ == "__main__":
+    app.run(main)
@@ -0,0 +1,443 @@
+"""File-based work queue for processing subjects on several nodes.
+
+The queue is a directory on a filesystem shared by the nodes, with one
+subdirectory per task state:
+
+    pending/  tasks waiting for a worker
+    claimed/  tasks being processed
+    done/     tasks that succeeded
+    failed/   tasks that failed, timed out or crashed too often
+
+A task is a json file describing a subject config and how to run it. Its file
+name starts with the priority and the enqueue time, so that listing pending/
+in order gives the next task. Workers claim a task by renaming it from pending/
+to claimed/, which is atomic on POSIX and NFS filesystems: exactly one worker
+wins. While processing, the worker touches the claimed file as a heartbeat.
+Claimed tasks whose heartbeat is older than the stale timeout belong to a
+crashed worker or node and are moved back to pending/ by any other worker.
+"""
+
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from typing import Any, Dict, List, Optional, Sequence
+
+import batch
+from utils import cache_utils, constants
+
+QUEUE_DIR = "data/queue"
+PENDING = "pending"
+CLAIMED = "claimed"
+DONE = "done"
+FAILED = "failed"
+STATES = (PENDING, CLAIMED, DONE, FAILED)
+# priority 0 is processed first
+PRIORITY_HIGH = 0
+PRIORITY_DEFAULT = 5
+PRIORITY_LOW = 9
+HEARTBEAT_INTERVAL = 30.0
+STALE_TIMEOUT = 300.0
+POLL_INTERVAL = 10.0
+MAX_ATTEMPTS = 3
+
+
+def _get_state_dir(queue_dir: str, state: str) -> str:
+    """Get the directory of a task state, creating it if needed.
+
+    Args:
+        queue_dir: queue directory
+        state: task state, one of STATES
+    Returns:
+        str directory path
+    """
+    path = os.path.join(queue_dir, state)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _get_task_id(config_path: str) -> str:
+    """Get the id of the task of a subject config.
+
+    Args:
+        config_path: path of the subject config file
+    Returns:
+        str task id, unique per config path
+    """
+    name = os.path.splitext(os.path.basename(config_path))[0]
+    return "{}-{}".format(name, cache_utils.get_hash(os.path.normpath(config_path))[:8])
+
+
+def _read_task(path: str) -> Dict[str, Any]:
+    """Read a task file.
+
+    Args:
+        path: task file path
+    Returns:
+        dictionary describing the task
+    """
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def _write_task(task: Dict[str, Any], path: str):
+    """Write a task file through a temporary file.
+
+    Args:
+        task: dictionary describing the task
+        path: task file path
+    """
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, "w") as f:
+        json.dump(task, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def list_tasks(queue_dir: str, state: str) -> List[str]:
+    """List the task files in a state, in processing order.
+
+    Args:
+        queue_dir: queue directory
+        state: task state, one of STATES
+    Returns:
+        list of task file names
+    """
+    return sorted(
+        name
+        for name in os.listdir(_get_state_dir(queue_dir, state))
+        if name.endswith(".json") and not name.startswith(".")
+    )
+
+
+def enqueue(
+    queue_dir: str,
+    config_path: str,
+    priority: int = PRIORITY_DEFAULT,
+    mode: str = batch.MODE_AUTO,
+    resume: bool = True,
+    force_segmentation: bool = False,
+) -> Optional[str]:
+    """Add a subject config to the queue.
+
+    The task is written to a hidden file first and then renamed into pending/,
+    so that workers never claim a partially written task. A config already
+    pending or claimed is not enqueued again.
+
+    Args:
+        queue_dir: queue directory
+        config_path: path of the subject config file relative to the repository
+            root
+        priority: priority from PRIORITY_HIGH (0) to PRIORITY_LOW (9)
+        mode: pipeline mode, see batch.run_subject
+        resume: whether to restore unchanged stages from checkpoints
+        force_segmentation: whether to run segmentation again when reading in
+    Returns:
+        str task file name, or None if the config is already queued
+    """
+    if not PRIORITY_HIGH <= priority <= PRIORITY_LOW:
+        raise ValueError("Invalid priority {}".format(priority))
+    task_id = _get_task_id(config_path)
+    for state in (PENDING, CLAIMED):
+        if any(name.endswith(task_id + ".json") for name in list_tasks(queue_dir, state)):
+            logging.info("{} is already queued.".format(config_path))
+            return None
+    name = "{}-{:020d}-{}.json".format(priority, time.time_ns(), task_id)
+    pending_dir = _get_state_dir(queue_dir, PENDING)
+    task = {
+        "config_path": config_path,
+        "mode": mode,
+        "resume": resume,
+        "force_segmentation": force_segmentation,
+        "attempts": 0,
+        "enqueued": time.time(),
+    }
+    _write_task(task, os.path.join(pending_dir, "." + name))
+    os.rename(os.path.join(pending_dir, "." + name), os.path.join(pending_dir, name))
+    return name
+
+
+def reap_stale(queue_dir: str, stale_timeout: float = STALE_TIMEOUT) -> int:
+    """Release the claimed tasks whose worker stopped sending heartbeats.
+
+    Released tasks go back to pending/, or to failed/ once they have been
+    attempted MAX_ATTEMPTS times. Tasks not yet stamped with their worker are
+    being claimed and are released only after twice the stale timeout.
+
+    Args:
+        queue_dir: queue directory
+        stale_timeout: seconds without heartbeat after which a task is released
+    Returns:
+        number of released tasks
+    """
+    claimed_dir = _get_state_dir(queue_dir, CLAIMED)
+    n_released = 0
+    for name in list_tasks(queue_dir, CLAIMED):
+        path = os.path.join(claimed_dir, name)
+        try:
+            age = time.time() - os.path.getmtime(path)
+            if age < stale_timeout:
+                continue
+            task = _read_task(path)
+        except (OSError, ValueError):
+            continue  # released or finished by another worker
+        if "worker" not in task and age < 2 * stale_timeout:
+            # still being claimed, unless the claiming worker crashed meanwhile
+            continue
+        # claim the stale task for release, so that a single worker releases it
+        release_path = "{}.{}.release".format(path, os.getpid())
+        try:
+            os.rename(path, release_path)
+        except FileNotFoundError:
+            continue
+        logging.warning(
+            "Releasing {} claimed by {}".format(name, task.get("worker", "unknown"))
+        )
+        if task.get("attempts", 0) >= MAX_ATTEMPTS:
+            task["status"] = constants.BatchStatus.FAILED.value
+            task["error"] = "worker stopped responding {} times".format(
+                task["attempts"]
+            )
+            state = FAILED
+        else:
+            state = PENDING
+        task.pop("worker", None)
+        _write_task(task, release_path)
+        os.rename(release_path, os.path.join(_get_state_dir(queue_dir, state), name))
+        n_released += 1
+    return n_released
+
+
+def claim(queue_dir: str, worker_id: str) -> Optional[str]:
+    """Claim the next pending task.
+
+    Args:
+        queue_dir: queue directory
+        worker_id: id of the worker, recorded in the task
+    Returns:
+        str path of the claimed task file, or None if no task is pending
+    """
+    pending_dir = _get_state_dir(queue_dir, PENDING)
+    claimed_dir = _get_state_dir(queue_dir, CLAIMED)
+    for name in list_tasks(queue_dir, PENDING):
+        path = os.path.join(claimed_dir, name)
+        try:
+            # renaming keeps the modification time, which is the heartbeat, so
+            # the task is touched first to not look stale once claimed
+            os.utime(os.path.join(pending_dir, name))
+            os.rename(os.path.join(pending_dir, name), path)
+        except FileNotFoundError:
+            continue  # claimed by another worker
+        try:
+            task = _read_task(path)
+            task["attempts"] = task.get("attempts", 0) + 1
+            task["worker"] = worker_id
+            task["claimed"] = time.time()
+            _write_task(task, path)
+        except FileNotFoundError:
+            logging.warning("Lost the claim of {}".format(name))
+            continue
+        return path
+    return None
+
+
+def _heartbeat(path: str, stop: threading.Event, interval: float):
+    """Touch a claimed task file until stopped.
+
+    Args:
+        path: claimed task file path
+        stop: event set when the task is finished
+        interval: seconds between heartbeats
+    """
+    while not stop.wait(interval):
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            logging.warning("{} was released while processing.".format(path))
+            return
+
+
+def process(
+    queue_dir: str,
+    path: str,
+    threads: int = 1,
+    timeout: Optional[float] = None,
+    heartbeat_interval: float = HEARTBEAT_INTERVAL,
+    admission: Optional[batch.MemoryAdmission] = None,
+) -> constants.BatchStatus:
+    """Process a claimed task and move it to done/ or failed/.
+
+    The subject runs in a worker process through batch.run_batch. If this process
+    is interrupted, the task is moved back to pending/.
+
+    Args:
+        queue_dir: queue directory
+        path: claimed task file path
+        threads: number of threads of the numerical libraries
+        timeout: maximum wall time of the subject in seconds, or None for no limit
+        heartbeat_interval: seconds between heartbeats
+        admission: memory budget shared by the workers of the node, see
+            batch.MemoryAdmission. Defaults to the budget of the node for this
+            task only.
+    Returns:
+        status of the task
+    """
+    task = _read_task(path)
+    stop = threading.Event()
+    heartbeat = threading.Thread(
+        target=_heartbeat, args=(path, stop, heartbeat_interval), daemon=True
+    )
+    heartbeat.start()
+    try:
+        (job,) = batch.run_batch(
+            [task["config_path"]],
+            threads_per_worker=threads,
+            timeout=timeout,
+            mode=task["mode"],
+            resume=task["resume"],
+            force_segmentation=task["force_segmentation"],
+            admission=admission,
+        )
+    except BaseException:
+        stop.set()
+        task.pop("worker", None)
+        try:
+            _write_task(task, path)
+            os.rename(
+                path,
+                os.path.join(_get_state_dir(queue_dir, PENDING), os.path.basename(path)),
+            )
+        except OSError:
+            logging.warning("Cannot release {}".format(path))
+        raise
+    finally:
+        stop.set()
+        heartbeat.join()
+    task.update(
+        subject_id=job.subject_id,
+        status=job.status.value,
+        runtime=round(job.runtime, 1),
+        error=job.error,
+        finished=time.time(),
+    )
+    state = DONE if job.status == constants.BatchStatus.SUCCESS else FAILED
+    try:
+        _write_task(task, path)
+        os.rename(
+            path, os.path.join(_get_state_dir(queue_dir, state), os.path.basename(path))
+        )
+    except FileNotFoundError:
+        logging.warning("{} was released while processing.".format(path))
+    return job.status
+
+
+def work(
+    queue_dir: str,
+    worker_id: str,
+    threads: int = 1,
+    timeout: Optional[float] = None,
+    wait: bool = False,
+    stale_timeout: float = STALE_TIMEOUT,
+    admission: Optional[batch.MemoryAdmission] = None,
+):
+    """Process tasks until the queue is empty.
+
+    Args:
+        queue_dir: queue directory
+        worker_id: id of the worker, recorded in the tasks
+        threads: number of threads of the numerical libraries
+        timeout: maximum wall time per subject in seconds, or None for no limit
+        wait: whether to keep polling for new tasks when the queue is empty
+        stale_timeout: seconds without heartbeat after which a task is released
+        admission: memory budget shared by the workers of the node
+    """
+    while True:
+        reap_stale(queue_dir, stale_timeout)
+        path = claim(queue_dir, worker_id)
+        if path:
+            logging.info("{} claimed {}".format(worker_id, os.path.basename(path)))
+            process(
+                queue_dir,
+                path,
+                threads,
+                timeout,
+                heartbeat_interval=min(HEARTBEAT_INTERVAL, stale_timeout / 3),
+                admission=admission,
+            )
+        elif wait or list_tasks(queue_dir, CLAIMED):
+            # claimed tasks may still be released by a crashed worker
+            time.sleep(POLL_INTERVAL)
+        else:
+            return
+
+
+def run_workers(
+    queue_dir: str,
+    n_workers: int = 1,
+    threads_per_worker: int = 1,
+    timeout: Optional[float] = None,
+    wait: bool = False,
+    stale_timeout: float = STALE_TIMEOUT,
+    memory_budget: Optional[float] = None,
+):
+    """Run workers on this node until the queue is empty.
+
+    The workers share the memory budget of the node: a claimed subject starts
+    only once its estimated peak memory fits the memory left, see batch.py.
+
+    Args:
+        queue_dir: queue directory
+        n_workers: number of subjects processed concurrently on this node
+        threads_per_worker: number of threads of the numerical libraries in each
+            worker
+        timeout: maximum wall time per subject in seconds, or None for no limit
+        wait: whether to keep polling for new tasks when the queue is empty
+        stale_timeout: seconds without heartbeat after which a task is released
+        memory_budget: memory available to the workers in bytes, or None for a
+            fraction of the physical memory of the node
+    """
+    admission = batch.MemoryAdmission(memory_budget)
+    host = "{}:{}".format(socket.gethostname(), os.getpid())
+    threads = [
+        threading.Thread(
+            target=work,
+            args=(
+                queue_dir,
+                "{}:{}".format(host, i),
+                threads_per_worker,
+                timeout,
+                wait,
+                stale_timeout,
+                admission,
+            ),
+            name="worker{}".format(i),
+        )
+        for i in range(n_workers)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def summarize(queue_dir: str, states: Sequence[str] = STATES) -> str:
+    """Summarize the state of the queue.
+
+    Args:
+        queue_dir: queue directory
+        states: task states to list
+    Returns:
+        str summary with the number of tasks per state and the failed tasks
+    """
+    lines = [
+        "{}: {}".format(state, len(list_tasks(queue_dir, state))) for state in states
+    ]
+    failed_dir = _get_state_dir(queue_dir, FAILED)
+    for name in list_tasks(queue_dir, FAILED):
+        try:
+            task = _read_task(os.path.join(failed_dir, name))
+        except (OSError, ValueError):
+            continue
+        lines.append("{}: {}".format(task["config_path"], task.get("error", "")))
+    return "\n".join(lines)
@@ -0,0 +1,251 @@
+"""Long-lived worker daemon running the pipeline on request.
+
+Starting the pipeline pays for the TensorFlow import and the construction of the
+segmentation model, and every new process compiles the numba gridding kernels
+again. The daemon pays these once: it imports the pipeline and its lazily
+imported dependencies, builds the model and then listens on a Unix socket for
+subject configs, which it runs in-process one at a time. Requests and replies
+are json lines. While a subject runs, its log records are streamed back to the
+client, followed by a final result line.
+
+Start the daemon from the repository root, then submit subjects with
+script_submit.py:
+
+    python worker_daemon.py &
+    python script_submit.py --config config/tests/subject01.py
+"""
+
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+import time
+import traceback
+from typing import Any, Dict
+
+import numpy as np
+from absl import app, flags
+
+import batch
+import reconstruction
+import segmentation
+from main import FLAGS  # also imports the pipeline modules
+from utils import constants, filter_utils, lazy_import, plot, report
+
+PROTOCOL = constants.WorkerDaemon
+
+flags.DEFINE_string("socket", PROTOCOL.SOCKET_PATH, "path of the Unix socket.")
+
+
+def send_message(wfile: Any, message: Dict[str, Any]):
+    """Write a json line to a socket file.
+
+    Args:
+        wfile: writable socket file
+        message: message to send
+    """
+    wfile.write((json.dumps(message) + "\n").encode())
+    wfile.flush()
+
+
+class _SocketLogHandler(logging.Handler):
+    """Logging handler streaming log records to a client."""
+
+    def __init__(self, wfile: Any):
+        """Init object."""
+        super().__init__(level=logging.INFO)
+        self.wfile = wfile
+        self.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+
+    def emit(self, record: logging.LogRecord):
+        """Send a log record to the client."""
+        try:
+            send_message(
+                self.wfile,
+                {PROTOCOL.TYPE: PROTOCOL.TYPE_LOG, "message": self.format(record)},
+            )
+        except (OSError, ValueError):
+            pass  # the client disconnected, the subject keeps running
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    """Handler of a client connection.
+
+    Subjects are run one at a time: the pipeline keeps global state such as the
+    background export pool, and a single subject already uses all the threads
+    of the numerical libraries.
+    """
+
+    run_lock = threading.Lock()
+
+    def handle(self):
+        """Read a request and reply."""
+        try:
+            request = json.loads(self.rfile.readline())
+        except ValueError:
+            send_message(
+                self.wfile,
+                {PROTOCOL.TYPE: PROTOCOL.TYPE_RESULT, "error": "invalid request"},
+            )
+            return
+        action = request.get(PROTOCOL.ACTION, PROTOCOL.ACTION_RUN)
+        if action == PROTOCOL.ACTION_RUN:
+            self._run(request)
+        elif action == PROTOCOL.ACTION_STATUS:
+            send_message(
+                self.wfile,
+                {
+                    PROTOCOL.TYPE: PROTOCOL.TYPE_RESULT,
+                    "busy": self.run_lock.locked(),
+                    "uptime": time.time() - self.server.start_time,
+                    "n_runs": self.server.n_runs,
+                },
+            )
+        elif action == PROTOCOL.ACTION_SHUTDOWN:
+            send_message(
+                self.wfile, {PROTOCOL.TYPE: PROTOCOL.TYPE_RESULT, "status": "stopping"}
+            )
+            threading.Thread(target=self.server.shutdown).start()
+        else:
+            send_message(
+                self.wfile,
+                {
+                    PROTOCOL.TYPE: PROTOCOL.TYPE_RESULT,
+                    "error": "invalid action {}".format(action),
+                },
+            )
+
+    def _run(self, request: Dict[str, Any]):
+        """Run the pipeline on a subject and stream its logs.
+
+        Args:
+            request: config_path relative to the daemon working directory or
+                absolute, and the pipeline flags force_recon, force_readin,
+                force_segmentation and resume
+        """
+        if self.run_lock.locked():
+            send_message(
+                self.wfile,
+                {
+                    PROTOCOL.TYPE: PROTOCOL.TYPE_LOG,
+                    "message": "Waiting for the running subject.",
+                },
+            )
+        with self.run_lock:
+            handler = _SocketLogHandler(self.wfile)
+            logging.getLogger().addHandler(handler)
+            result: Dict[str, Any] = {
+                PROTOCOL.TYPE: PROTOCOL.TYPE_RESULT,
+                "status": constants.BatchStatus.SUCCESS.value,
+            }
+            start = time.time()
+            try:
+                config = batch.load_config(request["config_path"], reload=True)
+                result["subject_id"] = config.subject_id
+                batch.run_subject(
+                    config,
+                    batch.get_mode(
+                        request.get("force_recon", False),
+                        request.get("force_readin", False),
+                    ),
+                    request.get("resume", True),
+                    request.get("force_segmentation", False),
+                )
+            except Exception:
+                logging.error(traceback.format_exc())
+                result["status"] = constants.BatchStatus.FAILED.value
+                result["error"] = traceback.format_exc(limit=-1).strip()
+            finally:
+                logging.getLogger().removeHandler(handler)
+            self.server.n_runs += 1
+            result["runtime"] = time.time() - start
+        try:
+            send_message(self.wfile, result)
+        except OSError:
+            logging.warning("Client disconnected before the result.")
+
+
+class WorkerServer(socketserver.ThreadingUnixStreamServer):
+    """Unix socket server of the worker daemon.
+
+    Attributes:
+        start_time (float): time the server started, in seconds since the epoch
+        n_runs (int): number of subjects run
+    """
+
+    daemon_threads = True
+
+    def __init__(self, socket_path: str = PROTOCOL.SOCKET_PATH):
+        """Init object.
+
+        Args:
+            socket_path: path of the Unix socket
+        """
+        if os.path.dirname(socket_path):
+            os.makedirs(os.path.dirname(socket_path), exist_ok=True)
+        if os.path.exists(socket_path):
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                if sock.connect_ex(socket_path) == 0:
+                    raise OSError(
+                        "A daemon is already listening on {}".format(socket_path)
+                    )
+            os.remove(socket_path)  # left over by a daemon that was killed
+        super().__init__(socket_path, RequestHandler)
+        self.start_time = time.time()
+        self.n_runs = 0
+
+    def server_close(self):
+        """Close the server and remove its socket."""
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+def warm_up():
+    """Import the lazily imported dependencies and build the segmentation model.
+
+    The numba kernels are compiled by running them once on small inputs of the
+    types used by the pipeline.
+    """
+    start = time.time()
+    for module in (
+        plot.plt,
+        plot.skimage,
+        report.git_repo,
+        report.pdfkit,
+        report.PyPDF2,
+    ):
+        try:
+            lazy_import.load(module)
+        except ImportError as e:
+            logging.warning("Cannot import {}: {}".format(module.__name__, e))
+    try:
+        reconstruction.reconstruct(
+            data=np.ones((64, 1), dtype=np.complex128),
+            traj=np.random.default_rng(0).uniform(-0.5, 0.5, (64, 3)),
+            image_size=8,
+            n_dcf_iter=1,
+            verbosity=False,
+        )
+        filter_utils.median_filter(np.zeros((3, 3, 3)))
+    except Exception as e:
+        logging.warning("Cannot compile the numba kernels: {}".format(e))
+    try:
+        segmentation.get_model(constants.ImageType.VENT.value)
+    except Exception as e:
+        logging.warning("Cannot load the segmentation model: {}".format(e))
+    logging.info("Warmed up in {:.1f} s".format(time.time() - start))
+
+
+def main(argv):
+    """Start the worker daemon."""
+    warm_up()
+    with WorkerServer(FLAGS.socket) as server:
+        logging.info("Listening on {}".format(FLAGS.socket))
+        server.serve_forever()
+
+
+if __name__ == "__main__":
+    app.run(main)